@@ -1,11 +1,16 @@
 import geopandas as gpd
+import pandas as pd
 
-try:
+# NYC borough codes used by the bike routes dataset
+BOROUGHS = {1: 'Manhattan', 2: 'Bronx', 3: 'Brooklyn', 4: 'Queens', 5: 'Staten Island'}
+
+def preprocess_bike_routes(input_file, output_file):
     # Load the GeoJSON file into a GeoDataFrame
-    bike_paths = gpd.read_file('../NYC Bike Routes.geojson')
+    bike_paths = gpd.read_file(input_file)
 
     # Selecting the necessary columns and renaming them for clarity
-    bike_paths = bike_paths[['fromstreet', 'tostreet', 'street', 'lanecount', 'facilitycl', 'geometry']]
+    columns = ['fromstreet', 'tostreet', 'street', 'lanecount', 'facilitycl', 'geometry']
+    bike_paths = bike_paths[columns + (['boro'] if 'boro' in bike_paths.columns else [])]
 
     bike_paths.rename(columns={
         'fromstreet': 'From Street',
@@ -15,11 +20,22 @@ try:
         'facilitycl': 'Facility Class'
     }, inplace=True)
 
-    bike_paths.to_file("../processed_bike_paths.geojson", driver='GeoJSON')
+    # Keep the borough by name for per-borough rankings, when the download has it
+    if 'boro' in bike_paths.columns:
+        bike_paths['Borough'] = pd.to_numeric(bike_paths.pop('boro'), errors='coerce').map(BOROUGHS)
+
+    bike_paths.to_file(output_file, driver='GeoJSON')
+    return bike_paths
+
+def main(input_file='../NYC Bike Routes.geojson', output_file='../processed_bike_paths.geojson'):
+    try:
+        bike_paths = preprocess_bike_routes(input_file, output_file)
 
-    print("\nBike Routes Data:")
-    print(bike_paths.info())
+        print("\nBike Routes Data:")
+        print(bike_paths.info())
 
-except Exception as e:
-    print(f"An error occurred: {e}")
+    except Exception as e:
+        print(f"An error occurred: {e}")
 
+if __name__ == "__main__":
+    main()
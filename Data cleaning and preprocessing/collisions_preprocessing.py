@@ -1,54 +1,117 @@
+import os
+import shutil
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from helper_functions import parse_dates, quarantine_file_for, report_unparsed, validate_csv
 
-try:
-    columns_to_keep = [
-        'CRASH DATE', 'CRASH TIME', 'LATITUDE', 'LONGITUDE', 'NUMBER OF PERSONS INJURED',
-        'NUMBER OF PERSONS KILLED', 'NUMBER OF PEDESTRIANS INJURED', 'NUMBER OF PEDESTRIANS KILLED',
-        'NUMBER OF CYCLIST INJURED', 'NUMBER OF CYCLIST KILLED'
+columns_to_keep = [
+    'CRASH DATE', 'CRASH TIME', 'LATITUDE', 'LONGITUDE', 'NUMBER OF PERSONS INJURED',
+    'NUMBER OF PERSONS KILLED', 'NUMBER OF PEDESTRIANS INJURED', 'NUMBER OF PEDESTRIANS KILLED',
+    'NUMBER OF CYCLIST INJURED', 'NUMBER OF CYCLIST KILLED'
+]
+
+int_columns = [
+    'NUMBER OF PERSONS INJURED', 'NUMBER OF PERSONS KILLED',
+    'NUMBER OF PEDESTRIANS INJURED', 'NUMBER OF PEDESTRIANS KILLED',
+    'NUMBER OF CYCLIST INJURED', 'NUMBER OF CYCLIST KILLED'
+]
+
+# Typed output columns, with 'CRASH DATETIME' as the third column and the year used for partitioning
+output_schema = pa.schema(
+    [
+        ('CRASH DATE', pa.timestamp('ns')),
+        ('CRASH DATETIME', pa.timestamp('ns')),
+        ('LATITUDE', pa.float32()),
+        ('LONGITUDE', pa.float32()),
     ]
-    collisions = pd.read_csv(
-        '../Motor_Vehicle_Collisions.csv',
-        usecols=columns_to_keep,
-        parse_dates=['CRASH DATE'],
-        on_bad_lines='skip'
-    )
-    
+    + [(col, pa.int16()) for col in int_columns]
+    + [('CRASH YEAR', pa.int16())]
+)
+
+# Rows read from the raw CSV at a time, keeps peak memory flat regardless of the file size
+CHUNK_SIZE = 250_000
+
+def normalize_crash_time(crash_time):
+    # Split CRASH TIME ("H", "H:MM" or "HH:MM:SS") into numeric hours, minutes and seconds
+    parts = crash_time.str.split(':', n=2, expand=True).reindex(columns=range(3))
+    hours = pd.to_numeric(parts[0], errors='coerce')
+    minutes = pd.to_numeric(parts[1], errors='coerce').fillna(0)
+    seconds = pd.to_numeric(parts[2], errors='coerce').fillna(0)
+
+    # Out of range times become NaT, as they did when parsed with '%H:%M:%S'
+    valid = hours.between(0, 23) & minutes.between(0, 59) & seconds.between(0, 59)
+    offset = (hours * 3600 + minutes * 60 + seconds).where(valid)
+    return pd.to_timedelta(offset, unit='s')
+
+def clean_collisions_chunk(collisions):
+    # Cleaned rows of one chunk, and the dates and times that didn't parse, whose rows are dropped
     # Filling in NaN values with 0 before conversion to int16
-    int_columns = [
-        'NUMBER OF PERSONS INJURED', 'NUMBER OF PERSONS KILLED',
-        'NUMBER OF PEDESTRIANS INJURED', 'NUMBER OF PEDESTRIANS KILLED',
-        'NUMBER OF CYCLIST INJURED', 'NUMBER OF CYCLIST KILLED'
-    ]
     collisions[int_columns] = collisions[int_columns].fillna(0).astype('int16')
 
-    # Standardizing CRASH TIME format to HH:MM:SS
-    collisions['CRASH TIME'] = collisions['CRASH TIME'].apply(
-        lambda x: x if len(x.split(':')) == 3 else (x + ':00' if ':' in x else x + ':00:00')
+    # Combining 'CRASH DATE' and the normalized 'CRASH TIME' into a single datetime column
+    collisions['CRASH DATE'], unparsed_dates = parse_dates(collisions['CRASH DATE'], '%m/%d/%Y')
+    crash_time = normalize_crash_time(collisions['CRASH TIME'].astype(str))
+    unparsed_times = collisions['CRASH TIME'][crash_time.isna() & collisions['CRASH TIME'].notna() & collisions['CRASH DATE'].notna()]
+    collisions['CRASH DATETIME'] = collisions['CRASH DATE'] + crash_time
+
+    # Dropping rows with missing essential coordinates or datetime
+    collisions = collisions.dropna(subset=['LATITUDE', 'LONGITUDE', 'CRASH DATETIME'])
+
+    collisions = collisions.assign(**{'CRASH YEAR': collisions['CRASH DATETIME'].dt.year.astype('int16')})
+    return collisions[output_schema.names], {'CRASH DATE': unparsed_dates, 'CRASH TIME': unparsed_times}
+
+def preprocess_collisions(input_file, output_dir, chunk_size=CHUNK_SIZE, quarantine_file=None):
+    # Start from an empty dataset so reruns don't append duplicate rows
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+
+    # Malformed records are quarantined with a reason instead of being skipped silently by the reader;
+    # anything the reader still finds wrong is reported as a warning
+    rejected_rows, _ = validate_csv(input_file, quarantine_file=quarantine_file or quarantine_file_for(input_file, output_dir))
+    chunks = pd.read_csv(
+        input_file,
+        usecols=columns_to_keep,
+        dtype={'CRASH DATE': str, 'CRASH TIME': str, 'LATITUDE': 'float32', 'LONGITUDE': 'float32'},
+        skiprows=set(rejected_rows),
+        on_bad_lines='warn',
+        chunksize=chunk_size
     )
 
-    # Combining 'CRASH DATE' and 'CRASH TIME' into a single datetime column
-    collisions['CRASH DATETIME'] = pd.to_datetime(collisions['CRASH DATE'].dt.strftime('%Y-%m-%d') + ' ' + collisions['CRASH TIME'],
-                                                  format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    rows_written = 0
+    unparsed = {'CRASH DATE': [], 'CRASH TIME': []}
+    for chunk_number, chunk in enumerate(chunks):
+        collisions, chunk_unparsed = clean_collisions_chunk(chunk)
+        table = pa.Table.from_pandas(collisions, schema=output_schema, preserve_index=False)
 
-    # Dropping rows with missing essential coordinates or datetime
-    collisions.dropna(subset=['LATITUDE', 'LONGITUDE', 'CRASH DATETIME'], inplace=True)
+        # Each chunk is written as its own file in every year partition it touches
+        pq.write_to_dataset(
+            table,
+            root_path=output_dir,
+            partition_cols=['CRASH YEAR'],
+            basename_template=f'part-{chunk_number:05d}-{{i}}.parquet'
+        )
+        rows_written += len(collisions)
+        n_unparsed = sum(len(values) for values in chunk_unparsed.values())
+        print(f"Processed chunk {chunk_number}: {len(chunk)} rows read, {len(collisions)} rows kept"
+              + (f", {n_unparsed} dropped for unparsed dates or times" if n_unparsed else ''))
+        for column, values in chunk_unparsed.items():
+            unparsed[column].append(values)
 
+    report_unparsed('CRASH DATE', pd.concat(unparsed['CRASH DATE']), 'MM/DD/YYYY', 'so their crashes were dropped')
+    report_unparsed('CRASH TIME', pd.concat(unparsed['CRASH TIME']), 'H:MM[:SS]', 'so their crashes were dropped')
+    return rows_written
 
-    # New order with 'CRASH DATETIME' as the third column
-    new_columns = [
-        'CRASH DATE', 'CRASH TIME', 'CRASH DATETIME', 'LATITUDE', 'LONGITUDE', 
-        'NUMBER OF PERSONS INJURED', 'NUMBER OF PERSONS KILLED', 
-        'NUMBER OF PEDESTRIANS INJURED', 'NUMBER OF PEDESTRIANS KILLED', 
-        'NUMBER OF CYCLIST INJURED', 'NUMBER OF CYCLIST KILLED'
-    ]
-    
-    collisions = collisions[new_columns]
-    collisions.to_csv('cleaned_motor_vehicle_collisions.csv', index=False)
-    
-    print("\nCollisions Data:")
-    print(collisions.info())
+def main(input_file='../Motor_Vehicle_Collisions.csv', output_dir='../cleaned_motor_vehicle_collisions.parquet'):
+    try:
+        rows_written = preprocess_collisions(input_file, output_dir)
 
+        print("\nCollisions Data:")
+        print(f"{rows_written} rows written to {output_dir}")
+        print(output_schema)
 
-except Exception as e:
-    print("An error occurred:", e)
+    except Exception as e:
+        print("An error occurred:", e)
 
+if __name__ == "__main__":
+    main()
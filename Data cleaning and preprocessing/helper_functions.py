@@ -1,8 +1,239 @@
+import csv
+import json
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
 collisions_expected_number_of_fields = 29
 
+# Bytes scanned per block; the scan keeps a handful of arrays of this length, so memory stays flat for any file size
+BLOCK_SIZE = 16 * 1024 ** 2
+
+# Files smaller than this are scanned in the calling process, a pool doesn't pay off
+PARALLEL_MIN_BYTES = 64 * 1024 ** 2
+
+NEWLINE, QUOTE, COMMA, CR = ord('\n'), ord('"'), ord(','), ord('\r')
+
+# Bytes a quote that delimits a quoted field touches on at least one side; a quote with none of these on
+# either side sits inside unquoted text, where the readers take it literally
+QUOTE_NEIGHBORS = np.zeros(256, dtype=bool)
+QUOTE_NEIGHBORS[[NEWLINE, QUOTE, COMMA, CR]] = True
+
+def next_line_start(data, offset):
+    # First byte after the newline at or following offset
+    if offset <= 0:
+        return 0
+    newline = data.find(b'\n', offset - 1)
+    return len(data) if newline == -1 else newline + 1
+
+def field_quotes(buffer):
+    # Positions of the quotes that open or close quoted fields in a block of whole lines
+    quotes = np.flatnonzero(buffer == QUOTE).astype(np.int32)
+    before = buffer[np.maximum(quotes - 1, 0)].copy()
+    before[quotes == 0] = NEWLINE
+    after = buffer[np.minimum(quotes + 1, len(buffer) - 1)].copy()
+    after[quotes == len(buffer) - 1] = NEWLINE
+    return quotes[QUOTE_NEIGHBORS[before] | QUOTE_NEIGHBORS[after]]
+
+def count_field_quotes(file_path, start, end, block_size=BLOCK_SIZE):
+    # Number of field quotes between two line starts, to find where quoted fields cross a range boundary
+    count = 0
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        block_start = start
+        while block_start < end:
+            block_end = min(end, next_line_start(data, block_start + block_size))
+            count += len(field_quotes(np.frombuffer(data[block_start:block_end], dtype=np.uint8)))
+            block_start = block_end
+    return count
+
+def scan_block(block, final=True):
+    # Quote-aware field count of every record in a block starting on a record boundary, with numpy instead of a
+    # Python loop per line. A record runs over several lines while a quoted field is open at a line end, as the
+    # readers parse it. Work is per line and per quote; commas are only located once and then counted by binary
+    # search. Positions fit in int32 for any block size used here, which halves the memory the searches walk.
+    # Returns the records and the bytes and lines they cover; a record still open at the end of the block is
+    # left out, unless the block is final, where it is returned as an unbalanced record.
+    buffer = np.frombuffer(block, dtype=np.uint8)
+    line_ends = np.flatnonzero(buffer == NEWLINE).astype(np.int32)
+    if buffer[-1] != NEWLINE:
+        line_ends = np.append(line_ends, np.int32(len(buffer)))
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1)).astype(np.int32)
+
+    # Quotes alternate between opening and closing a quoted field ("" inside one closes and reopens it),
+    # so a line that ends after an odd number of them ends inside a quoted field and the record goes on
+    commas = np.flatnonzero(buffer == COMMA).astype(np.int32)
+    quotes = field_quotes(buffer)
+    last_lines = np.flatnonzero(np.searchsorted(quotes, line_ends) % 2 == 0)
+    unbalanced = np.zeros(len(last_lines), dtype=bool)
+    if final and (len(last_lines) == 0 or last_lines[-1] != len(line_ends) - 1):
+        last_lines = np.append(last_lines, len(line_ends) - 1)
+        unbalanced = np.append(unbalanced, True)
+    first_lines = np.concatenate(([0], last_lines[:-1] + 1)).astype(np.int64)
+    record_starts, record_ends = line_starts[first_lines], line_ends[last_lines]
+
+    # Commas inside quoted fields don't separate fields; a field left open runs to the end of the block
+    openers, closers = quotes[0::2], np.append(quotes[1::2], np.int32(len(buffer)))[:len(quotes[0::2])]
+    quoted_commas = np.searchsorted(commas, closers) - np.searchsorted(commas, openers)
+    record_commas = np.searchsorted(commas, record_ends) - np.searchsorted(commas, record_starts)
+    span_records = np.searchsorted(record_ends, openers)
+    in_records = span_records < len(record_ends)
+    fields = record_commas - np.bincount(span_records[in_records], weights=quoted_commas[in_records],
+                                         minlength=len(record_ends)).astype(np.int64) + 1
+
+    # Empty lines (or a lone \r) are skipped by the CSV readers rather than rejected
+    lengths = record_ends - record_starts
+    blank = (lengths == 0) | ((lengths == 1) & (buffer[np.minimum(record_starts, len(buffer) - 1)] == CR))
+    covered_bytes = int(record_ends[-1]) + 1 if len(record_ends) else 0
+    covered_lines = int(last_lines[-1]) + 1 if len(last_lines) else 0
+    return record_starts, record_ends, first_lines, fields, blank, unbalanced, min(covered_bytes, len(buffer)), covered_lines
+
+def scan_range(file_path, start, end, expected_fields, block_size=BLOCK_SIZE):
+    # Bad records between two record starts of the file, read block by block through a memory map.
+    # Returns the number of records and lines scanned and (record index, line index, start, end, field count,
+    # reason) of each bad record; a record is one row of the CSV readers, and may span several lines.
+    rejected = []
+    n_records = n_lines = 0
+    if start >= end:
+        return n_records, n_lines, rejected
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        block_start = start
+        while block_start < end:
+            block_end = min(end, next_line_start(data, block_start + block_size))
+            final = block_end == end
+            (record_starts, record_ends, first_lines, fields, blank, unbalanced,
+             covered_bytes, covered_lines) = scan_block(data[block_start:block_end], final)
+            if covered_bytes == 0 and not final:
+                # A single record longer than the block; scan it in a bigger one
+                block_size *= 2
+                continue
+
+            bad = ~blank & (unbalanced | (fields != expected_fields))
+            for record in np.flatnonzero(bad):
+                reason = 'unbalanced quotes' if unbalanced[record] else ('too many fields' if fields[record] > expected_fields else 'too few fields')
+                rejected.append((n_records + int(record), n_lines + int(first_lines[record]), block_start + int(record_starts[record]),
+                                 block_start + int(record_ends[record]), int(fields[record]), reason))
+            n_records += len(record_starts)
+            n_lines += covered_lines
+
+            # A record still open at the end of the block is scanned again from its start with the next block
+            block_start = block_end if final else block_start + covered_bytes
+    return n_records, n_lines, rejected
+
+def split_ranges(data, n_parts):
+    # Split the file into roughly equal byte ranges that each start and end on a line boundary
+    bounds = sorted({next_line_start(data, len(data) * part // n_parts) for part in range(n_parts)} | {len(data)})
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def next_record_start(data, offset, end):
+    # First line start at or after offset that isn't inside a quoted field, given that offset is inside one
+    open_field = True
+    while open_field and offset < end:
+        line_end = next_line_start(data, offset + 1)
+        open_field ^= len(field_quotes(np.frombuffer(data[offset:line_end], dtype=np.uint8))) % 2 == 1
+        offset = line_end
+    return offset
+
+def record_ranges(file_path, data, ranges, n_jobs):
+    # Move range boundaries that fall inside a multi-line quoted field to the next record start,
+    # from the number of field quotes before each boundary
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        counts = list(executor.map(count_field_quotes, [file_path] * len(ranges), *zip(*ranges)))
+    bounds = [ranges[0][0]]
+    for (start, end), quotes_before in zip(ranges[1:], np.cumsum(counts)[:-1]):
+        bounds.append(max(bounds[-1], next_record_start(data, start, end) if quotes_before % 2 else start))
+    bounds.append(ranges[-1][1])
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def validate_csv(file_path, expected_fields=None, quarantine_file=None, n_jobs=None):
+    # Scan a raw CSV for records the readers would drop or misparse: wrong quote-aware field count or a quoted
+    # field that never closes. Quoted fields may span lines, like the readers allow. Rejected records go to the
+    # quarantine file with their row index, line number and reason. The header sets the expected count unless one
+    # is given. Returns the 0-based row indices of the rejected records, as skiprows counts them, and a summary.
+    with open(file_path, 'rb') as file:
+        header = file.readline()
+    if expected_fields is None:
+        expected_fields = len(next(csv.reader([header.decode('utf-8', errors='replace')]), ['']))
+    data_start = len(header)
+
+    size = os.path.getsize(file_path)
+    n_jobs = n_jobs or os.cpu_count()
+    if size == 0:
+        ranges = []
+    else:
+        with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            n_parts = n_jobs if size >= PARALLEL_MIN_BYTES and n_jobs > 1 else 1
+            ranges = [(max(start, data_start), end) for start, end in split_ranges(data, n_parts) if end > data_start]
+            if len(ranges) > 1:
+                ranges = record_ranges(file_path, data, ranges, n_jobs)
+
+    # Each worker maps the file itself, so only the bad records' offsets cross process boundaries
+    arguments = ([file_path] * len(ranges), [start for start, _ in ranges], [end for _, end in ranges], [expected_fields] * len(ranges))
+    if len(ranges) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(scan_range, *arguments))
+    else:
+        results = [scan_range(*args) for args in zip(*arguments)]
+
+    # Row and line numbers are global: the header is row and line 0 and each range continues from the previous one
+    rejected = []
+    n_records = n_lines = 1
+    for range_records, range_lines, range_rejected in results:
+        rejected.extend((n_records + record, n_lines + line, *rest) for record, line, *rest in range_rejected)
+        n_records += range_records
+        n_lines += range_lines
+
+    reasons = {}
+    for *_, reason in rejected:
+        reasons[reason] = reasons.get(reason, 0) + 1
+    summary = {
+        'file': file_path, 'bytes': size, 'expected_fields': expected_fields,
+        'records': n_records - 1, 'lines': n_lines - 1, 'rejected': len(rejected), 'reasons': reasons,
+    }
+
+    if quarantine_file:
+        write_quarantine(file_path, rejected, quarantine_file)
+        summary['quarantine_file'] = quarantine_file
+        with open(os.path.splitext(quarantine_file)[0] + '.summary.json', 'w') as file:
+            json.dump(summary, file, indent=2)
+
+    print(f"{os.path.basename(file_path)}: {summary['records']} records checked, {summary['rejected']} rejected"
+          + (f" ({', '.join(f'{count} {reason}' for reason, count in reasons.items())})" if reasons else ''))
+    return [record for record, *_ in rejected], summary
+
+def write_quarantine(file_path, rejected, quarantine_file):
+    # One row per rejected record with where it came from, why it was rejected and the raw text
+    os.makedirs(os.path.dirname(quarantine_file) or '.', exist_ok=True)
+    with open(file_path, 'rb') as file, open(quarantine_file, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output)
+        writer.writerow(['row_index', 'line_number', 'reason', 'field_count', 'raw_record'])
+        if not rejected:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for record, line, start, end, fields, reason in rejected:
+                writer.writerow([record, line + 1, reason, fields, data[start:end].decode('utf-8', errors='replace').rstrip('\r')])
+
+def parse_dates(values, date_format):
+    # Dates in the expected format, and the non-empty values in any other format, which became NaT
+    dates = pd.to_datetime(values, format=date_format, errors='coerce')
+    return dates, values[dates.isna() & values.notna()]
+
+def report_unparsed(column, unparsed, expected, consequence, n_examples=5):
+    # Summarize the values that didn't parse, with a few of them, rather than losing their rows silently
+    if len(unparsed):
+        examples = ', '.join(repr(value) for value in pd.unique(unparsed)[:n_examples])
+        print(f"Warning: {len(unparsed)} {column} values not in {expected} format {consequence}, e.g. {examples}")
+
+def quarantine_file_for(input_file, output_path):
+    # Quarantine file of a raw input, in a 'quarantine' folder next to its processed output
+    name = os.path.splitext(os.path.basename(input_file))[0]
+    return os.path.join(os.path.dirname(os.path.abspath(output_path)), 'quarantine', f'{name}.rejected.csv')
+
 def inspect_bad_lines(file_path, expected_fields):
-    with open(file_path, 'r') as file:
-        for line_number, line in enumerate(file, 1):
-            fields = line.strip().split(',')  # Adjust delimiter as needed
-            if len(fields) != expected_fields:
-                print(f"Line {line_number}: {line.strip()}")  # Print problematic line
\ No newline at end of file
+    # Print the records whose quote-aware field count doesn't match; file line numbers start at 1
+    _, _, rejected = scan_range(file_path, 0, os.path.getsize(file_path), expected_fields)
+    with open(file_path, 'rb') as file:
+        for _, line, start, end, _, reason in rejected:
+            file.seek(start)
+            print(f"Line {line + 1} ({reason}): {file.read(end - start).decode('utf-8', errors='replace').strip()}")
@@ -1,43 +1,91 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas.api.types import union_categoricals
+from helper_functions import parse_dates, quarantine_file_for, report_unparsed, validate_csv
 
-try:
-    traffic_counts = pd.read_csv('../Traffic_Volume_Counts.csv')
-    traffic_counts.drop(['ID', 'SegmentID', 'Direction'], axis=1, inplace=True)
+key_columns = ['Roadway Name', 'From', 'To']
 
-    traffic_counts['Date'] = pd.to_datetime(traffic_counts['Date'])
+hour_columns = [
+    '12:00-1:00 AM', '1:00-2:00AM', '2:00-3:00AM', '3:00-4:00AM',
+    '4:00-5:00AM', '5:00-6:00AM', '6:00-7:00AM', '7:00-8:00AM',
+    '8:00-9:00AM', '9:00-10:00AM', '10:00-11:00AM', '11:00-12:00PM',
+    '12:00-1:00PM', '1:00-2:00PM', '2:00-3:00PM', '3:00-4:00PM',
+    '4:00-5:00PM', '5:00-6:00PM', '6:00-7:00PM', '7:00-8:00PM',
+    '8:00-9:00PM', '9:00-10:00PM', '10:00-11:00PM', '11:00-12:00AM'
+]
 
-    # Sorting data for sequential processing
-    traffic_counts.sort_values(by=['Roadway Name', 'From', 'To', 'Date'], inplace=True)
+# Typed output columns; the names match the earlier CSV output so readers can use either
+output_schema = pa.schema(
+    [(col, pa.dictionary(pa.int32(), pa.string())) for col in key_columns]
+    + [(f'{hour} sum', pa.int64()) for hour in hour_columns]
+    + [('Number of Days Measured', pa.int32()), ('Last Day of Count', pa.timestamp('ns'))]
+)
 
-    hour_columns = [
-        '12:00-1:00 AM', '1:00-2:00AM', '2:00-3:00AM', '3:00-4:00AM',
-        '4:00-5:00AM', '5:00-6:00AM', '6:00-7:00AM', '7:00-8:00AM',
-        '8:00-9:00AM', '9:00-10:00AM', '10:00-11:00AM', '11:00-12:00PM',
-        '12:00-1:00PM', '1:00-2:00PM', '2:00-3:00PM', '3:00-4:00PM',
-        '4:00-5:00PM', '5:00-6:00PM', '6:00-7:00PM', '7:00-8:00PM',
-        '8:00-9:00PM', '9:00-10:00PM', '10:00-11:00PM', '11:00-12:00AM'
-    ]
+# Rows read from the raw CSV at a time, keeps peak memory flat regardless of the file size
+CHUNK_SIZE = 250_000
+
+DATE_FORMAT = '%m/%d/%Y'
+
+def aggregate_traffic_chunk(traffic_counts):
+    # Partial sums, day counts and last count day for the segments in one chunk, and the dates that didn't parse.
+    # Their counts still add to the hour sums, but they aren't measured days and can't be the last count day
+    traffic_counts['Date'], unparsed_dates = parse_dates(traffic_counts['Date'], DATE_FORMAT)
+
+    # No sort needed: the grouping hashes the categorical keys and only visits segments present in the chunk
+    grouped = traffic_counts.groupby(key_columns, observed=True, sort=False)
+    partial = grouped[hour_columns].sum()
+    partial['Date count'] = grouped['Date'].count()
+    partial['Date max'] = grouped['Date'].max()
+    return partial.reset_index(), unparsed_dates
+
+def combine_partial_aggregates(partials):
+    # Sums and counts add up across chunks and the last count day is the latest of them
+    combined = pd.DataFrame({col: union_categoricals([partial[col] for partial in partials]) for col in key_columns})
+    for col in hour_columns + ['Date count', 'Date max']:
+        combined[col] = pd.concat([partial[col] for partial in partials], ignore_index=True)
 
-    # Grouping by 'Roadway Name', 'From', and 'To' and setting up aggregation functions
     aggregation_functions = {hour: 'sum' for hour in hour_columns}
-    aggregation_functions['Date'] = ['count', 'max']
-    
-    result = traffic_counts.groupby(['Roadway Name', 'From', 'To']).agg(aggregation_functions).reset_index()
+    aggregation_functions.update({'Date count': 'sum', 'Date max': 'max'})
+    return combined.groupby(key_columns, observed=True, sort=False).agg(aggregation_functions).reset_index()
+
+def preprocess_traffic_counts(input_file, output_file, chunk_size=CHUNK_SIZE, quarantine_file=None):
+    # Malformed records are quarantined with a reason instead of failing the whole run
+    rejected_rows, _ = validate_csv(input_file, quarantine_file=quarantine_file or quarantine_file_for(input_file, output_file))
+    chunks = pd.read_csv(
+        input_file,
+        usecols=key_columns + ['Date'] + hour_columns,
+        dtype={**{col: 'category' for col in key_columns}, 'Date': str, **{hour: 'float64' for hour in hour_columns}},
+        skiprows=set(rejected_rows),
+        chunksize=chunk_size
+    )
 
-    # Flattening the leftover MultiIndexes in columns
-    result.columns = [' '.join(col).strip() for col in result.columns.values]
+    partials, unparsed_dates = [], []
+    for chunk_number, chunk in enumerate(chunks):
+        partial, unparsed = aggregate_traffic_chunk(chunk)
+        partials.append(partial)
+        unparsed_dates.append(unparsed)
+        print(f"Processed chunk {chunk_number}: {len(chunk)} rows read, {len(partial)} segments"
+              + (f", {len(unparsed)} unparsed dates" if len(unparsed) else ''))
+    report_unparsed('Date', pd.concat(unparsed_dates), 'MM/DD/YYYY', "don't count as measured days")
 
-    result.rename(columns={
-        'Date count': 'Number of Days Measured',
-        'Date max': 'Last Day of Count'
-    }, inplace=True)
+    result = combine_partial_aggregates(partials)
+    result.rename(columns={'Date count': 'Number of Days Measured', 'Date max': 'Last Day of Count'}, inplace=True)
+    result.rename(columns={hour: f'{hour} sum' for hour in hour_columns}, inplace=True)
 
-    result.to_csv('../aggregated_traffic_volume_counts.csv', index=False)
+    table = pa.Table.from_pandas(result, preserve_index=False).cast(output_schema)
+    pq.write_table(table, output_file)
+    return result
 
-    print("\nTraffic Aggregation Data:")
-    print(result.info())
+def main(input_file='../Traffic_Volume_Counts.csv', output_file='../aggregated_traffic_volume_counts.parquet'):
+    try:
+        result = preprocess_traffic_counts(input_file, output_file)
 
-except Exception as e:
-    print("An error occurred:", e)
+        print("\nTraffic Aggregation Data:")
+        print(result.info())
 
+    except Exception as e:
+        print("An error occurred:", e)
 
+if __name__ == "__main__":
+    main()
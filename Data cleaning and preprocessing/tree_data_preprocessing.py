@@ -1,26 +1,44 @@
 import geopandas as gpd
-import pandas as pd  # Ensure pandas is imported
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-try:
+# Trees are stored in the projected CRS the analysis scripts work in (NY State Plane Long Island, in feet)
+OUTPUT_CRS = 'EPSG:2263'
+
+# Plain coordinate and diameter columns, so loading needs no geometry parsing
+output_schema = pa.schema(
+    [('x', pa.float64()), ('y', pa.float64()), ('Tree Diameter at Breast Height (cm)', pa.float32())],
+    metadata={'crs': OUTPUT_CRS}
+)
+
+def preprocess_trees(input_file, output_file):
     # Load the GeoJSON file into a GeoDataFrame
-    trees = gpd.read_file('../Tree Data.geojson')
+    trees = gpd.read_file(input_file)
 
     # Ensure that 'tree_dbh' is a numeric field and filter rows where 'tree_dbh' is not available
     trees['tree_dbh'] = pd.to_numeric(trees['tree_dbh'], errors='coerce')
     trees.dropna(subset=['tree_dbh', 'geometry'], inplace=True)
 
-    # Extracting latitude and longitude if not directly available as columns
-    if 'latitude' not in trees.columns or 'longitude' not in trees.columns:
-        trees['latitude'] = trees.geometry.y
-        trees['longitude'] = trees.geometry.x
+    # Project once here and keep only the coordinates; latitude and longitude columns would duplicate them
+    points = trees.geometry.to_crs(OUTPUT_CRS)
+    table = pa.table(
+        [points.x.to_numpy(), points.y.to_numpy(), trees['tree_dbh'].to_numpy(dtype='float32')],
+        schema=output_schema
+    )
+    pq.write_table(table, output_file)
+    return table
+
+def main(input_file='../Tree Data.geojson', output_file='../processed_tree_data.parquet'):
+    try:
+        table = preprocess_trees(input_file, output_file)
 
-    trees = trees[['latitude', 'longitude', 'tree_dbh', 'geometry']]
-    trees.rename(columns={'tree_dbh': 'Tree Diameter at Breast Height (cm)'}, inplace=True)
+        print("Tree Data Overview:")
+        print(f"{table.num_rows} trees written to {output_file}")
+        print(table.schema)
 
-    trees.to_file("../processed_tree_data.geojson", driver='GeoJSON')
+    except Exception as e:
+        print(f"An error occurred: {e}")
 
-    print("Tree Data Overview:")
-    print(trees.info())
-    
-except Exception as e:
-    print(f"An error occurred: {e}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from bike_network import PROJECTED_CRS
+from instrumentation import MemorySampler, current_rss, tracing
+
+# The preprocessing scripts live in their own folder and are imported from there
+PREPROCESSING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data cleaning and preprocessing')
+sys.path.insert(0, PREPROCESSING_DIR)
+
+# South-west corner of the synthetic street grid in EPSG:2263 feet, in lower Manhattan
+ORIGIN = (980_000, 160_000)
+
+# Manhattan-style block size in feet: short blocks between streets, long ones between avenues
+BLOCK_X, BLOCK_Y = 900, 260
+
+# Stage groups after the preprocessing, which always runs since every later stage reads its outputs;
+# ranking ranks the segment scores, so it runs the pipeline group too
+BENCHMARK_STAGES = ['spatial', 'safety', 'traffic', 'pipeline', 'ranking', 'routing']
+
+# Origin-destination pairs to route between
+N_ROUTES = 100
+
+def generate_bike_routes(n_paths, seed=0):
+    # A connected street grid of one-block segments in the raw NYC Bike Routes layout: streets run east-west between
+    # avenues and avenues north-south between streets. Endpoints sit exactly on the intersections, so segments share
+    # nodes for routing, and only the vertices in between get a little digitizing noise
+    rng = np.random.default_rng(seed)
+    n_streets = max(int(np.sqrt(n_paths / 2 * BLOCK_X / BLOCK_Y)), 2)
+    n_avenues = max(int(np.ceil(n_paths / 2 / n_streets)), 2)
+    avenue, street = np.meshgrid(np.arange(n_avenues), np.arange(n_streets))
+    avenue, street = avenue.ravel(), street.ravel()
+    along_street, along_avenue = avenue < n_avenues - 1, street < n_streets - 1
+    horizontal = np.repeat([True, False], [along_street.sum(), along_avenue.sum()])
+    avenue = np.concatenate([avenue[along_street], avenue[along_avenue]])
+    street = np.concatenate([street[along_street], street[along_avenue]])
+    n_paths = len(horizontal)
+
+    # Two to six vertices per segment
+    n_vertices = rng.integers(2, 7, n_paths)
+    offsets = np.repeat(np.cumsum(n_vertices) - n_vertices, n_vertices)
+    vertex = np.arange(n_vertices.sum()) - offsets
+    position = vertex / np.repeat(n_vertices - 1, n_vertices)
+    x = (np.repeat(avenue, n_vertices) + np.where(np.repeat(horizontal, n_vertices), position, 0)) * BLOCK_X + ORIGIN[0]
+    y = (np.repeat(street, n_vertices) + np.where(np.repeat(horizontal, n_vertices), 0, position)) * BLOCK_Y + ORIGIN[1]
+    interior = (vertex > 0) & (vertex < np.repeat(n_vertices - 1, n_vertices))
+    coords = np.column_stack([x, y]) + rng.normal(0, 2, (len(x), 2)) * interior[:, None]
+    lines = shapely.linestrings(coords, indices=np.repeat(np.arange(n_paths), n_vertices))
+
+    # Borough codes by position: Manhattan in the west, Brooklyn south-east and Queens north-east
+    east = avenue >= n_avenues // 3
+    boro = np.where(east, np.where(street < n_streets // 2, 3, 4), 1)
+
+    street_names = np.char.add(np.char.add('W ', street.astype(str)), ' St')
+    avenue_names = np.char.add(avenue.astype(str), ' Avenue')
+    end_avenue_names = np.char.add((avenue + 1).astype(str), ' Avenue')
+    end_street_names = np.char.add(np.char.add('W ', (street + 1).astype(str)), ' St')
+    bike_routes = gpd.GeoDataFrame({
+        'fromstreet': np.where(horizontal, avenue_names, street_names),
+        'tostreet': np.where(horizontal, end_avenue_names, end_street_names),
+        'street': np.where(horizontal, street_names, avenue_names),
+        'lanecount': rng.integers(1, 3, n_paths),
+        'facilitycl': rng.choice(['I', 'II', 'III'], n_paths),
+        'boro': boro,
+    }, geometry=lines, crs=PROJECTED_CRS)
+    return bike_routes.to_crs('EPSG:4326')
+
+def points_near_paths(bike_paths, n_points, spread, near_share, rng):
+    # Most points scattered around random spots on the paths, the rest uniform over the network's extent
+    lines = np.asarray(bike_paths.to_crs(PROJECTED_CRS).geometry.values)
+    n_near = int(n_points * near_share)
+    on_path = shapely.line_interpolate_point(lines[rng.integers(0, len(lines), n_near)], rng.random(n_near), normalized=True)
+    near = shapely.get_coordinates(on_path) + rng.normal(0, spread, (n_near, 2))
+    bounds = shapely.total_bounds(lines)
+    uniform = rng.uniform(bounds[:2], bounds[2:], (n_points - n_near, 2))
+    xy = np.concatenate([near, uniform])[rng.permutation(n_points)]
+    return gpd.GeoSeries(gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs=PROJECTED_CRS).to_crs('EPSG:4326')
+
+def generate_trees(bike_paths, n_trees, seed=0):
+    # Street trees with a skewed trunk diameter distribution, in the raw tree census layout
+    rng = np.random.default_rng(seed)
+    points = points_near_paths(bike_paths, n_trees, 60, 0.7, rng)
+    return gpd.GeoDataFrame({'tree_dbh': np.round(rng.gamma(2.0, 6.0, n_trees)).astype(int).astype(str)}, geometry=points)
+
+def generate_crashes(bike_paths, n_crashes, seed=0):
+    # Raw collision records as published: text dates and times, casualty counts, some missing coordinates
+    rng = np.random.default_rng(seed)
+    points = points_near_paths(bike_paths, n_crashes, 40, 0.8, rng)
+    timestamps = pd.Timestamp('2013-01-01') + pd.to_timedelta(rng.integers(0, 11 * 365 * 24 * 60, n_crashes), unit='min')
+    crashes = pd.DataFrame({
+        'CRASH DATE': timestamps.strftime('%m/%d/%Y'),
+        'CRASH TIME': [f'{hour}:{minute:02d}' for hour, minute in zip(timestamps.hour, timestamps.minute)],
+        'BOROUGH': rng.choice(['MANHATTAN', 'BROOKLYN', 'QUEENS'], n_crashes),
+        'LATITUDE': points.y.to_numpy(),
+        'LONGITUDE': points.x.to_numpy(),
+    })
+    missing = rng.random(n_crashes) < 0.05
+    crashes.loc[missing, ['LATITUDE', 'LONGITUDE']] = np.nan
+
+    for col, rate in [('INJURED', 0.3), ('KILLED', 0.002)]:
+        for who, share in [('PERSONS', 1.0), ('PEDESTRIANS', 0.3), ('CYCLIST', 0.1)]:
+            crashes[f'NUMBER OF {who} {col}'] = rng.poisson(rate * share, n_crashes)
+    return crashes
+
+def generate_traffic_counts(bike_paths, n_rows, hour_columns, seed=0):
+    # Raw hourly counts on a subset of the path segments, with the street names spelled out differently
+    rng = np.random.default_rng(seed)
+    segments = bike_paths.iloc[rng.integers(0, len(bike_paths), max(n_rows // 20, 1))]
+    rows = rng.integers(0, len(segments), n_rows)
+    dates = pd.Timestamp('2012-01-01') + pd.to_timedelta(rng.integers(0, 10 * 365, n_rows), unit='D')
+    spelled_out = segments['street'].str.upper().str.replace('^W ', 'WEST ', regex=True).str.replace(' ST$', ' STREET', regex=True)
+    traffic_counts = pd.DataFrame({
+        'ID': np.arange(n_rows),
+        'SegmentID': rows,
+        'Roadway Name': spelled_out.to_numpy()[rows],
+        'From': segments['fromstreet'].str.upper().to_numpy()[rows],
+        'To': segments['tostreet'].str.upper().to_numpy()[rows],
+        'Direction': rng.choice(['NB', 'SB', 'EB', 'WB'], n_rows),
+        'Date': dates.strftime('%m/%d/%Y'),
+    })
+    for hour in hour_columns:
+        traffic_counts[hour] = rng.poisson(300, n_rows)
+    return traffic_counts
+
+def generate_inputs(n_points, workdir, seed=0):
+    # Raw and processed inputs under the file names the pipelines expect
+    from traffic_volume_preprocessing import hour_columns
+
+    bike_paths = generate_bike_routes(int(np.clip(n_points // 50, 500, 100_000)), seed)
+    n_paths = len(bike_paths)
+    print(f"Generating {n_paths} bike paths and {n_points} trees and crashes...")
+    bike_paths.to_file(os.path.join(workdir, 'NYC Bike Routes.geojson'), driver='GeoJSON')
+    generate_trees(bike_paths, n_points, seed + 1).to_file(os.path.join(workdir, 'Tree Data.geojson'), driver='GeoJSON')
+    generate_crashes(bike_paths, n_points, seed + 2).to_csv(os.path.join(workdir, 'Motor_Vehicle_Collisions.csv'), index=False)
+    generate_traffic_counts(bike_paths, max(n_points // 10, 1000), hour_columns, seed + 3).to_csv(
+        os.path.join(workdir, 'Traffic_Volume_Counts.csv'), index=False
+    )
+    return n_paths
+
+@contextmanager
+def measure(results, name):
+    # Wall time and peak RSS of one stage, plus how far the stage raised memory above its starting point
+    start_rss = current_rss()
+    usage = {'peak_rss': start_rss}
+    sampler = MemorySampler([usage])
+    sampler.start()
+    record = {'stage': name}
+    start = time.perf_counter()
+    yield record
+    record['seconds'] = round(time.perf_counter() - start, 4)
+    sampler.stop()
+    peak_rss = max(usage['peak_rss'], current_rss())
+    record['peak_rss_mb'] = round(peak_rss / 1024 ** 2, 1)
+    record['rss_growth_mb'] = round((peak_rss - start_rss) / 1024 ** 2, 1)
+    results.append(record)
+    print(f"  {name}: {record['seconds']:.2f}s, peak RSS {record['peak_rss_mb']} MB (+{record['rss_growth_mb']} MB)")
+
+def benchmark_preprocessing(workdir, results):
+    from bike_routes_preprocessing import preprocess_bike_routes
+    from collisions_preprocessing import preprocess_collisions
+    from traffic_volume_preprocessing import preprocess_traffic_counts
+    from tree_data_preprocessing import preprocess_trees
+
+    with measure(results, 'preprocess.bike_routes') as record:
+        record['rows'] = len(preprocess_bike_routes(
+            os.path.join(workdir, 'NYC Bike Routes.geojson'), os.path.join(workdir, 'processed_bike_paths.geojson')
+        ))
+    with measure(results, 'preprocess.collisions') as record:
+        record['rows'] = preprocess_collisions(
+            os.path.join(workdir, 'Motor_Vehicle_Collisions.csv'), os.path.join(workdir, 'cleaned_motor_vehicle_collisions.parquet')
+        )
+    with measure(results, 'preprocess.traffic') as record:
+        record['rows'] = len(preprocess_traffic_counts(
+            os.path.join(workdir, 'Traffic_Volume_Counts.csv'), os.path.join(workdir, 'aggregated_traffic_volume_counts.parquet')
+        ))
+    with measure(results, 'preprocess.trees') as record:
+        record['rows'] = preprocess_trees(os.path.join(workdir, 'Tree Data.geojson'), os.path.join(workdir, 'processed_tree_data.parquet')).num_rows
+
+def benchmark_spatial(workdir, results, n_clusters, output_dir):
+    from bike_network import prepare_bike_paths
+    from scoring_engine import aggregate_by_path, pair_points_with_paths
+    from spatial_analysis import canopy_scores, output_cluster_info, prepare_tree_points
+
+    with measure(results, 'spatial.combine') as record:
+        bike_paths = prepare_bike_paths(os.path.join(workdir, 'processed_bike_paths.geojson'), n_clusters=n_clusters)
+        record['rows'] = len(bike_paths)
+    with measure(results, 'spatial.tree_points') as record:
+        trees = prepare_tree_points(os.path.join(workdir, 'processed_tree_data.parquet'))
+        record['rows'] = len(trees)
+    with measure(results, 'spatial.tree_pairs') as record:
+        tree_pairs = pair_points_with_paths(bike_paths, trees, 100)
+        record['rows'] = len(tree_pairs)
+    with measure(results, 'spatial.scores'):
+        bike_paths['tree_density'] = aggregate_by_path(tree_pairs['point_idx'].to_numpy(), tree_pairs['path_idx'].to_numpy(), len(bike_paths))
+        bike_paths['canopy_score'] = canopy_scores(tree_pairs, trees, len(bike_paths))
+    with measure(results, 'spatial.output'):
+        output_cluster_info(bike_paths.to_crs(epsg=4326), 'tree_density', output_dir)
+    return bike_paths
+
+def benchmark_safety(workdir, results, bike_paths, output_dir):
+    from safety_analysis import (
+        calculate_safety_scores, get_safe_and_unsafe_clusters, normalize_scores, output_cluster_info, prepare_crash_points
+    )
+    from scoring_engine import aggregate_by_path, pair_points_with_paths
+
+    with measure(results, 'safety.crash_points') as record:
+        crashes = calculate_safety_scores(prepare_crash_points(os.path.join(workdir, 'cleaned_motor_vehicle_collisions.parquet')))
+        record['rows'] = len(crashes)
+    with measure(results, 'safety.crash_pairs') as record:
+        crash_pairs = pair_points_with_paths(bike_paths, crashes, 50)
+        record['rows'] = len(crash_pairs)
+    with measure(results, 'safety.scores'):
+        bike_paths['safety_score'] = aggregate_by_path(
+            crash_pairs['point_idx'].to_numpy(), crash_pairs['path_idx'].to_numpy(), len(bike_paths), crashes['safety_score'].to_numpy()
+        )
+        normalize_scores(bike_paths)
+    with measure(results, 'safety.output'):
+        safest_clusters, least_safe_clusters = get_safe_and_unsafe_clusters(bike_paths.to_crs('EPSG:4326'))
+        output_cluster_info(safest_clusters, os.path.join(output_dir, 'most_safe_clusters.geojson'))
+        output_cluster_info(least_safe_clusters, os.path.join(output_dir, 'least_safe_clusters.geojson'))
+
+def benchmark_traffic(workdir, results):
+    from traffic_analysis import load_collision_data, load_traffic_data, process_collision_data, process_traffic_data
+
+    with measure(results, 'traffic.volume') as record:
+        traffic_data = load_traffic_data(os.path.join(workdir, 'aggregated_traffic_volume_counts.parquet'))
+        process_traffic_data(traffic_data)
+        record['rows'] = len(traffic_data)
+    with measure(results, 'traffic.collisions') as record:
+        collision_data = load_collision_data(os.path.join(workdir, 'cleaned_motor_vehicle_collisions.parquet'))
+        process_collision_data(collision_data)
+        record['rows'] = len(collision_data)
+
+def benchmark_pipeline(workdir, results, output_dir):
+    # Per-segment scoring with traffic exposure, as run by pipeline.main --segments --roll-up Borough
+    from bike_network import prepare_segments
+    from pipeline import output_scored_network
+    from safety_analysis import calculate_safety_scores, prepare_crash_points
+    from segment_scoring import pair_segment_points, roll_up, score_segments
+    from spatial_analysis import prepare_tree_points
+
+    with measure(results, 'pipeline.segments') as record:
+        segments = prepare_segments(os.path.join(workdir, 'processed_bike_paths.geojson'),
+                                    os.path.join(workdir, 'aggregated_traffic_volume_counts.parquet'))
+        record['rows'] = len(segments)
+    with measure(results, 'pipeline.points') as record:
+        trees = prepare_tree_points(os.path.join(workdir, 'processed_tree_data.parquet'))
+        crashes = calculate_safety_scores(prepare_crash_points(os.path.join(workdir, 'cleaned_motor_vehicle_collisions.parquet')))
+        record['rows'] = len(trees) + len(crashes)
+    with measure(results, 'pipeline.segment_pairs') as record:
+        point_pairs = pair_segment_points(segments, trees, crashes, 100, 50)
+        record['rows'] = sum(len(pairs) for pairs in point_pairs.values())
+    with measure(results, 'pipeline.scores'):
+        scored_segments = score_segments(segments, trees, crashes, point_pairs).to_crs('EPSG:4326')
+    with measure(results, 'pipeline.output'):
+        output_scored_network(scored_segments, os.path.join(output_dir, 'scored_bike_paths.parquet'))
+    with measure(results, 'pipeline.roll_up') as record:
+        by_borough = roll_up(scored_segments, 'Borough')
+        output_scored_network(by_borough, os.path.join(output_dir, 'scored_by_borough.parquet'))
+        record['rows'] = len(by_borough)
+    return scored_segments
+
+def benchmark_ranking(results, scored_segments, output_dir):
+    # Top k, percentile bands and the top k per borough, as run by ranking.main --bands --group-by Borough
+    from ranking import BAND_QUANTILES, rank_network
+
+    with measure(results, 'ranking.green') as record:
+        outputs = rank_network(scored_segments, 'tree_density', output_dir, 'green', quantiles=BAND_QUANTILES, group_column='Borough')
+        record['rows'] = sum(len(frame) for frame in outputs.values())
+    with measure(results, 'ranking.safe') as record:
+        outputs = rank_network(scored_segments, 'safety_score', output_dir, 'safe', quantiles=BAND_QUANTILES, group_column='Borough',
+                               higher_is_better=False)
+        record['rows'] = sum(len(frame) for frame in outputs.values())
+
+def benchmark_routing(workdir, results, output_dir, seed=0, n_routes=N_ROUTES):
+    # Building the scored route graph, single routes and a cost matrix between random intersections
+    from routing import output_route, prepare_route_graph, route_cost_matrix, shortest_route
+
+    with measure(results, 'routing.graph') as record:
+        graph = prepare_route_graph(os.path.join(workdir, 'processed_bike_paths.geojson'), os.path.join(workdir, 'processed_tree_data.parquet'),
+                                    os.path.join(workdir, 'cleaned_motor_vehicle_collisions.parquet'))
+        record['rows'] = len(graph.edge_u)
+    pairs = np.random.default_rng(seed).integers(0, len(graph.node_xy), (n_routes, 2))
+    with measure(results, 'routing.routes') as record:
+        routes = [shortest_route(graph, origin, destination) for origin, destination in pairs]
+        record['rows'] = sum(route is not None for route in routes)
+    with measure(results, 'routing.cost_matrix') as record:
+        costs = route_cost_matrix(graph, pairs[:, 0], pairs[:, 1])
+        record['rows'] = int(np.isfinite(costs).sum())
+    with measure(results, 'routing.output'):
+        for i, route in enumerate(route for route in routes[:10] if route is not None):
+            output_route(graph, route, os.path.join(output_dir, f'route_{i}.geojson'))
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(n_points, workdir, seed=0, stages=BENCHMARK_STAGES, n_clusters=200):
+    output_dir = os.path.join(workdir, 'outputs')
+    os.makedirs(output_dir, exist_ok=True)
+    n_paths = generate_inputs(n_points, workdir, seed)
+
+    results = []
+    print("Running benchmark stages...")
+    benchmark_preprocessing(workdir, results)
+    if 'spatial' in stages or 'safety' in stages:
+        bike_paths = benchmark_spatial(workdir, results, n_clusters, output_dir)
+        if 'safety' in stages:
+            benchmark_safety(workdir, results, bike_paths, output_dir)
+    if 'traffic' in stages:
+        benchmark_traffic(workdir, results)
+    if 'pipeline' in stages or 'ranking' in stages:
+        scored_segments = benchmark_pipeline(workdir, results, output_dir)
+        if 'ranking' in stages:
+            benchmark_ranking(results, scored_segments, output_dir)
+    if 'routing' in stages:
+        benchmark_routing(workdir, results, output_dir, seed)
+
+    return {
+        'commit': git_commit(),
+        'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'seed': seed,
+        'n_points': n_points,
+        'n_paths': n_paths,
+        'stages': results,
+    }
+
+def compare_results(baseline, current):
+    # Per-stage time and memory ratios against an earlier run at the same scale
+    baseline_stages = {stage['stage']: stage for stage in baseline['stages']}
+    print(f"Compared with {baseline.get('commit')} at {baseline['n_points']} points:")
+    for stage in current['stages']:
+        before = baseline_stages.get(stage['stage'])
+        if before:
+            print(f"  {stage['stage']}: {stage['seconds'] / max(before['seconds'], 1e-9):.2f}x time, "
+                  f"{stage['peak_rss_mb'] - before['peak_rss_mb']:+.1f} MB peak RSS")
+
+def main(n_points=10_000, workdir='benchmark_data', output_file='benchmark_results.json', seed=0, stages=BENCHMARK_STAGES, baseline_file=None):
+    try:
+        result = run_benchmark(n_points, workdir, seed, stages)
+        with open(output_file, 'w') as file:
+            json.dump(result, file, indent=2)
+        print(f"Wrote benchmark results to {output_file}")
+
+        if baseline_file:
+            with open(baseline_file) as file:
+                compare_results(json.load(file), result)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on deterministic synthetic NYC-scale data.")
+    parser.add_argument('--points', type=int, default=10_000, help="Number of trees and of crashes to generate (default: 10000)")
+    parser.add_argument('--workdir', default='benchmark_data', help="Directory for the generated inputs and outputs")
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON file to write the results to")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic data generators (default: 0)")
+    parser.add_argument('--stages', nargs='+', choices=BENCHMARK_STAGES, default=BENCHMARK_STAGES, help="Stage groups to run after the preprocessing")
+    parser.add_argument('--compare', metavar='JSON', help="Earlier results to compare against")
+    parser.add_argument('--trace', metavar='FILE', help="Also trace every instrumented function inside the stages (.json for Chrome trace format)")
+    parser.add_argument('--profile', metavar='FILE', help="Also run under cProfile and write the stats to FILE (.prof)")
+    args = parser.parse_args()
+    with tracing(args.trace, args.profile):
+        main(args.points, args.workdir, args.output, args.seed, args.stages, args.compare)
@@ -0,0 +1,217 @@
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import geopandas as gpd
+import pandas as pd
+import shapely
+import numpy as np
+from pyproj import Transformer
+from instrumentation import instrumented
+
+# Projected CRS used for all distance work (NY State Plane Long Island, in feet)
+PROJECTED_CRS = 'EPSG:2263'
+
+# Longitude/latitude box around the five boroughs; points outside it, including (0, 0), are bad geocodes
+NYC_BOUNDS = (-74.27, 40.48, -73.68, 40.93)
+
+CLUSTERING_METHODS = ['kmeans', 'minibatch', 'grid']
+
+@lru_cache(maxsize=None)
+def lonlat_transformer(crs=PROJECTED_CRS):
+    # Built once per process and CRS; creating a pyproj Transformer is far more expensive than using one
+    return Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+
+def ensure_projected(gdf):
+    # Reproject only when needed; to_crs copies and transforms every coordinate even when the CRS already matches
+    return gdf if gdf.crs == PROJECTED_CRS else gdf.to_crs(PROJECTED_CRS)
+
+def in_nyc_bounds(lon, lat):
+    # Vectorized bounding box check; NaN coordinates fail every comparison and are dropped too
+    min_lon, min_lat, max_lon, max_lat = NYC_BOUNDS
+    return (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+
+@instrumented
+def load_bike_paths(bike_path_file):
+    # Load the processed bike paths GeoJSON file
+    return gpd.read_file(bike_path_file)
+
+def path_centroids(bike_paths):
+    # Vectorized segment centroids in the projected CRS, so distances are in feet rather than degrees
+    geometry = bike_paths.geometry if bike_paths.crs == PROJECTED_CRS else bike_paths.geometry.to_crs(PROJECTED_CRS)
+    return geometry, shapely.get_coordinates(shapely.centroid(np.asarray(geometry.values)))
+
+def morton_codes(xy, bits=16):
+    # Interleave the bits of the quantized x and y coordinates (Z-order curve)
+    span = np.maximum(xy.max(axis=0) - xy.min(axis=0), 1e-9)
+    cells = ((xy - xy.min(axis=0)) / span * (2 ** bits - 1)).astype(np.uint64)
+
+    codes = np.zeros(len(xy), dtype=np.uint64)
+    for bit in range(bits):
+        codes |= ((cells[:, 0] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+        codes |= ((cells[:, 1] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + 1)
+    return codes
+
+def grid_partition(centroids, lengths, n_clusters, bits=16):
+    # Split the area into quadtree cells, the cell with the most path length first, until there are n_clusters
+    # cells or none can split without going over. A cluster is one cell, so it is spatially contiguous (a run of
+    # the Z-order curve spanning several cells need not be); path length is only roughly balanced between them
+    codes = morton_codes(centroids, bits)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    cumulative_lengths = np.concatenate(([0.0], np.cumsum(lengths[order])))
+
+    # A cell at some depth is the run of sorted codes sharing their top 2 * depth bits
+    cells, heap, n_cells = [], [(-cumulative_lengths[-1], 0, len(codes), 0)], 1
+    while heap:
+        if n_cells == n_clusters:
+            cells.extend((start, end) for _, start, end, _ in heap)
+            break
+        _, start, end, depth = heapq.heappop(heap)
+        children = []
+        if end - start > 1 and depth < bits:
+            quadrants = (codes[start:end] >> np.uint64(2 * (bits - depth - 1))) & np.uint64(3)
+            bounds = start + np.searchsorted(quadrants, np.arange(5, dtype=np.uint64))
+            children = [(int(low), int(high)) for low, high in zip(bounds[:-1], bounds[1:]) if high > low]
+        if children and n_cells + len(children) - 1 <= n_clusters:
+            n_cells += len(children) - 1
+            for low, high in children:
+                heapq.heappush(heap, (-(cumulative_lengths[high] - cumulative_lengths[low]), low, high, depth + 1))
+        else:
+            cells.append((start, end))
+
+    # Numbered in Z order, so the labels are stable for the same paths
+    cells.sort()
+    counts = np.array([end - start for start, end in cells])
+    labels = np.empty(len(centroids), dtype=np.int64)
+    labels[order] = np.repeat(np.arange(len(cells)), counts)
+
+    # Centers are the mean centroid of each cell, used for reporting and warm starts of the KMeans backends
+    centers = np.column_stack([np.bincount(labels, weights=centroids[:, axis], minlength=len(cells)) for axis in range(2)])
+    return labels, centers / counts[:, None]
+
+@instrumented
+def cluster_bike_paths(bike_paths, n_clusters=50, method='kmeans', init_centers=None):
+    # Extract projected centroids for clustering
+    geometry, centroids = path_centroids(bike_paths)
+
+    if init_centers is not None and np.shape(init_centers) != (n_clusters, 2):
+        raise ValueError(f"Expected {n_clusters} initial centers, got {np.shape(init_centers)[0]}")
+
+    if method == 'grid':
+        # Quadtree cells split by path length; deterministic, so labels are stable without warm starts
+        labels, centers = grid_partition(centroids, geometry.length.to_numpy(), n_clusters)
+    else:
+        # Warm-starting from the previous run's centers converges in a few iterations and keeps labels stable
+        from sklearn.cluster import KMeans, MiniBatchKMeans
+
+        init = 'k-means++' if init_centers is None else np.asarray(init_centers)
+        if method == 'kmeans':
+            model = KMeans(n_clusters=n_clusters, init=init, n_init='auto', random_state=0)
+        elif method == 'minibatch':
+            model = MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init='auto', batch_size=4096, random_state=0)
+        else:
+            raise ValueError(f"Unknown clustering method {method!r}, expected one of {CLUSTERING_METHODS}")
+        model.fit(centroids)
+        labels, centers = model.labels_, model.cluster_centers_
+
+    bike_paths['cluster'] = labels
+    bike_paths.attrs['cluster_centers'] = centers
+    
+    return bike_paths
+
+def save_cluster_centers(centers, centers_file):
+    # Keep the cluster centers so the next run can warm-start from them; centers of empty clusters can't seed one
+    centers = np.asarray(centers, dtype=float)
+    np.save(centers_file, centers[np.isfinite(centers).all(axis=1)])
+
+def load_cluster_centers(centers_file):
+    if not centers_file or not os.path.exists(centers_file):
+        return None
+    centers = np.load(centers_file)
+    return centers[np.isfinite(centers).all(axis=1)]
+
+def union_cluster_geometries(geometries):
+    # Union the segments of one cluster, flattening collections down to their linear parts
+    combined_cluster_path = shapely.union_all(geometries)
+    parts = shapely.get_parts(shapely.get_parts(combined_cluster_path))
+    lines = parts[shapely.get_type_id(parts) == shapely.GeometryType.LINESTRING]
+
+    if len(lines) == 0:
+        print(f"Unhandled geometry type: {combined_cluster_path.geom_type}")
+        return None
+    return lines[0] if len(lines) == 1 else shapely.multilinestrings(lines)
+
+@instrumented
+def combine_bike_paths(bike_paths, n_jobs=None, sum_columns=()):
+    # Partition the segments by cluster with a single sort instead of one mask per cluster
+    labels = bike_paths['cluster'].to_numpy()
+    order = np.argsort(labels, kind='stable')
+    clusters, starts = np.unique(labels[order], return_index=True)
+    groups = np.split(np.asarray(bike_paths.geometry.values)[order], starts[1:])
+
+    # Union the clusters in parallel; a pool only pays off with more than one worker and cluster
+    n_jobs = n_jobs or os.cpu_count()
+    if n_jobs > 1 and len(groups) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            combined_geometries = list(executor.map(union_cluster_geometries, groups, chunksize=max(1, len(groups) // (4 * n_jobs))))
+    else:
+        combined_geometries = [union_cluster_geometries(group) for group in groups]
+
+    combined_bike_paths = gpd.GeoDataFrame({'cluster': clusters}, geometry=combined_geometries, crs=bike_paths.crs)
+
+    # Per-segment quantities such as traffic exposure roll up to their cluster as sums
+    cluster_rows = np.searchsorted(clusters, labels)
+    for col in sum_columns:
+        combined_bike_paths[col] = np.bincount(cluster_rows, weights=bike_paths[col].to_numpy(), minlength=len(clusters))
+
+    # A cluster takes the borough most of its segments are in
+    if 'Borough' in bike_paths.columns:
+        counts = pd.crosstab(cluster_rows, bike_paths['Borough'].to_numpy())
+        combined_bike_paths['Borough'] = counts.idxmax(axis=1).reindex(range(len(clusters))).to_numpy()
+    combined_bike_paths = combined_bike_paths[combined_bike_paths.geometry.notna()].reset_index(drop=True)
+
+    print(f"Number of combined bike path segments: {len(combined_bike_paths)}")
+    
+    return combined_bike_paths
+
+@instrumented
+def project_bike_paths(bike_paths):
+    # Ensure bike paths are in a projected CRS suitable for distance queries
+    print("Reprojecting bike paths to a projected CRS for spatial operations...")
+    return bike_paths.to_crs(PROJECTED_CRS)
+
+@instrumented
+def prepare_segments(bike_path_file, traffic_file=None):
+    # Load the bike path segments as they are, projected and numbered, without clustering or combining them
+    segments = load_bike_paths(bike_path_file)
+    if traffic_file:
+        from traffic_exposure import path_vehicle_exposure
+        segments['vehicle_exposure'] = path_vehicle_exposure(segments, traffic_file)
+
+    segments = project_bike_paths(segments[segments.geometry.notna()].reset_index(drop=True))
+    segments.insert(0, 'segment_id', np.arange(len(segments)))
+    segments['length_ft'] = segments.geometry.length
+    return segments
+
+@instrumented
+def prepare_bike_paths(bike_path_file, n_clusters, method='kmeans', warm_start_file=None, traffic_file=None):
+    # Load, cluster and combine the bike paths, projected for distance queries
+    bike_paths = load_bike_paths(bike_path_file)
+    sum_columns = []
+    if traffic_file:
+        # Imported here since the street matching is only needed when traffic counts are joined
+        from traffic_exposure import path_vehicle_exposure
+        bike_paths['vehicle_exposure'] = path_vehicle_exposure(bike_paths, traffic_file)
+        sum_columns.append('vehicle_exposure')
+
+    init_centers = load_cluster_centers(warm_start_file)
+    if init_centers is not None and len(init_centers) != n_clusters:
+        print(f"Ignoring {warm_start_file}: it holds {len(init_centers)} centers, not {n_clusters}")
+        init_centers = None
+
+    bike_paths = cluster_bike_paths(bike_paths, n_clusters=n_clusters, method=method, init_centers=init_centers)
+    if warm_start_file:
+        save_cluster_centers(bike_paths.attrs['cluster_centers'], warm_start_file)
+
+    return project_bike_paths(combine_bike_paths(bike_paths, sum_columns=sum_columns))
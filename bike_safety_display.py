@@ -1,3 +1,4 @@
+import os
 import geopandas as gpd
 import folium
 
@@ -28,6 +29,16 @@ folium.GeoJson(
     name='Least Safe Clusters'
 ).add_to(m)
 
+# Add a citywide heatmap from the grid index, if one has been built
+from grid_index import GRID_FILE
+if os.path.exists(GRID_FILE):
+    from folium.plugins import HeatMap
+    from grid_index import heatmap_points, load_grid_index
+    from safety_analysis import safety_by_cell
+
+    cells = safety_by_cell(load_grid_index(GRID_FILE), level=1)
+    HeatMap(heatmap_points(cells, 'safety_per_1000ft'), name='Crash Severity Heatmap', radius=12).add_to(m)
+
 # Add layer control
 folium.LayerControl().add_to(m)
 
@@ -0,0 +1,55 @@
+import os
+import geopandas as gpd
+import pandas as pd
+import pyarrow.parquet as pq
+
+def is_columnar(file_path):
+    # Parquet outputs are either a single file or a partitioned dataset directory
+    return os.path.isdir(file_path) or file_path.endswith('.parquet')
+
+def read_collisions(file_path, columns=None, since=None):
+    # Load cleaned collisions from the partitioned Parquet dataset or a legacy CSV
+    if is_columnar(file_path):
+        filters = None
+        if since is not None:
+            since = pd.Timestamp(since)
+            # The year filter prunes whole partitions before any row is read
+            filters = [('CRASH YEAR', '>=', since.year), ('CRASH DATETIME', '>', since)]
+        collisions = pd.read_parquet(file_path, columns=columns, filters=filters)
+        return collisions.drop(columns='CRASH YEAR', errors='ignore')
+
+    collisions = pd.read_csv(file_path, usecols=columns)
+    for col in ['CRASH DATE', 'CRASH DATETIME']:
+        if col in collisions.columns:
+            collisions[col] = pd.to_datetime(collisions[col])
+    if since is not None:
+        collisions = collisions[collisions['CRASH DATETIME'] > pd.Timestamp(since)]
+    return collisions
+
+def count_collisions(file_path):
+    # Number of cleaned collision records; for Parquet from the file footers, without reading any rows
+    if is_columnar(file_path):
+        import pyarrow.dataset as ds
+        return ds.dataset(file_path, format='parquet', partitioning='hive').count_rows()
+    return len(pd.read_csv(file_path, usecols=[0]))
+
+def read_traffic_counts(file_path, columns=None):
+    # Load aggregated traffic counts from the typed Parquet output or a legacy CSV
+    if is_columnar(file_path):
+        return pd.read_parquet(file_path, columns=columns)
+
+    traffic_counts = pd.read_csv(file_path, usecols=columns)
+    if 'Last Day of Count' in traffic_counts.columns:
+        traffic_counts['Last Day of Count'] = pd.to_datetime(traffic_counts['Last Day of Count'], format='%Y-%m-%d')
+    return traffic_counts
+
+def read_trees(file_path):
+    # Load processed trees from the coordinate Parquet file or a legacy GeoJSON
+    if not is_columnar(file_path):
+        return gpd.read_file(file_path)
+
+    table = pq.read_table(file_path)
+    crs = table.schema.metadata[b'crs'].decode()
+    trees = table.drop(['x', 'y']).to_pandas()
+    geometry = gpd.points_from_xy(table['x'].to_numpy(), table['y'].to_numpy(), crs=crs)
+    return gpd.GeoDataFrame(trees, geometry=geometry)
@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import numpy as np
+import shapely
+from bike_network import ensure_projected, load_bike_paths
+from instrumentation import instrumented
+
+DENSITY_FILE = './Bike Lane groupings/crash_density.npy'
+
+# Raster cell size and Gaussian bandwidth in feet; a crash at the bandwidth distance counts about 0.61 of its score
+CELL_SIZE = 25
+BANDWIDTH = 50
+
+# The kernel is cut off at this many bandwidths, where its weight is below 0.0004
+KERNEL_RADIUS = 4
+
+class CrashDensity:
+    # Smoothed crash safety score on a regular raster of cell centers; values may be a read-only memory map
+    def __init__(self, origin, cell_size, bandwidth, values, n_crashes=0, total_score=0.0):
+        self.origin = np.asarray(origin, dtype=float)
+        self.cell_size = float(cell_size)
+        self.bandwidth = float(bandwidth)
+        self.values = values
+        self.n_crashes = int(n_crashes)
+        self.total_score = float(total_score)
+
+    def sample(self, x, y):
+        # Bilinear lookup between the four surrounding cell centers, a constant amount of work per point
+        corners = bilinear_corners(x, y, self.origin, self.cell_size, self.values.shape)
+        return sum(weight * self.values[row, col] for row, col, weight in corners)
+
+    def path_scores(self, bike_paths):
+        # Length-weighted mean of the surface along each path, sampled at least once per cell.
+        # A mean rather than a total, so short segments near one crash don't outscore long ones along many
+        lines = np.asarray(ensure_projected(bike_paths).geometry.values)
+        coords, line_idx = shapely.get_coordinates(shapely.segmentize(lines, self.cell_size), return_index=True)
+        same_line = line_idx[1:] == line_idx[:-1]
+        start, end, path_idx = coords[:-1][same_line], coords[1:][same_line], line_idx[1:][same_line]
+        midpoints = (start + end) / 2
+        lengths = np.hypot(*(end - start).T)
+
+        weighted = np.bincount(path_idx, weights=self.sample(midpoints[:, 0], midpoints[:, 1]) * lengths, minlength=len(lines))
+        total_length = np.bincount(path_idx, weights=lengths, minlength=len(lines))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(total_length > 0, weighted / total_length, 0.0)
+
+    def matches(self, cell_size, bandwidth, crashes):
+        # Whether this surface was built with the same settings from the same crashes
+        return (self.cell_size == cell_size and self.bandwidth == bandwidth and self.n_crashes == len(crashes)
+                and np.isclose(self.total_score, crashes['safety_score'].sum()))
+
+def bilinear_corners(x, y, origin, cell_size, shape):
+    # Rows, columns and bilinear weights of the four cell centers around each point; points off the raster clamp to its edge
+    n_rows, n_cols = shape
+    fx = np.clip((np.asarray(x, dtype=float) - origin[0]) / cell_size - 0.5, 0, n_cols - 1)
+    fy = np.clip((np.asarray(y, dtype=float) - origin[1]) / cell_size - 0.5, 0, n_rows - 1)
+    col, row = np.minimum(fx.astype(np.int64), max(n_cols - 2, 0)), np.minimum(fy.astype(np.int64), max(n_rows - 2, 0))
+    tx, ty = fx - col, fy - row
+    col1, row1 = np.minimum(col + 1, n_cols - 1), np.minimum(row + 1, n_rows - 1)
+    return [(row, col, (1 - tx) * (1 - ty)), (row, col1, tx * (1 - ty)), (row1, col, (1 - tx) * ty), (row1, col1, tx * ty)]
+
+def gaussian_kernel(cell_size, bandwidth):
+    # Gaussian weights on the raster cells, 1 at the center so the surface reads as a soft crash buffer
+    radius = int(np.ceil(KERNEL_RADIUS * bandwidth / cell_size))
+    offsets = np.arange(-radius, radius + 1) * cell_size
+    return np.exp(-(offsets[:, None] ** 2 + offsets[None, :] ** 2) / (2 * bandwidth ** 2)).astype(np.float32)
+
+@instrumented
+def build_crash_density(crashes, cell_size=CELL_SIZE, bandwidth=BANDWIDTH, bounds=None):
+    # Spread the crash scores onto the cell centers, then convolve with the kernel by FFT overlap-add instead of a sum per crash
+    from scipy.signal import oaconvolve
+
+    crashes = ensure_projected(crashes)
+    if bounds is None:
+        padding = KERNEL_RADIUS * bandwidth
+        minx, miny, maxx, maxy = crashes.total_bounds
+        bounds = (minx - padding, miny - padding, maxx + padding, maxy + padding)
+    shape = (max(int(np.ceil((bounds[3] - bounds[1]) / cell_size)), 2), max(int(np.ceil((bounds[2] - bounds[0]) / cell_size)), 2))
+
+    # Linear binning splits each score over its four nearest centers, the inverse of the bilinear lookup,
+    # which keeps the surface accurate to well under a cell instead of snapping crashes to the nearest one
+    scores = crashes['safety_score'].to_numpy(dtype=float)
+    binned = np.zeros(shape[0] * shape[1])
+    for row, col, weight in bilinear_corners(crashes.geometry.x.to_numpy(), crashes.geometry.y.to_numpy(), bounds[:2], cell_size, shape):
+        binned += np.bincount(row * shape[1] + col, weights=weight * scores, minlength=len(binned))
+    values = oaconvolve(binned.reshape(shape).astype(np.float32), gaussian_kernel(cell_size, bandwidth), mode='same')
+    values = np.maximum(values, 0).astype(np.float32)
+
+    print(f"Built a {values.shape[1]} x {values.shape[0]} crash density raster of {cell_size:g} ft cells")
+    return CrashDensity(bounds[:2], cell_size, bandwidth, values, len(crashes), scores.sum())
+
+def save_crash_density(density, filename=DENSITY_FILE):
+    # The raster as a plain .npy so it can be memory-mapped, and its placement and settings next to it
+    np.save(filename, density.values)
+    with open(os.path.splitext(filename)[0] + '.json', 'w') as file:
+        json.dump({
+            'origin': density.origin.tolist(), 'cell_size': density.cell_size, 'bandwidth': density.bandwidth,
+            'n_crashes': density.n_crashes, 'total_score': density.total_score,
+        }, file, indent=2)
+
+def load_crash_density(filename=DENSITY_FILE):
+    # Memory-mapped, so loading is instant and lookups only read the pages they touch
+    with open(os.path.splitext(filename)[0] + '.json') as file:
+        metadata = json.load(file)
+    return CrashDensity(values=np.load(filename, mmap_mode='r'), **metadata)
+
+@instrumented
+def crash_density_surface(crashes, filename=DENSITY_FILE, cell_size=CELL_SIZE, bandwidth=BANDWIDTH, rebuild=False):
+    # Reuse the saved raster when it was built with the same settings from the same crashes, otherwise rebuild it
+    if not rebuild and os.path.exists(filename):
+        density = load_crash_density(filename)
+        if density.matches(cell_size, bandwidth, crashes):
+            print(f"Reusing the crash density raster in {filename}")
+            return density
+
+    density = build_crash_density(crashes, cell_size, bandwidth)
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    save_crash_density(density, filename)
+    return load_crash_density(filename)
+
+def main(cell_size=CELL_SIZE, bandwidth=BANDWIDTH, rebuild=False, bike_path_file='processed_bike_paths.geojson',
+         crash_data_file='cleaned_motor_vehicle_collisions.parquet', density_file=DENSITY_FILE, output_file=None):
+    try:
+        from safety_analysis import calculate_safety_scores, prepare_crash_points
+
+        print("Loading crashes...")
+        crashes = calculate_safety_scores(prepare_crash_points(crash_data_file))
+        density = crash_density_surface(crashes, density_file, cell_size, bandwidth, rebuild)
+
+        # Optionally score the uncombined bike path segments straight from the raster
+        if output_file:
+            print("Sampling the raster along the bike paths...")
+            bike_paths = load_bike_paths(bike_path_file)
+            bike_paths['crash_density'] = density.path_scores(bike_paths)
+            bike_paths.to_crs('EPSG:4326').to_file(output_file, driver='GeoJSON')
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute a crash kernel density raster and sample it along bike paths.")
+    parser.add_argument('--cell-size', type=float, default=CELL_SIZE, help=f"Raster cell size in feet (default: {CELL_SIZE})")
+    parser.add_argument('--bandwidth', type=float, default=BANDWIDTH, help=f"Gaussian bandwidth in feet (default: {BANDWIDTH})")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild the raster even if a matching one is saved")
+    parser.add_argument('--output', metavar='FILE', help="Also write every bike path segment with its crash density score to FILE (GeoJSON)")
+    args = parser.parse_args()
+    main(args.cell_size, args.bandwidth, args.rebuild, output_file=args.output)
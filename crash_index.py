@@ -0,0 +1,143 @@
+import argparse
+import hashlib
+import json
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from bike_network import PROJECTED_CRS
+from safety_analysis import SAFETY_WEIGHTS, prepare_crash_points
+from scoring_engine import pair_points_with_paths
+from stage_cache import file_fingerprint
+
+SCORED_NETWORK_FILE = './Bike Lane groupings/scored_bike_paths.parquet'
+TABLE_FILE = './Bike Lane groupings/crash_path_table.parquet'
+
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+def build_crash_path_table(bike_paths, crashes, buffer_radius=50):
+    # One row per (crash, path) pair within the radius, with the crash's time buckets and casualty counts
+    pairs = pair_points_with_paths(bike_paths.to_crs(PROJECTED_CRS), crashes, buffer_radius)
+    crash_times = crashes['CRASH DATETIME'].to_numpy()[pairs['point_idx'].to_numpy()]
+
+    table = pd.DataFrame({
+        'path_id': pairs['path_idx'].to_numpy().astype(np.int32),
+        'day': (crash_times.astype('datetime64[D]') - EPOCH).astype(np.int32),
+        'hour': pd.DatetimeIndex(crash_times).hour.to_numpy().astype(np.int8),
+        'weekday': pd.DatetimeIndex(crash_times).weekday.to_numpy().astype(np.int8),
+    })
+    for col in SAFETY_WEIGHTS:
+        table[col] = crashes[col].to_numpy()[pairs['point_idx'].to_numpy()].astype(np.int16)
+
+    # Sorted by day so a date window is a contiguous slice found by binary search
+    return table.sort_values('day', kind='stable').reset_index(drop=True)
+
+def table_fingerprint(bike_paths, crash_data_file, buffer_radius):
+    # The network the path ids index into and the crash data the pairs came from, as stored next to the table
+    geometry_digest = hashlib.sha256(b''.join(shapely.to_wkb(np.asarray(bike_paths.geometry.values)))).hexdigest()
+    fingerprint = {
+        'n_paths': len(bike_paths), 'paths_digest': geometry_digest, 'crs': bike_paths.crs.to_string() if bike_paths.crs else None,
+        'crashes': file_fingerprint(crash_data_file), 'buffer_radius': buffer_radius,
+    }
+    return json.loads(json.dumps(fingerprint))
+
+def save_crash_path_table(table, filename=TABLE_FILE, fingerprint=None):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    table.to_parquet(filename, index=False)
+    with open(os.path.splitext(filename)[0] + '.json', 'w') as file:
+        json.dump(fingerprint, file, indent=2)
+
+def load_crash_path_table(filename=TABLE_FILE):
+    return pd.read_parquet(filename)
+
+def crash_path_table(bike_paths, crash_data_file, filename=TABLE_FILE, buffer_radius=50, rebuild=False):
+    # Reuse the saved table when it was built for the same network and crash data, otherwise rebuild it
+    fingerprint = table_fingerprint(bike_paths, crash_data_file, buffer_radius)
+    metadata_file = os.path.splitext(filename)[0] + '.json'
+    if not rebuild and os.path.exists(filename) and os.path.exists(metadata_file):
+        with open(metadata_file) as file:
+            if json.load(file) == fingerprint:
+                print(f"Reusing the crash-to-path table in {filename}")
+                return load_crash_path_table(filename)
+
+    print("Building crash-to-path table...")
+    table = build_crash_path_table(bike_paths, prepare_crash_points(crash_data_file), buffer_radius)
+    save_crash_path_table(table, filename, fingerprint)
+    print(f"Saved {len(table)} crash-path pairs to {filename}")
+    return table
+
+def to_day(date):
+    return int((np.datetime64(pd.Timestamp(date).date(), 'D') - EPOCH).astype(np.int64))
+
+def query_safety_scores(table, n_paths, hours=None, weekdays=None, start=None, end=None, weights=SAFETY_WEIGHTS):
+    # Aggregate the safety score of every path over any hour, weekday and date window
+    days = table['day'].to_numpy()
+    first = 0 if start is None else np.searchsorted(days, to_day(start), side='left')
+    last = len(days) if end is None else np.searchsorted(days, to_day(end), side='right')
+    rows = slice(first, last)
+
+    # Hours and weekdays are small integers, so membership is a lookup into a boolean table
+    mask = np.ones(last - first, dtype=bool)
+    if hours is not None:
+        allowed_hours = np.zeros(24, dtype=bool)
+        allowed_hours[list(hours)] = True
+        mask &= allowed_hours[table['hour'].to_numpy()[rows]]
+    if weekdays is not None:
+        allowed_weekdays = np.zeros(7, dtype=bool)
+        allowed_weekdays[list(weekdays)] = True
+        mask &= allowed_weekdays[table['weekday'].to_numpy()[rows]]
+
+    scores = np.zeros(mask.sum())
+    for col, weight in weights.items():
+        scores += weight * table[col].to_numpy()[rows][mask]
+    path_ids = table['path_id'].to_numpy()[rows][mask]
+    if len(path_ids) and path_ids.max() >= n_paths:
+        raise ValueError(f"The crash-to-path table has path ids up to {path_ids.max()} for {n_paths} paths, rebuild it")
+
+    return pd.Series(np.bincount(path_ids, weights=scores, minlength=n_paths), name='safety_score')
+
+def parse_range(text, upper):
+    # "17-21" or "0,6" style ranges of hours (0-23) or weekdays (0=Monday)
+    if text is None:
+        return None
+    values = set()
+    for part in text.split(','):
+        low, _, high = part.partition('-')
+        values.update(range(int(low), int(high or low) + 1))
+    return sorted(value for value in values if 0 <= value < upper)
+
+def output_window_scores(bike_paths, scores, filename):
+    # Scores for one window as a map layer, with the same geometry as the scored network
+    window = bike_paths[['geometry']].copy()
+    window['safety_score'] = scores.to_numpy()
+    window.to_crs('EPSG:4326').to_file(filename, driver='GeoJSON')
+
+def main(build=False, hours=None, weekdays=None, start=None, end=None, scored_file=SCORED_NETWORK_FILE,
+         crash_data_file='cleaned_motor_vehicle_collisions.parquet', table_file=TABLE_FILE,
+         output_file='./Bike Lane groupings/safety_window.geojson'):
+    try:
+        bike_paths = gpd.read_parquet(scored_file)
+        table = crash_path_table(bike_paths, crash_data_file, table_file, rebuild=build)
+
+        print("Querying safety scores...")
+        scores = query_safety_scores(table, len(bike_paths), hours, weekdays, start, end)
+        output_window_scores(bike_paths, scores, output_file)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Safety scores of the scored bike network for an hour, weekday and date window.")
+    parser.add_argument('--build', action='store_true', help="Rebuild the table even if a matching one is saved")
+    parser.add_argument('--hours', help="Hours of the day to include, e.g. 17-21")
+    parser.add_argument('--weekdays', help="Weekdays to include, 0=Monday, e.g. 0-4")
+    parser.add_argument('--since', help="First date to include (YYYY-MM-DD)")
+    parser.add_argument('--until', help="Last date to include (YYYY-MM-DD)")
+    parser.add_argument('--scored', default=SCORED_NETWORK_FILE, help="Scored network written by the pipeline")
+    parser.add_argument('--crashes', default='cleaned_motor_vehicle_collisions.parquet', help="Cleaned collisions")
+    parser.add_argument('--table', default=TABLE_FILE, help="Crash-to-path table, rebuilt when the network or crashes changed")
+    parser.add_argument('--output', default='./Bike Lane groupings/safety_window.geojson', help="GeoJSON file to write the window scores to")
+    args = parser.parse_args()
+    main(args.build, parse_range(args.hours, 24), parse_range(args.weekdays, 7), args.since, args.until,
+         args.scored, args.crashes, args.table, args.output)
@@ -0,0 +1,243 @@
+import argparse
+import os
+import sys
+
+# Only argparse and os are imported up front; each subcommand imports the modules it needs,
+# so --help and score-only runs don't load folium, scipy or matplotlib
+
+PREPROCESSING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data cleaning and preprocessing')
+
+# Raw file (as downloaded into Data sources) and processed file of every dataset
+DATASETS = {
+    'bike-routes': ('bike_routes_preprocessing', 'NYC Bike Routes.geojson', 'processed_bike_paths.geojson'),
+    'collisions': ('collisions_preprocessing', 'Motor_Vehicle_Collisions.csv', 'cleaned_motor_vehicle_collisions.parquet'),
+    'traffic': ('traffic_volume_preprocessing', 'Traffic_Volume_Counts_20240512.csv', 'aggregated_traffic_volume_counts.parquet'),
+    'trees': ('tree_data_preprocessing', 'Tree Data.geojson', 'processed_tree_data.parquet'),
+}
+
+def dataset_name(value):
+    # Checked here rather than with choices, which argparse also applies to the empty default of nargs='*'
+    if value not in DATASETS:
+        raise argparse.ArgumentTypeError(f"invalid dataset {value!r} (choose from {', '.join(DATASETS)})")
+    return value
+
+def processed_file(data_dir, dataset):
+    return os.path.join(data_dir, DATASETS[dataset][2])
+
+def run_preprocess(args):
+    # The preprocessing scripts live in their own folder and are imported from there
+    sys.path.insert(0, PREPROCESSING_DIR)
+    import importlib
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for dataset in args.datasets or list(DATASETS):
+        module_name, raw_name, _ = DATASETS[dataset]
+        print(f"Preprocessing {dataset}...")
+        importlib.import_module(module_name).main(os.path.join(args.source_dir, raw_name), processed_file(args.output_dir, dataset))
+
+def run_score(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    plot_file = os.path.join(args.plot_dir, f'{args.score}_scores.png') if args.plot_dir else None
+    use_cache = not args.no_cache
+
+    if args.score == 'all':
+        import pipeline
+        pipeline.main(
+            n_clusters=args.clusters, clustering=args.clustering, use_cache=use_cache,
+            bike_path_file=processed_file(args.data_dir, 'bike-routes'), tree_data_file=processed_file(args.data_dir, 'trees'),
+            crash_data_file=processed_file(args.data_dir, 'collisions'), traffic_file=processed_file(args.data_dir, 'traffic'),
+            output_dir=args.output_dir, kde=args.kde, segments=args.segments, roll_up_columns=args.roll_up,
+        )
+    elif args.score == 'green':
+        import spatial_analysis
+        spatial_analysis.main(
+            use_cache=use_cache, rank_by=args.rank_by, clustering=args.clustering,
+            bike_path_file=processed_file(args.data_dir, 'bike-routes'), tree_data_file=processed_file(args.data_dir, 'trees'),
+            output_dir=args.output_dir, plot_file=plot_file, show_plot=False,
+        )
+    elif args.score == 'safety':
+        import safety_analysis
+        safety_analysis.main(
+            use_cache=use_cache, clustering=args.clustering,
+            bike_path_file=processed_file(args.data_dir, 'bike-routes'), crash_data_file=processed_file(args.data_dir, 'collisions'),
+            output_dir=args.output_dir, plot_file=plot_file, show_plot=False, kde=args.kde,
+        )
+    else:
+        import traffic_analysis
+        traffic_analysis.main(
+            traffic_file=processed_file(args.data_dir, 'traffic'), crash_data_file=processed_file(args.data_dir, 'collisions'),
+            plot_dir=args.plot_dir, show_plot=False,
+        )
+
+def run_update(args):
+    import incremental_safety
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    incremental_safety.main(
+        args.init, args.lookback_days,
+        bike_path_file=processed_file(args.data_dir, 'bike-routes'), crash_data_file=processed_file(args.data_dir, 'collisions'),
+        state_dir=args.state_dir, output_dir=args.output_dir, clustering=args.clustering,
+    )
+
+def run_render(args):
+    import map_layers
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    map_layers.main(args.score, args.scored, args.output_dir)
+
+def run_rank(args):
+    import ranking
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    quantiles = ranking.BAND_QUANTILES if args.bands == [] else args.bands
+    ranking.main(args.score, args.k, quantiles, args.group_by, args.scored, args.output_dir, args.format)
+
+def run_grid(args):
+    import grid_index
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    grid_index.main(
+        args.cell_size, args.shape, args.levels, args.summary_level,
+        bike_path_file=processed_file(args.data_dir, 'bike-routes'), tree_data_file=processed_file(args.data_dir, 'trees'),
+        crash_data_file=processed_file(args.data_dir, 'collisions'), output_dir=args.output_dir,
+    )
+
+def run_serve(args):
+    import score_service
+
+    score_service.main(
+        args.host, args.port, args.scored,
+        tree_data_file=processed_file(args.data_dir, 'trees'), crash_data_file=processed_file(args.data_dir, 'collisions'),
+    )
+
+def run_route(args):
+    import routing
+
+    output_file = args.output or os.path.join('Bike Lane groupings', 'route_cost_matrix.csv' if args.points else 'route.geojson')
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    window = None
+    if args.hours or args.weekdays or args.since or args.until:
+        from crash_index import parse_range
+        window = {'hours': parse_range(args.hours, 24), 'weekdays': parse_range(args.weekdays, 7), 'start': args.since, 'end': args.until}
+    routing.main(
+        args.origin and tuple(args.origin), args.destination and tuple(args.destination), args.green_weight, args.safety_weight,
+        args.rebuild, window,
+        bike_path_file=processed_file(args.data_dir, 'bike-routes'), tree_data_file=processed_file(args.data_dir, 'trees'),
+        crash_data_file=processed_file(args.data_dir, 'collisions'), graph_dir=args.graph, output_file=output_file,
+        crash_density_file=args.crash_density, points_file=args.points,
+    )
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Batch command line for the green and safe bike path analysis. Never opens plot windows.")
+    parser.add_argument('--trace', metavar='FILE', help="Record per-stage time, rows, vertices and peak memory (.json for Chrome trace format)")
+    parser.add_argument('--profile', metavar='FILE', help="Run under cProfile and write the stats to FILE (.prof)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    preprocess = subparsers.add_parser('preprocess', help="Clean the raw datasets into the processed files the analyses read")
+    preprocess.add_argument('datasets', nargs='*', type=dataset_name, metavar='DATASET',
+                            help=f"Datasets to preprocess, any of {', '.join(DATASETS)} (default: all)")
+    preprocess.add_argument('--source-dir', default='Data sources', help="Directory of the raw downloads (default: 'Data sources')")
+    preprocess.add_argument('--output-dir', default='.', help="Directory to write the processed files to (default: .)")
+    preprocess.set_defaults(handler=run_preprocess)
+
+    score = subparsers.add_parser('score', help="Score bike paths for greenery and safety")
+    score.add_argument('score', nargs='?', choices=['all', 'green', 'safety', 'traffic'], default='all',
+                       help="Both scores in a single pass, one of them, or the hourly traffic and crash summary (default: all)")
+    score.add_argument('--data-dir', default='.', help="Directory of the processed files (default: .)")
+    score.add_argument('--output-dir', default='Bike Lane groupings', help="Directory to write the rankings to (default: 'Bike Lane groupings')")
+    score.add_argument('--plot-dir', help="Save plots as PNG files in this directory; without it no plots are drawn")
+    score.add_argument('--clusters', type=int, default=200, help="Number of bike path clusters for 'all' (default: 200)")
+    score.add_argument('--clustering', choices=['kmeans', 'minibatch', 'grid'], default='kmeans', help="Clustering backend; 'grid' needs no scikit-learn (default: kmeans)")
+    score.add_argument('--rank-by', choices=['tree_density', 'canopy_score'], default='tree_density', help="Green ranking for 'green' (default: tree_density)")
+    score.add_argument('--segments', action='store_true', help="Score every bike path segment per 100 ft instead of clusters, for 'all'")
+    score.add_argument('--roll-up', nargs='+', default=[], metavar='COLUMN',
+                       help="With --segments, also write the segment scores summed up by each COLUMN, e.g. Borough or cluster")
+    score.add_argument('--kde', action='store_true',
+                       help="Score crash exposure from a crash kernel density raster: replaces the buffer score for 'safety', adds crash_density for 'all'")
+    score.add_argument('--no-cache', action='store_true', help="Recompute every stage without reading or writing the stage cache")
+    score.set_defaults(handler=run_score)
+
+    update = subparsers.add_parser('update', help="Add newly published crashes to the cached safety scores without a full rerun")
+    update.add_argument('--init', action='store_true', help="Build the score state from scratch with a full run")
+    update.add_argument('--lookback-days', type=int,
+                        help="Days before the watermark rescanned for late crashes (default: 30 for --init; updates use the one the state was built with and accept no more)")
+    update.add_argument('--state-dir', default='safety_state', help="Directory of the cached score state (default: safety_state)")
+    update.add_argument('--clustering', choices=['kmeans', 'minibatch', 'grid'], default='kmeans', help="Clustering backend for --init (default: kmeans)")
+    update.add_argument('--data-dir', default='.', help="Directory of the processed files (default: .)")
+    update.add_argument('--output-dir', default='Bike Lane groupings', help="Directory to write the rankings to (default: 'Bike Lane groupings')")
+    update.set_defaults(handler=run_update)
+
+    render = subparsers.add_parser('render', help="Render the scored network as a lightweight web map")
+    render.add_argument('--score', default='tree_density', help="Score column to color the network by (default: tree_density)")
+    render.add_argument('--scored', default=os.path.join('Bike Lane groupings', 'scored_bike_paths.parquet'),
+                        help="Scored network written by 'score all'")
+    render.add_argument('--output-dir', default='Mapped Results', help="Directory to write the map to (default: 'Mapped Results')")
+    render.set_defaults(handler=run_render)
+
+    rank = subparsers.add_parser('rank', help="Top-k, percentile band and per-group rankings of the scored network")
+    rank.add_argument('--score', default='tree_density', help="Score column to rank by (default: tree_density)")
+    rank.add_argument('-k', type=int, default=5, help="Number of best and worst paths to output (default: 5)")
+    rank.add_argument('--bands', nargs='*', type=float, metavar='QUANTILE',
+                      help="Also output percentile bands split at these quantiles (default: deciles and quartiles)")
+    rank.add_argument('--group-by', metavar='COLUMN', help="Also output the top k within each value of COLUMN, e.g. Borough")
+    rank.add_argument('--format', choices=['geojson', 'parquet'], default='geojson', help="Output file format (default: geojson)")
+    rank.add_argument('--scored', default=os.path.join('Bike Lane groupings', 'scored_bike_paths.parquet'),
+                      help="Scored network written by 'score all'")
+    rank.add_argument('--output-dir', default='Bike Lane groupings', help="Directory to write the rankings to (default: 'Bike Lane groupings')")
+    rank.set_defaults(handler=run_rank)
+
+    grid = subparsers.add_parser('grid', help="Bin trees, crashes and path length into a multi-resolution grid for heatmaps")
+    grid.add_argument('--cell-size', type=float, default=500, help="Finest cell size in feet (default: 500)")
+    grid.add_argument('--shape', choices=['square', 'hex'], default='square', help="Cell shape (default: square)")
+    grid.add_argument('--levels', type=int, default=5, help="Number of levels, each doubling the cell size (default: 5)")
+    grid.add_argument('--summary-level', type=int, default=2, help="Level of the cell summaries written as GeoJSON (default: 2)")
+    grid.add_argument('--data-dir', default='.', help="Directory of the processed files (default: .)")
+    grid.add_argument('--output-dir', default='Bike Lane groupings', help="Directory to write the grid and summaries to (default: 'Bike Lane groupings')")
+    grid.set_defaults(handler=run_grid)
+
+    serve = subparsers.add_parser('serve', help="Serve point, bbox and path score queries over HTTP")
+    serve.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1)")
+    serve.add_argument('--port', type=int, default=8765, help="Port to listen on (default: 8765)")
+    serve.add_argument('--scored', default=os.path.join('Bike Lane groupings', 'scored_bike_paths.parquet'),
+                       help="Scored network written by 'score all'")
+    serve.add_argument('--data-dir', default='.', help="Directory of the processed tree and collision files (default: .)")
+    serve.set_defaults(handler=run_serve)
+
+    route = subparsers.add_parser('route', help="Find a green and safe route between two points, or the route costs between many")
+    route.add_argument('--origin', nargs=2, type=float, metavar=('LON', 'LAT'))
+    route.add_argument('--destination', nargs=2, type=float, metavar=('LON', 'LAT'))
+    route.add_argument('--points', metavar='CSV',
+                       help="Instead of one route, write the route costs between every pair of the name, longitude, latitude rows of CSV")
+    route.add_argument('--green-weight', type=float, default=1.0, help="Penalty per foot of path without tree cover (default: 1.0)")
+    route.add_argument('--safety-weight', type=float, default=1.0, help="Penalty per foot of path with crash exposure (default: 1.0)")
+    route.add_argument('--data-dir', default='.', help="Directory of the processed files (default: .)")
+    route.add_argument('--graph', default='route_graph', help="Route graph directory, built on first use (default: route_graph)")
+    route.add_argument('--rebuild', action='store_true', help="Rebuild the route graph from the processed data")
+    route.add_argument('--crash-density', metavar='FILE',
+                       help="Crash exposure of a rebuilt graph from this crash density raster (.npy), built if missing or stale")
+    route.add_argument('--output', help="File to write the route (GeoJSON, default: 'Bike Lane groupings/route.geojson') "
+                                        "or cost matrix (CSV, default: 'Bike Lane groupings/route_cost_matrix.csv') to")
+    route.add_argument('--hours', help="Only count crashes in these hours of the day, e.g. 17-21")
+    route.add_argument('--weekdays', help="Only count crashes on these weekdays, 0=Monday, e.g. 0-4")
+    route.add_argument('--since', help="Only count crashes from this date (YYYY-MM-DD)")
+    route.add_argument('--until', help="Only count crashes up to this date (YYYY-MM-DD)")
+    route.set_defaults(handler=run_route)
+
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'route' and not args.points and not (args.origin and args.destination):
+        parser.error("route: --origin and --destination are required unless --points is given")
+    if args.command == 'score' and args.roll_up and not (args.score == 'all' and args.segments):
+        parser.error("score: --roll-up requires 'all' with --segments")
+    if args.trace or args.profile:
+        from instrumentation import tracing
+        with tracing(args.trace, args.profile):
+            args.handler(args)
+    else:
+        args.handler(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import argparse
+import os
+import geopandas as gpd
+import numpy as np
+import shapely
+from bike_network import PROJECTED_CRS, ensure_projected, load_bike_paths
+
+GRID_FILE = './Bike Lane groupings/grid_index.npz'
+
+# Finest cell size in feet; every coarser level doubles it
+CELL_SIZE = 500
+N_LEVELS = 5
+
+GRID_SHAPES = ['square', 'hex']
+
+SQRT3 = np.sqrt(3)
+
+class GridIndex:
+    # Dense per-cell sums of trees, crashes and bike path length at the finest level; coarser levels are rolled up on demand
+    def __init__(self, bounds, cell_size, shape, n_levels, layers):
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.cell_size = float(cell_size)
+        self.shape = str(shape)
+        self.n_levels = int(n_levels)
+        self.layers = layers
+        self._rolled_up = {}
+
+    def level_size(self, level):
+        # Square side or hexagon circumradius in feet
+        return self.cell_size * 2 ** level
+
+    def level_geometry(self, level):
+        # Origin, cell pitch and (rows, cols) of a level; hex grids get one cell of padding around the bounds
+        size = self.level_size(level)
+        minx, miny, maxx, maxy = self.bounds
+        if self.shape == 'square':
+            pitch = (size, size)
+            origin = (minx, miny)
+            dims = (max(int(np.ceil((maxy - miny) / size)), 1), max(int(np.ceil((maxx - minx) / size)), 1))
+        else:
+            pitch = (SQRT3 * size, 1.5 * size)
+            origin = (minx - pitch[0], miny - pitch[1])
+            dims = (int((maxy - miny) / pitch[1]) + 3, int((maxx - minx) / pitch[0]) + 3)
+        return origin, pitch, dims
+
+    def cell_of(self, x, y, level=0):
+        # Row and column of the cell holding each point, by arithmetic alone; -1 for points outside the grid
+        (origin_x, origin_y), _, (n_rows, n_cols) = self.level_geometry(level)
+        x = np.asarray(x, dtype=float) - origin_x
+        y = np.asarray(y, dtype=float) - origin_y
+        with np.errstate(invalid='ignore'):
+            if self.shape == 'square':
+                size = self.level_size(level)
+                rows, cols = np.floor(y / size).astype(np.int64), np.floor(x / size).astype(np.int64)
+                # Points on the far edges of the bounds belong to the last row or column
+                minx, miny, maxx, maxy = self.bounds
+                rows = np.where((rows == n_rows) & (y <= maxy - miny), n_rows - 1, rows)
+                cols = np.where((cols == n_cols) & (x <= maxx - minx), n_cols - 1, cols)
+            else:
+                rows, cols = hex_cells(x, y, self.level_size(level))
+        outside = (rows < 0) | (rows >= n_rows) | (cols < 0) | (cols >= n_cols)
+        return np.where(outside, -1, rows), np.where(outside, -1, cols)
+
+    def cell_centers(self, level=0):
+        # Projected x and y of every cell center, as (rows, cols) arrays
+        (origin_x, origin_y), (pitch_x, pitch_y), (n_rows, n_cols) = self.level_geometry(level)
+        rows, cols = np.indices((n_rows, n_cols))
+        if self.shape == 'square':
+            return origin_x + (cols + 0.5) * pitch_x, origin_y + (rows + 0.5) * pitch_y
+        return origin_x + (cols + 0.5 * (rows & 1)) * pitch_x, origin_y + rows * pitch_y
+
+    def layer(self, name, level=0):
+        # Dense array of one layer at any level; square levels nest exactly, hex levels re-bin the finest cell centers
+        if level == 0:
+            return self.layers[name]
+        key = (name, level)
+        if key not in self._rolled_up:
+            if self.shape == 'square':
+                factor = 2 ** level
+                n_rows, n_cols = self.level_geometry(level)[2]
+                padded = np.zeros((n_rows * factor, n_cols * factor))
+                padded[:self.layers[name].shape[0], :self.layers[name].shape[1]] = self.layers[name]
+                self._rolled_up[key] = padded.reshape(n_rows, factor, n_cols, factor).sum(axis=(1, 3))
+            else:
+                center_x, center_y = self.cell_centers(0)
+                self._rolled_up[key] = self.bin_values(center_x.ravel(), center_y.ravel(), self.layers[name].ravel(), level)
+        return self._rolled_up[key]
+
+    def value_at(self, name, x, y, level=0):
+        # Layer values of the cells holding the given points, NaN for points outside the grid
+        rows, cols = self.cell_of(x, y, level)
+        return np.where(rows >= 0, self.layer(name, level)[rows, cols], np.nan)
+
+    def bin_values(self, x, y, weights=None, level=0):
+        # Sum weights (or count points) per cell into a dense array; points outside the grid are left out
+        n_rows, n_cols = self.level_geometry(level)[2]
+        rows, cols = self.cell_of(x, y, level)
+        inside = rows >= 0
+        weights = None if weights is None else np.asarray(weights)[inside]
+        return np.bincount(rows[inside] * n_cols + cols[inside], weights=weights, minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+
+    def cell_polygons(self, rows, cols, level=0):
+        # Square or pointy-top hexagon outline of each given cell
+        center_x, center_y = self.cell_centers(level)
+        x, y = center_x[rows, cols], center_y[rows, cols]
+        size = self.level_size(level)
+        if self.shape == 'square':
+            return shapely.box(x - size / 2, y - size / 2, x + size / 2, y + size / 2)
+        angles = np.radians(np.arange(6) * 60 + 30)
+        ring_x = x[:, None] + size * np.cos(angles)
+        ring_y = y[:, None] + size * np.sin(angles)
+        return shapely.polygons(np.stack([ring_x, ring_y], axis=-1))
+
+    def cell_table(self, level=0, names=None):
+        # Non-empty cells as a GeoDataFrame with every layer, the starting point for heatmaps and area summaries
+        names = list(self.layers) if names is None else names
+        stacked = np.stack([self.layer(name, level) for name in names])
+        rows, cols = np.nonzero(stacked.any(axis=0))
+        cells = gpd.GeoDataFrame(
+            {'level': level, 'row': rows, 'col': cols, **{name: stacked[i, rows, cols] for i, name in enumerate(names)}},
+            geometry=self.cell_polygons(rows, cols, level), crs=PROJECTED_CRS
+        )
+        return cells
+
+def hex_cells(x, y, size):
+    # Pointy-top hexagons in odd-row offset coordinates: axial coordinates, cube rounding, then offset
+    q = (SQRT3 / 3 * x - y / 3) / size
+    r = 2 / 3 * y / size
+    s = -q - r
+    round_q, round_r, round_s = np.round(q), np.round(r), np.round(s)
+    diff_q, diff_r, diff_s = np.abs(round_q - q), np.abs(round_r - r), np.abs(round_s - s)
+    fix_q = (diff_q > diff_r) & (diff_q > diff_s)
+    fix_r = ~fix_q & (diff_r > diff_s)
+    round_q = np.where(fix_q, -round_r - round_s, round_q)
+    round_r = np.where(fix_r, -round_q - round_s, round_r)
+
+    rows = round_r.astype(np.int64)
+    cols = round_q.astype(np.int64) + (rows - (rows & 1)) // 2
+    return rows, cols
+
+def path_segments(bike_paths, max_length):
+    # Midpoints and lengths of the path linework cut into pieces no longer than max_length
+    lines = shapely.segmentize(np.asarray(bike_paths.geometry.values), max_length)
+    coords, line_idx = shapely.get_coordinates(lines, return_index=True)
+    same_line = line_idx[1:] == line_idx[:-1]
+    start, end = coords[:-1][same_line], coords[1:][same_line]
+    midpoints = (start + end) / 2
+    return midpoints[:, 0], midpoints[:, 1], np.hypot(*(end - start).T)
+
+def build_grid_index(bike_paths, trees=None, crashes=None, cell_size=CELL_SIZE, shape='square', n_levels=N_LEVELS, bounds=None):
+    # Bin every input once into the finest level; all queries and coarser levels read these arrays
+    if shape not in GRID_SHAPES:
+        raise ValueError(f"Unknown grid shape {shape!r}, expected one of {GRID_SHAPES}")
+    bike_paths = ensure_projected(bike_paths)
+    trees = None if trees is None else ensure_projected(trees)
+    crashes = None if crashes is None else ensure_projected(crashes)
+    if bounds is None:
+        frames = [frame for frame in (bike_paths, trees, crashes) if frame is not None]
+        all_bounds = np.array([frame.total_bounds for frame in frames])
+        bounds = (*all_bounds[:, :2].min(axis=0), *all_bounds[:, 2:].max(axis=0))
+
+    grid = GridIndex(bounds, cell_size, shape, n_levels, {})
+    x, y, lengths = path_segments(bike_paths, cell_size / 4)
+    grid.layers['path_length'] = grid.bin_values(x, y, lengths)
+
+    if trees is not None:
+        tree_x, tree_y = trees.geometry.x.to_numpy(), trees.geometry.y.to_numpy()
+        grid.layers['trees'] = grid.bin_values(tree_x, tree_y)
+        from spatial_analysis import DBH_COLUMN
+        if DBH_COLUMN in trees.columns:
+            grid.layers['canopy'] = grid.bin_values(tree_x, tree_y, trees[DBH_COLUMN].to_numpy(dtype=float))
+    if crashes is not None:
+        crash_x, crash_y = crashes.geometry.x.to_numpy(), crashes.geometry.y.to_numpy()
+        grid.layers['crashes'] = grid.bin_values(crash_x, crash_y)
+        if 'safety_score' in crashes.columns:
+            grid.layers['safety'] = grid.bin_values(crash_x, crash_y, crashes['safety_score'].to_numpy(dtype=float))
+    return grid
+
+def per_path_length(values, path_length, per_feet=1000):
+    # A cell total per 1000 feet of bike path in the cell; NaN where the cell has no path
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(path_length > 0, values / path_length * per_feet, np.nan)
+
+def heatmap_points(cells, column):
+    # [lat, lon, weight] rows for folium.plugins.HeatMap, one per cell center
+    centers = gpd.GeoSeries(cells.geometry.centroid, crs=cells.crs).to_crs('EPSG:4326')
+    weights = cells[column].fillna(0).to_numpy()
+    return np.column_stack([centers.y.to_numpy(), centers.x.to_numpy(), weights / max(weights.max(), 1e-9)]).tolist()
+
+def save_grid_index(grid, filename=GRID_FILE):
+    np.savez_compressed(
+        filename, bounds=grid.bounds, cell_size=grid.cell_size, shape=grid.shape, n_levels=grid.n_levels,
+        **{f'layer_{name}': values for name, values in grid.layers.items()}
+    )
+
+def load_grid_index(filename=GRID_FILE):
+    with np.load(filename) as arrays:
+        layers = {name[len('layer_'):]: arrays[name] for name in arrays.files if name.startswith('layer_')}
+        return GridIndex(arrays['bounds'], arrays['cell_size'], arrays['shape'], arrays['n_levels'], layers)
+
+def main(cell_size=CELL_SIZE, shape='square', n_levels=N_LEVELS, summary_level=2, bike_path_file='processed_bike_paths.geojson',
+         tree_data_file='processed_tree_data.parquet', crash_data_file='cleaned_motor_vehicle_collisions.parquet',
+         output_dir='./Bike Lane groupings'):
+    try:
+        from safety_analysis import calculate_safety_scores, prepare_crash_points, safety_by_cell
+        from spatial_analysis import prepare_tree_points, tree_density_by_cell
+
+        print("Loading bike paths, trees and crashes...")
+        bike_paths = load_bike_paths(bike_path_file)
+        trees = prepare_tree_points(tree_data_file)
+        crashes = calculate_safety_scores(prepare_crash_points(crash_data_file))
+
+        print(f"Binning into {shape} cells of {cell_size:g} feet...")
+        grid = build_grid_index(bike_paths, trees, crashes, cell_size, shape, n_levels)
+        save_grid_index(grid, os.path.join(output_dir, 'grid_index.npz'))
+
+        # Area summaries at one level, e.g. 2000 ft cells for neighborhood comparisons
+        print(f"Outputting cell summaries at level {summary_level} ({grid.level_size(summary_level):g} ft cells)...")
+        tree_density_by_cell(grid, summary_level).to_crs('EPSG:4326').to_file(
+            os.path.join(output_dir, 'green_cells.geojson'), driver='GeoJSON')
+        safety_by_cell(grid, summary_level).to_crs('EPSG:4326').to_file(
+            os.path.join(output_dir, 'safety_cells.geojson'), driver='GeoJSON')
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bin trees, crashes and bike path length into a multi-resolution grid for heatmaps.")
+    parser.add_argument('--cell-size', type=float, default=CELL_SIZE, help=f"Finest cell size in feet (default: {CELL_SIZE})")
+    parser.add_argument('--shape', choices=GRID_SHAPES, default='square', help="Cell shape (default: square)")
+    parser.add_argument('--levels', type=int, default=N_LEVELS, help=f"Number of levels, each doubling the cell size (default: {N_LEVELS})")
+    parser.add_argument('--summary-level', type=int, default=2, help="Level of the cell summaries written as GeoJSON (default: 2)")
+    args = parser.parse_args()
+    main(args.cell_size, args.shape, args.levels, args.summary_level)
@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from bike_network import PROJECTED_CRS, cluster_bike_paths, combine_bike_paths
+from columnar_io import count_collisions, read_collisions
+from scoring_engine import build_path_index, score_points_near_paths
+from safety_analysis import (
+    load_data, create_crash_points, calculate_safety_scores, normalize_scores, get_safe_and_unsafe_clusters,
+    output_cluster_info
+)
+
+# Score state lives next to the other pipeline outputs
+STATE_DIR = 'safety_state'
+
+# Crashes are often published days or weeks after they happened, so every update rescans this many days before the
+# watermark and skips the records it already scored
+LOOKBACK_DAYS = 30
+
+def crash_keys(crashes):
+    # Content hash of every record, numbered among identical records so that repeated rows each count once
+    hashes = pd.util.hash_pandas_object(crashes[sorted(crashes.columns)], index=False).to_numpy()
+    return pd.DataFrame({
+        'hash': hashes,
+        'occurrence': pd.Series(hashes).groupby(hashes).cumcount().to_numpy(),
+        'CRASH DATETIME': crashes['CRASH DATETIME'].to_numpy(),
+    })
+
+def save_score_state(bike_paths, watermark, buffer_radius, scored_keys, n_scored, lookback_days=LOOKBACK_DAYS, state_dir=STATE_DIR):
+    # Persist the projected path geometries with their raw score sums, the crash watermark, and the keys of the
+    # scored crashes that a later update could read again
+    os.makedirs(state_dir, exist_ok=True)
+    bike_paths.to_parquet(os.path.join(state_dir, 'paths.parquet'))
+    window_start = pd.Timestamp(watermark) - pd.Timedelta(days=lookback_days)
+    scored_keys[scored_keys['CRASH DATETIME'] > window_start].to_parquet(os.path.join(state_dir, 'scored_keys.parquet'))
+    with open(os.path.join(state_dir, 'state.json'), 'w') as file:
+        json.dump({
+            'watermark': pd.Timestamp(watermark).isoformat(), 'buffer_radius': buffer_radius,
+            'lookback_days': lookback_days, 'n_scored': int(n_scored),
+        }, file)
+
+def load_score_state(state_dir=STATE_DIR):
+    # Load the cached paths, the watermark of the newest crash already scored and the keys of the recent ones.
+    # State saved before the keys were kept has none; its updates read strictly after the watermark as before
+    bike_paths = gpd.read_parquet(os.path.join(state_dir, 'paths.parquet'))
+    with open(os.path.join(state_dir, 'state.json')) as file:
+        state = json.load(file)
+    state['watermark'] = pd.Timestamp(state['watermark'])
+    keys_file = os.path.join(state_dir, 'scored_keys.parquet')
+    state['scored_keys'] = pd.read_parquet(keys_file) if os.path.exists(keys_file) else None
+    return bike_paths, state
+
+def score_crashes(bike_paths, crashes, buffer_radius, path_index=None):
+    # Turn raw crash records into projected, weighted points and sum them per path
+    crashes_gdf = calculate_safety_scores(create_crash_points(crashes))
+    return score_points_near_paths(bike_paths, crashes_gdf, buffer_radius, weight_column='safety_score', path_index=path_index)
+
+def initialize_score_state(bike_path_file, crash_data_file, state_dir=STATE_DIR, n_clusters=200, buffer_radius=50,
+                           lookback_days=LOOKBACK_DAYS, clustering='kmeans'):
+    # Run the full clustering and scoring once and persist the result as the starting state
+    print("Loading data...")
+    bike_paths, crashes = load_data(bike_path_file, crash_data_file)
+
+    print("Clustering and combining bike paths...")
+    bike_paths = cluster_bike_paths(bike_paths, n_clusters=n_clusters, method=clustering)
+    combined_bike_paths = combine_bike_paths(bike_paths).to_crs(PROJECTED_CRS)
+
+    print("Scoring all crashes...")
+    combined_bike_paths['safety_score'] = score_crashes(combined_bike_paths, crashes, buffer_radius)
+
+    watermark = crashes['CRASH DATETIME'].max()
+    save_score_state(combined_bike_paths, watermark, buffer_radius, crash_keys(crashes), len(crashes), lookback_days, state_dir)
+    print(f"Saved score state for {len(combined_bike_paths)} paths with watermark {watermark}")
+    return combined_bike_paths
+
+def update_safety_scores(crash_data_file, state_dir=STATE_DIR, lookback_days=None):
+    # Score the crashes in the lookback window before the watermark and after it that weren't scored yet,
+    # and add them to the cached sums
+    bike_paths, state = load_score_state(state_dir)
+    stored_lookback = state.get('lookback_days', LOOKBACK_DAYS)
+    lookback_days = stored_lookback if lookback_days is None else lookback_days
+    if lookback_days > stored_lookback:
+        # Keys of crashes before the stored window were pruned, so a longer window would score them a second time
+        raise ValueError(f"The score state only remembers the last {stored_lookback} days of scored crashes; "
+                         f"rebuild it with --init --lookback-days {lookback_days} for a longer lookback")
+    scored_keys = state['scored_keys']
+    if scored_keys is None:
+        lookback_days = 0
+        scored_keys = pd.DataFrame({'hash': np.empty(0, dtype=np.uint64), 'occurrence': np.empty(0, dtype=np.int64),
+                                    'CRASH DATETIME': np.empty(0, dtype='datetime64[ns]')})
+    window_start = state['watermark'] - pd.Timedelta(days=lookback_days)
+
+    crashes = read_collisions(crash_data_file, since=window_start)
+    keys = crash_keys(crashes)
+    new = ~pd.MultiIndex.from_frame(keys[['hash', 'occurrence']]).isin(
+        pd.MultiIndex.from_frame(scored_keys[['hash', 'occurrence']])
+    )
+    new_crashes = crashes[new]
+    late = int((new_crashes['CRASH DATETIME'] <= state['watermark']).sum())
+    print(f"Found {len(new_crashes)} new crashes after {window_start}, {late} of them late arrivals before the watermark")
+
+    n_scored = state.get('n_scored', 0) + len(new_crashes)
+    if len(new_crashes) > 0:
+        # The path index is rebuilt from the cached linework, which takes milliseconds for a few hundred paths
+        path_index = build_path_index(bike_paths)
+        bike_paths['safety_score'] += score_crashes(bike_paths, new_crashes, state['buffer_radius'], path_index)
+        watermark = max(state['watermark'], new_crashes['CRASH DATETIME'].max())
+        save_score_state(bike_paths, watermark, state['buffer_radius'], pd.concat([scored_keys, keys[new]], ignore_index=True),
+                         n_scored, lookback_days, state_dir)
+
+    # Records published later than the lookback window can only be caught by a full run
+    n_records = count_collisions(crash_data_file)
+    if 'n_scored' in state and n_records != n_scored:
+        print(f"Warning: {crash_data_file} holds {n_records} crashes but {n_scored} have been scored; "
+              f"crashes older than the {lookback_days}-day lookback changed, rebuild the state with --init")
+
+    return bike_paths
+
+def output_safety_rankings(bike_paths, output_dir='./Bike Lane groupings'):
+    # Recompute normalization and the top/bottom clusters from the cached aggregates
+    bike_paths_normalized = normalize_scores(bike_paths.to_crs('EPSG:4326'))
+    safest_clusters, least_safe_clusters = get_safe_and_unsafe_clusters(bike_paths_normalized)
+    output_cluster_info(safest_clusters, os.path.join(output_dir, 'most_safe_clusters.geojson'))
+    output_cluster_info(least_safe_clusters, os.path.join(output_dir, 'least_safe_clusters.geojson'))
+    return bike_paths_normalized
+
+def main(initialize=False, lookback_days=None, bike_path_file='processed_bike_paths.geojson',
+         crash_data_file='cleaned_motor_vehicle_collisions.parquet', state_dir=STATE_DIR, output_dir='./Bike Lane groupings',
+         clustering='kmeans'):
+    try:
+        if initialize:
+            bike_paths = initialize_score_state(bike_path_file, crash_data_file, state_dir, clustering=clustering,
+                                                lookback_days=LOOKBACK_DAYS if lookback_days is None else lookback_days)
+        else:
+            bike_paths = update_safety_scores(crash_data_file, state_dir, lookback_days)
+
+        print("Outputting cluster information for Google Maps...")
+        output_safety_rankings(bike_paths, output_dir)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add newly published crashes to the cached bike path safety scores.")
+    parser.add_argument('--init', action='store_true', help="Build the score state from scratch with a full run")
+    parser.add_argument('--lookback-days', type=int,
+                        help=f"Days before the watermark rescanned for late crashes (default: {LOOKBACK_DAYS} for --init; updates use the one the state was built with and accept no more)")
+    args = parser.parse_args()
+    main(initialize=args.init, lookback_days=args.lookback_days)
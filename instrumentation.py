@@ -0,0 +1,178 @@
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+# Tracer of the current run; None keeps every instrumented function a plain call
+active_tracer = None
+
+def current_rss():
+    # Resident set size in bytes, read from /proc so memory allocated by GEOS and numpy is included
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def frames_in(value):
+    # The frames in an argument or result, looking inside the tuples and dicts stages return
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return [value]
+    if isinstance(value, (tuple, list)):
+        return [frame for item in value for frame in frames_in(item)]
+    if isinstance(value, dict):
+        return [frame for item in value.values() for frame in frames_in(item)]
+    return []
+
+def vertex_count(frame):
+    # Total number of coordinates in the geometry of a (Geo)DataFrame or GeoSeries, None without geometry
+    if isinstance(frame, gpd.GeoSeries):
+        geometry = frame
+    elif isinstance(frame, gpd.GeoDataFrame):
+        try:
+            geometry = frame.geometry
+        except AttributeError:
+            return None
+    else:
+        return None
+    return int(shapely.get_num_coordinates(np.asarray(geometry.values)).sum())
+
+def describe_frames(frames):
+    # Row and vertex counts summed over the frames going into or out of a stage
+    vertices = [count for count in map(vertex_count, frames) if count is not None]
+    return sum(len(frame) for frame in frames), sum(vertices) if vertices else None
+
+class MemorySampler(threading.Thread):
+    # Samples the RSS every few milliseconds and raises the peak of every stage that is still open
+    def __init__(self, open_records, interval=0.005):
+        super().__init__(daemon=True, name='rss-sampler')
+        self.open_records = open_records
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = current_rss()
+            for record in list(self.open_records):
+                record['peak_rss'] = max(record['peak_rss'], rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class Tracer:
+    def __init__(self, trace_file):
+        # A .json trace file is written in Chrome trace format at the end of the run, anything else as JSON lines
+        self.trace_file = trace_file
+        self.chrome_format = trace_file.endswith('.json')
+        self.origin = time.perf_counter()
+        self.events = []
+        self.open_records = []
+        self.lines = None if self.chrome_format else open(trace_file, 'w')
+        self.sampler = MemorySampler(self.open_records)
+        self.sampler.start()
+
+    @contextmanager
+    def stage(self, name, inputs=()):
+        rows_in, vertices_in = describe_frames(inputs)
+        rss = current_rss()
+        record = {'stage': name, 'depth': len(self.open_records), 'start_rss': rss, 'peak_rss': rss}
+        if inputs:
+            record.update(rows_in=rows_in, vertices_in=vertices_in)
+
+        self.open_records.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            end = time.perf_counter()
+            self.open_records.remove(record)
+            self.finish(record, start, end)
+
+    def set_outputs(self, record, result):
+        frames = frames_in(result)
+        if frames:
+            record['rows_out'], record['vertices_out'] = describe_frames(frames)
+
+    def finish(self, record, start, end):
+        peak_rss = max(record.pop('peak_rss'), current_rss())
+        start_rss = record.pop('start_rss')
+        record['start'] = round(start - self.origin, 6)
+        record['seconds'] = round(end - start, 6)
+        record['peak_rss_mb'] = round(peak_rss / 1024 ** 2, 1)
+        record['rss_growth_mb'] = round((peak_rss - start_rss) / 1024 ** 2, 1)
+        print(f"[trace] {'  ' * record['depth']}{record['stage']}: {record['seconds']:.3f}s, "
+              f"peak RSS {record['peak_rss_mb']} MB (+{record['rss_growth_mb']} MB)")
+
+        if self.chrome_format:
+            args = {key: value for key, value in record.items() if key not in ('stage', 'start', 'seconds', 'depth')}
+            self.events.append({
+                'name': record['stage'], 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                'ts': round(record['start'] * 1e6, 1), 'dur': round(record['seconds'] * 1e6, 1), 'args': args,
+            })
+        else:
+            # One flushed line per stage, so a slow run can be followed while it is still going
+            self.lines.write(json.dumps(record) + '\n')
+            self.lines.flush()
+
+    def close(self):
+        self.sampler.stop()
+        if self.chrome_format:
+            with open(self.trace_file, 'w') as file:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, file)
+        else:
+            self.lines.close()
+        print(f"Wrote stage trace to {self.trace_file}")
+
+def stage_name(func):
+    # Named after the defining file rather than __module__, which is '__main__' for the script being run
+    module = os.path.splitext(os.path.basename(func.__code__.co_filename))[0]
+    return f'{module}.{func.__qualname__}'
+
+def instrumented(func):
+    # Record duration, row and vertex counts and peak memory of every call while a trace is active
+    name = stage_name(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if active_tracer is None:
+            return func(*args, **kwargs)
+        with active_tracer.stage(name, frames_in(list(args) + list(kwargs.values()))) as record:
+            result = func(*args, **kwargs)
+            active_tracer.set_outputs(record, result)
+            return result
+
+    return wrapper
+
+@contextmanager
+def stage(name, inputs=()):
+    # Instrument a block that is not a function of its own; yields the record, or None without a trace
+    if active_tracer is None:
+        yield None
+        return
+    with active_tracer.stage(name, frames_in(list(inputs))) as record:
+        yield record
+
+@contextmanager
+def tracing(trace_file=None, profile_file=None):
+    # Opt-in stage trace and cProfile run; the .prof file opens in snakeviz or converts to a flamegraph
+    global active_tracer
+    profiler = cProfile.Profile() if profile_file else None
+    if trace_file:
+        active_tracer = Tracer(trace_file)
+    if profiler:
+        profiler.enable()
+    try:
+        yield active_tracer
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            print(f"Wrote profile to {profile_file}")
+        if active_tracer is not None:
+            active_tracer.close()
+            active_tracer = None
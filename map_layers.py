@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import geopandas as gpd
+import numpy as np
+import shapely
+import folium
+from branca.element import MacroElement
+from folium.elements import JSCSSMixin
+from jinja2 import Template
+from matplotlib import colormaps
+from matplotlib.colors import to_hex
+from bike_network import PROJECTED_CRS
+
+# Minimum zoom of each simplified copy of the network; the finest copy is used from its zoom onwards
+ZOOM_BANDS = [10, 12, 14, 16]
+
+# Coordinates are rounded to half a screen pixel of each zoom band, which is invisible on the map
+QUANTIZATION_PIXELS = 0.5
+
+# Scores are drawn in this many color steps, so each feature stores a small bin number instead of a style
+N_COLOR_BINS = 16
+
+# Latitude of NYC, where web mercator pixels are this many times smaller than at the equator
+PIXEL_SCALE = np.cos(np.radians(40.7))
+
+def pixel_size_ft(zoom):
+    # Ground size of one web mercator screen pixel around NYC at this zoom level
+    return 156543.03 * PIXEL_SCALE / 2 ** zoom * 3.28084
+
+def simplify_for_zoom(geometries, zoom):
+    # Drop vertices that move the line less than one pixel at this zoom, and lines shorter than a pixel
+    tolerance = pixel_size_ft(zoom)
+    simplified = shapely.simplify(geometries, tolerance, preserve_topology=False)
+    return np.where(shapely.length(simplified) >= tolerance, simplified, None)
+
+def score_bins(scores, n_bins=N_COLOR_BINS):
+    # Equal-width bins over the score range, so the full citywide gradient is used; missing scores get the lowest bin
+    low, high = np.nanmin(scores), np.nanmax(scores)
+    span = high - low if high > low else 1
+    return np.clip(np.nan_to_num((scores - low) / span * n_bins).astype(int), 0, n_bins - 1)
+
+def quantize(coords, bounds, step):
+    # Integer grid positions plus the TopoJSON transform that maps them back to lon/lat
+    minx, miny = bounds[:2]
+    grid = np.round((coords - [minx, miny]) / step).astype(np.int64)
+    return grid, {'scale': [step, step], 'translate': [minx, miny]}
+
+def encode_arcs(grid, part_idx):
+    # Delta-encode each line as a TopoJSON arc, dropping points that round onto the previous one
+    starts = np.r_[True, part_idx[1:] != part_idx[:-1]]
+    deltas = np.where(starts[:, None], grid, np.diff(grid, axis=0, prepend=grid[:1]))
+    keep = starts | (deltas != 0).any(axis=1)
+    deltas, part_idx = deltas[keep], part_idx[keep]
+    boundaries = np.flatnonzero(np.r_[True, part_idx[1:] != part_idx[:-1]])
+    return [arc.tolist() for arc in np.split(deltas, boundaries[1:])]
+
+def band_topology(projected, bins, zoom):
+    # Simplified, quantized TopoJSON of the network for one zoom band, with the score bin of every feature
+    simplified = gpd.GeoSeries(simplify_for_zoom(projected, zoom), crs=PROJECTED_CRS).to_crs('EPSG:4326')
+    parts, feature_idx = shapely.get_parts(np.asarray(simplified.values), return_index=True)
+    coords, part_idx = shapely.get_coordinates(parts, return_index=True)
+
+    # Pixel size in degrees of latitude; longitude degrees are shorter, so rounding is finer than needed there
+    step = pixel_size_ft(zoom) * QUANTIZATION_PIXELS / 364000
+    grid, transform = quantize(coords, simplified.total_bounds, step)
+
+    features, starts = np.unique(feature_idx, return_index=True)
+    geometries = [
+        {'type': 'MultiLineString', 'arcs': [[int(arc)] for arc in feature_arcs], 'properties': {'b': int(bins[feature])}}
+        for feature, feature_arcs in zip(features, np.split(np.arange(len(parts)), starts[1:]))
+    ]
+    return {
+        'type': 'Topology', 'transform': transform,
+        'objects': {'network': {'type': 'GeometryCollection', 'geometries': geometries}},
+        'arcs': encode_arcs(grid, part_idx),
+    }
+
+def network_layers(bike_paths, score_column, zoom_bands=ZOOM_BANDS):
+    # One serialized TopoJSON layer per zoom band, keyed by the band's minimum zoom
+    projected = np.asarray(bike_paths.to_crs(PROJECTED_CRS).geometry.values)
+    bins = score_bins(bike_paths[score_column].to_numpy(dtype=float))
+    return {zoom: json.dumps(band_topology(projected, bins, zoom), separators=(',', ':')) for zoom in zoom_bands}
+
+def color_palette(cmap, n_bins=N_COLOR_BINS):
+    return [to_hex(color) for color in colormaps[cmap](np.linspace(0, 1, n_bins))]
+
+class ZoomBandLayer(JSCSSMixin, MacroElement):
+    # Draws the TopoJSON band whose minimum zoom is the closest one at or below the map's zoom.
+    # Only the coarsest band is embedded in the page; the finer ones are fetched from their files the first
+    # time the map zooms into them, and the finest band loaded so far is drawn until then
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }}_palette = {{ this.palette|tojson }};
+            var {{ this.get_name() }}_style = {style: function(feature) {
+                return {color: {{ this.get_name() }}_palette[feature.properties.b], weight: {{ this.weight }}, opacity: 0.8};
+            }};
+            function {{ this.get_name() }}_layer(topology) {
+                return L.geoJson(topojson.feature(topology, topology.objects.network), {{ this.get_name() }}_style);
+            }
+            var {{ this.get_name() }}_bands = [
+            {%- for zoom, url in this.urls.items() %}
+                {zoom: {{ zoom }}, url: {{ url|tojson }}, layer: null, loading: false},
+            {%- endfor %}
+            ];
+            {{ this.get_name() }}_bands[0].layer = {{ this.get_name() }}_layer({{ this.first_layer }});
+            function {{ this.get_name() }}_update() {
+                var map = {{ this._parent.get_name() }};
+                var zoom = map.getZoom();
+                var wanted = {{ this.get_name() }}_bands[0];
+                var active = wanted.layer;
+                {{ this.get_name() }}_bands.forEach(function(band) {
+                    if (band.zoom <= zoom) {
+                        wanted = band;
+                        if (band.layer) { active = band.layer; }
+                    }
+                });
+                if (!wanted.layer && !wanted.loading) {
+                    wanted.loading = true;
+                    fetch(wanted.url).then(function(response) {
+                        if (!response.ok) { throw new Error(response.status + ' ' + response.statusText); }
+                        return response.json();
+                    }).then(function(topology) {
+                        wanted.layer = {{ this.get_name() }}_layer(topology);
+                        {{ this.get_name() }}_update();
+                    }).catch(function(error) {
+                        console.warn('Could not load ' + wanted.url + ', serve the map folder over HTTP for the detailed bands', error);
+                    });
+                }
+                {{ this.get_name() }}_bands.forEach(function(band) {
+                    if (!band.layer) { return; }
+                    if (band.layer === active) { band.layer.addTo(map); }
+                    else { map.removeLayer(band.layer); }
+                });
+            }
+            {{ this._parent.get_name() }}.on('zoomend', {{ this.get_name() }}_update);
+            {{ this.get_name() }}_update();
+        {% endmacro %}
+    """)
+
+    default_js = [('topojson', 'https://cdnjs.cloudflare.com/ajax/libs/topojson/1.6.9/topojson.min.js')]
+
+    def __init__(self, first_layer, urls, palette, weight=2):
+        super().__init__()
+        self._name = 'ZoomBandLayer'
+        self.first_layer = first_layer
+        self.urls = urls
+        self.palette = palette
+        self.weight = weight
+
+def render_network_map(bike_paths, score_column, map_file, layer_prefix=None, cmap='RdYlGn'):
+    # Full scored network as compact, zoom-banded TopoJSON files next to a folium page that loads them on zoom,
+    # so the page itself only carries the coarsest band
+    layers = network_layers(bike_paths, score_column)
+    layer_prefix = layer_prefix or os.path.splitext(map_file)[0]
+    map_dir = os.path.dirname(os.path.abspath(map_file))
+    urls = {}
+    for zoom, layer in layers.items():
+        layer_file = f'{layer_prefix}_z{zoom}.topojson'
+        with open(layer_file, 'w') as file:
+            file.write(layer)
+        urls[zoom] = os.path.relpath(os.path.abspath(layer_file), map_dir).replace(os.sep, '/')
+
+    m = folium.Map(location=[40.7128, -74.0060], zoom_start=12)  # Centered around New York City
+    ZoomBandLayer(layers[min(layers)], urls, color_palette(cmap)).add_to(m)
+    m.save(map_file)
+    return layers
+
+def main(score_column='tree_density', scored_file='./Bike Lane groupings/scored_bike_paths.parquet', output_dir='./Mapped Results'):
+    try:
+        # Safety scores count against a path, so they are drawn with the palette reversed
+        cmap = 'RdYlGn_r' if 'safety' in score_column else 'RdYlGn'
+        bike_paths = gpd.read_parquet(scored_file)
+
+        print(f"Rendering {len(bike_paths)} bike paths by {score_column}...")
+        map_file = os.path.join(output_dir, f'{score_column}_network_map.html')
+        render_network_map(bike_paths, score_column, map_file, os.path.join(output_dir, f'{score_column}_network'), cmap)
+
+        # Browsers don't let a page opened from disk fetch files, so the finer bands need the folder served
+        print(f"Saved {map_file}; for the detailed zoom bands open it through a local web server, "
+              f"e.g. python -m http.server --directory \"{output_dir}\"")
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the full scored bike network as a lightweight map.")
+    parser.add_argument('--score', default='tree_density', help="Score column to color the network by (default: tree_density)")
+    args = parser.parse_args()
+    main(args.score)
@@ -0,0 +1,153 @@
+import argparse
+import os
+import pandas as pd
+from bike_network import CLUSTERING_METHODS, cluster_bike_paths, prepare_bike_paths, prepare_segments
+from instrumentation import instrumented, tracing
+from scoring_engine import build_path_index, query_points_near_paths, aggregate_by_path
+from segment_scoring import UNIT_LENGTH, pair_segment_points, roll_up, score_segments
+from safety_analysis import (
+    calculate_safety_scores, prepare_crash_points, normalize_scores, get_safe_and_unsafe_clusters,
+    output_cluster_info as output_safety_cluster_info
+)
+from spatial_analysis import canopy_scores, prepare_tree_points, output_cluster_info as output_green_cluster_info
+from stage_cache import StageCache
+from traffic_exposure import exposure_normalized_scores
+
+# Search radii in feet around each path for trees and crashes
+TREE_RADIUS = 100
+CRASH_RADIUS = 50
+
+# Cached pipeline stages, in the order they run
+PIPELINE_STAGES = ['combine', 'segments', 'tree_points', 'crash_points', 'point_pairs', 'segment_pairs']
+
+@instrumented
+def pair_network_points(bike_paths, trees, crashes, tree_radius=TREE_RADIUS, crash_radius=CRASH_RADIUS):
+    # Query trees and crashes against one shared index over the bike path linework
+    path_index = build_path_index(bike_paths)
+    tree_idx, tree_path_idx = query_points_near_paths(path_index, trees.geometry.values, tree_radius)
+    crash_idx, crash_path_idx = query_points_near_paths(path_index, crashes.geometry.values, crash_radius)
+    return {
+        'trees': pd.DataFrame({'point_idx': tree_idx, 'path_idx': tree_path_idx}),
+        'crashes': pd.DataFrame({'point_idx': crash_idx, 'path_idx': crash_path_idx}),
+    }
+
+@instrumented
+def score_network(bike_paths, trees, crashes, point_pairs):
+    # Compute every score as a column of the same result table
+    n_paths = len(bike_paths)
+    tree_pairs, crash_pairs = point_pairs['trees'], point_pairs['crashes']
+
+    bike_paths['tree_density'] = aggregate_by_path(tree_pairs['point_idx'].to_numpy(), tree_pairs['path_idx'].to_numpy(), n_paths)
+    bike_paths['canopy_score'] = canopy_scores(tree_pairs, trees, n_paths)
+    bike_paths['safety_score'] = aggregate_by_path(
+        crash_pairs['point_idx'].to_numpy(), crash_pairs['path_idx'].to_numpy(), n_paths, crashes['safety_score'].to_numpy()
+    )
+    if 'vehicle_exposure' in bike_paths.columns:
+        bike_paths['safety_per_exposure'] = exposure_normalized_scores(bike_paths)
+    return normalize_scores(bike_paths)
+
+@instrumented
+def output_scored_network(bike_paths, filename):
+    # Output the full scored network as a single GeoParquet table
+    bike_paths.to_parquet(filename)
+
+def main(n_clusters=200, clustering='kmeans', warm_start_file=None, use_cache=True, rebuild_from=None,
+         bike_path_file='processed_bike_paths.geojson', tree_data_file='processed_tree_data.parquet',
+         crash_data_file='cleaned_motor_vehicle_collisions.parquet', traffic_file='aggregated_traffic_volume_counts.parquet',
+         output_dir='./Bike Lane groupings', kde=False, segments=False, roll_up_columns=()):
+    try:
+        if roll_up_columns and not segments:
+            raise ValueError("Roll-ups sum segment scores, they need segments=True")
+
+        # Traffic counts are optional; without them the exposure-normalized score is left out
+        traffic_file = traffic_file if traffic_file and os.path.exists(traffic_file) else None
+        cache = StageCache(enabled=use_cache, rebuild_from=rebuild_from, stage_order=PIPELINE_STAGES)
+        network_files = [bike_path_file] + ([traffic_file] if traffic_file else [])
+
+        if segments:
+            # Score every original segment; clusters, if asked for, are only a roll-up of the segment scores
+            print("Loading bike path segments...")
+            bike_paths = cache.run('segments', prepare_segments, bike_path_file, traffic_file=traffic_file, input_files=network_files)
+            if 'cluster' in roll_up_columns:
+                bike_paths = cluster_bike_paths(bike_paths, n_clusters=n_clusters, method=clustering)
+
+            # Checked before any scoring, so a typo doesn't surface only after the scored network was written
+            missing = [column for column in roll_up_columns if column not in bike_paths.columns]
+            if missing:
+                raise ValueError(f"Cannot roll up by {', '.join(missing)}: no such segment column "
+                                 f"(available: {', '.join(col for col in bike_paths.columns if col != 'geometry')})")
+        else:
+            # Load, cluster, combine and project the bike network once for both scores
+            print("Loading, clustering and combining bike paths...")
+            bike_paths = cache.run('combine', prepare_bike_paths, bike_path_file, n_clusters=n_clusters, method=clustering,
+                                   warm_start_file=warm_start_file, traffic_file=traffic_file, input_files=network_files)
+
+        # Load the tree and crash points in the same projected CRS
+        print("Loading tree data...")
+        trees = cache.run('tree_points', prepare_tree_points, tree_data_file, input_files=[tree_data_file])
+        print("Creating crash points...")
+        crashes = cache.run('crash_points', prepare_crash_points, crash_data_file, input_files=[crash_data_file])
+        crashes = calculate_safety_scores(crashes)
+
+        if segments:
+            # Many more points than segments, so the points are indexed and queried with chunks of segments in parallel
+            print(f"Matching trees and crashes to {len(bike_paths)} bike path segments...")
+            point_pairs = cache.run('segment_pairs', pair_segment_points, bike_paths, trees, crashes,
+                                    tree_radius=TREE_RADIUS, crash_radius=CRASH_RADIUS,
+                                    depends_on=['segments', 'tree_points', 'crash_points'])
+            print(f"Scoring bike path segments per {UNIT_LENGTH} ft...")
+            scored_bike_paths = score_segments(bike_paths, trees, crashes, point_pairs)
+        else:
+            # Match trees and crashes to the bike paths in a single pass over the shared index
+            print("Matching trees and crashes to bike paths...")
+            point_pairs = cache.run('point_pairs', pair_network_points, bike_paths, trees, crashes,
+                                    tree_radius=TREE_RADIUS, crash_radius=CRASH_RADIUS,
+                                    depends_on=['combine', 'tree_points', 'crash_points'])
+            print("Scoring bike paths...")
+            scored_bike_paths = score_network(bike_paths, trees, crashes, point_pairs)
+
+        # Crash exposure from the smoothed crash surface, next to the buffer-based safety score
+        if kde:
+            from crash_density import crash_density_surface
+            print("Sampling the crash density raster along bike paths...")
+            density = crash_density_surface(crashes, os.path.join(output_dir, 'crash_density.npy'))
+            scored_bike_paths['crash_density'] = density.path_scores(scored_bike_paths)
+        scored_bike_paths = scored_bike_paths.to_crs('EPSG:4326')
+        output_scored_network(scored_bike_paths, os.path.join(output_dir, 'scored_bike_paths.parquet'))
+
+        # Groupings of the segments, each scored from the summed totals of its segments
+        for column in roll_up_columns:
+            print(f"Rolling up segment scores by {column}...")
+            output_scored_network(roll_up(scored_bike_paths, column),
+                                  os.path.join(output_dir, f"scored_by_{column.lower().replace(' ', '_')}.parquet"))
+
+        # The green and safe rankings now refer to the same combined segments
+        output_green_cluster_info(scored_bike_paths, output_dir=output_dir)
+        print("Outputting safety cluster information for Google Maps...")
+        safest_clusters, least_safe_clusters = get_safe_and_unsafe_clusters(scored_bike_paths)
+        output_safety_cluster_info(safest_clusters, os.path.join(output_dir, 'most_safe_clusters.geojson'))
+        output_safety_cluster_info(least_safe_clusters, os.path.join(output_dir, 'least_safe_clusters.geojson'))
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score bike paths for greenery and safety in a single pass.")
+    parser.add_argument('--clusters', type=int, default=200, help="Number of bike path clusters to score (default: 200)")
+    parser.add_argument('--clustering', choices=CLUSTERING_METHODS, default='kmeans', help="Clustering backend (default: kmeans)")
+    parser.add_argument('--warm-start', metavar='FILE', help="Start clustering from the centers saved in FILE (.npy) and update them")
+    parser.add_argument('--kde', action='store_true', help="Also score crash exposure from a crash kernel density raster")
+    parser.add_argument('--segments', action='store_true', help=f"Score every bike path segment per {UNIT_LENGTH} ft instead of clusters")
+    parser.add_argument('--roll-up', nargs='+', default=[], metavar='COLUMN',
+                        help="With --segments, also write the segment scores summed up by each COLUMN, e.g. Borough or cluster")
+    parser.add_argument('--no-cache', action='store_true', help="Recompute every stage without reading or writing the stage cache")
+    parser.add_argument('--rebuild-from', choices=PIPELINE_STAGES, help="Recompute this stage and every stage after it")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="Record per-stage time, rows, vertices and peak memory; FILE.json opens in a Chrome trace viewer, other names get JSON lines")
+    parser.add_argument('--profile', metavar='FILE', help="Also run under cProfile and write the stats to FILE (.prof)")
+    args = parser.parse_args()
+    if args.roll_up and not args.segments:
+        parser.error("--roll-up requires --segments")
+    with tracing(args.trace, args.profile):
+        main(n_clusters=args.clusters, clustering=args.clustering, warm_start_file=args.warm_start, use_cache=not args.no_cache, rebuild_from=args.rebuild_from,
+             kde=args.kde, segments=args.segments, roll_up_columns=args.roll_up)
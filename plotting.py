@@ -0,0 +1,17 @@
+import os
+
+def new_figure(figsize=(10, 10)):
+    # pyplot is imported on first use, so runs that skip plotting never load matplotlib
+    import matplotlib.pyplot as plt
+    return plt.subplots(figsize=figsize)
+
+def finish_figure(fig, output_file=None, show=True):
+    # Write the figure to a file in batch runs, otherwise show it in a window
+    import matplotlib.pyplot as plt
+    if output_file:
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        fig.savefig(output_file, dpi=150, bbox_inches='tight')
+        print(f"Saved plot to {output_file}")
+    elif show:
+        plt.show()
+    plt.close(fig)
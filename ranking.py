@@ -0,0 +1,125 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+SCORED_NETWORK_FILE = './Bike Lane groupings/scored_bike_paths.parquet'
+
+# Identifying columns kept in ranking outputs next to the score; anything else (intermediate columns) is left out
+ID_COLUMNS = ['segment_id', 'cluster', 'Street Name', 'Borough']
+
+# Output names of the rankings per score column, matching the existing most_/least_*_clusters files
+RANKING_NAMES = {
+    'tree_density': 'green', 'canopy_score': 'green',
+    'safety_score': 'safe', 'normalized_safety_score': 'safe', 'safety_per_exposure': 'safe', 'crash_density': 'safe',
+}
+
+# Default percentile band edges: bottom decile, lower quartile, middle, upper quartile, top decile
+BAND_QUANTILES = [0.1, 0.25, 0.75, 0.9]
+
+def top_k(values, k, largest=True):
+    # Positions of the k largest (or smallest) values, most extreme first; NaN scores are never ranked
+    values = np.asarray(values, dtype=float)
+    candidates = np.flatnonzero(~np.isnan(values))
+    keys = -values[candidates] if largest else values[candidates]
+    k = min(k, len(candidates))
+    if k == 0:
+        return candidates[:0]
+
+    # argpartition selects the k in linear time; only those k are then sorted
+    selected = np.argpartition(keys, k - 1)[:k] if k < len(candidates) else np.arange(len(candidates))
+    return candidates[selected[np.argsort(keys[selected], kind='stable')]]
+
+def top_k_by_group(values, groups, k, largest=True):
+    # Top k positions within every group, with each row's rank in its group (1 = most extreme)
+    codes, labels = pd.factorize(pd.Series(groups), use_na_sentinel=True)
+    order = np.argsort(codes, kind='stable')
+    starts = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+
+    positions, ranks = [], []
+    for group in range(len(labels)):
+        members = order[starts[group]:starts[group + 1]]
+        selected = members[top_k(np.asarray(values, dtype=float)[members], k, largest)]
+        positions.append(selected)
+        ranks.append(np.arange(1, len(selected) + 1))
+    if not positions:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    return np.concatenate(positions), np.concatenate(ranks)
+
+def assign_bands(values, quantiles=BAND_QUANTILES):
+    # Percentile band of every value in one pass: quantile edges by selection, then a binary search per row
+    values = np.asarray(values, dtype=float)
+    edges = np.nanquantile(values, quantiles) if np.isfinite(values).any() else np.full(len(quantiles), np.nan)
+    bands = np.searchsorted(edges, values, side='right')
+    return np.where(np.isnan(values), -1, bands), edges
+
+def band_labels(quantiles=BAND_QUANTILES):
+    # "p0-p10", "p10-p25", ... for each band between consecutive edges
+    bounds = [0, *[round(q * 100) for q in quantiles], 100]
+    return [f'p{low}-p{high}' for low, high in zip(bounds[:-1], bounds[1:])]
+
+def ranking_columns(bike_paths, score_columns):
+    # Only the identifying columns, the scores and the geometry go into a ranking output
+    columns = [col for col in ID_COLUMNS if col in bike_paths.columns] + list(score_columns) + [bike_paths.geometry.name]
+    return list(dict.fromkeys(columns))
+
+def write_ranking(frame, filename):
+    # GeoParquet for .parquet files, GeoJSON otherwise
+    if filename.endswith('.parquet'):
+        frame.to_parquet(filename)
+    else:
+        frame.to_file(filename, driver='GeoJSON')
+
+def rank_network(bike_paths, score_column, output_dir, name, k=5, quantiles=None, group_column=None, higher_is_better=True, file_format='geojson'):
+    # Write the best and worst k paths, and optionally percentile bands and per-group top k, from one scored table
+    columns = ranking_columns(bike_paths, [score_column])
+    values = bike_paths[score_column].to_numpy(dtype=float)
+    outputs = {
+        f'most_{name}_clusters': bike_paths.iloc[top_k(values, k, largest=higher_is_better)][columns],
+        f'least_{name}_clusters': bike_paths.iloc[top_k(values, k, largest=not higher_is_better)][columns],
+    }
+
+    if quantiles:
+        bands, edges = assign_bands(values, quantiles)
+        labels = np.array(band_labels(quantiles) + [None], dtype=object)
+        banded = bike_paths[columns].copy()
+        banded['band'] = labels[bands]
+        outputs[f'{name}_bands'] = banded[bands >= 0]
+        print(f"{score_column} band edges at {', '.join(f'{q:g}' for q in quantiles)}: {np.round(edges, 3).tolist()}")
+
+    if group_column:
+        positions, ranks = top_k_by_group(values, bike_paths[group_column].to_numpy(), k, largest=higher_is_better)
+        grouped = bike_paths.iloc[positions][ranking_columns(bike_paths, [group_column, score_column])].copy()
+        grouped['rank'] = ranks
+        outputs[f'most_{name}_by_{group_column.lower()}'] = grouped
+
+    extension = 'parquet' if file_format == 'parquet' else 'geojson'
+    for output_name, frame in outputs.items():
+        write_ranking(frame, os.path.join(output_dir, f'{output_name}.{extension}'))
+    return outputs
+
+def main(score_column='tree_density', k=5, quantiles=None, group_column=None, scored_file=SCORED_NETWORK_FILE,
+         output_dir='./Bike Lane groupings', file_format='geojson'):
+    try:
+        import geopandas as gpd
+
+        bike_paths = gpd.read_parquet(scored_file)
+        # Safety scores count against a path, so the best paths are the ones with the lowest score
+        name = RANKING_NAMES.get(score_column, score_column)
+        higher_is_better = name != 'safe' and 'safety' not in score_column
+        print(f"Ranking {len(bike_paths)} bike paths by {score_column}...")
+        rank_network(bike_paths, score_column, output_dir, name, k, quantiles, group_column, higher_is_better, file_format)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Top-k, percentile band and per-group rankings of the scored bike network.")
+    parser.add_argument('--score', default='tree_density', help="Score column to rank by (default: tree_density)")
+    parser.add_argument('-k', type=int, default=5, help="Number of best and worst paths to output (default: 5)")
+    parser.add_argument('--bands', nargs='*', type=float, metavar='QUANTILE',
+                        help=f"Also output percentile bands split at these quantiles (default: {BAND_QUANTILES})")
+    parser.add_argument('--group-by', metavar='COLUMN', help="Also output the top k within each value of COLUMN, e.g. Borough")
+    parser.add_argument('--format', choices=['geojson', 'parquet'], default='geojson', help="Output file format (default: geojson)")
+    args = parser.parse_args()
+    main(args.score, args.k, BAND_QUANTILES if args.bands == [] else args.bands, args.group_by, file_format=args.format)
@@ -0,0 +1,495 @@
+import argparse
+import heapq
+import os
+import sys
+import tempfile
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import Point
+from benchmark import PREPROCESSING_DIR, generate_inputs
+from bike_network import NYC_BOUNDS, PROJECTED_CRS
+
+# Small fixture built with the benchmark generators, so every check runs in seconds on a laptop
+N_POINTS = 5_000
+
+# Buffer polygons approximate the circle with 16 segments per quarter, which puts their edge up to 0.12% of the radius
+# inside it; points closer than this share of the radius to the edge can land on either side and are left out
+BUFFER_TOLERANCE = 0.002
+
+class CheckFailed(Exception):
+    pass
+
+def check(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+
+def build_fixture(workdir, n_points=N_POINTS, seed=0):
+    # Raw synthetic inputs run through the real preprocessing, then loaded the way the pipelines load them
+    sys.path.insert(0, PREPROCESSING_DIR)
+    from bike_routes_preprocessing import preprocess_bike_routes
+    from collisions_preprocessing import preprocess_collisions
+    from tree_data_preprocessing import preprocess_trees
+    from bike_network import prepare_bike_paths, prepare_segments
+    from safety_analysis import calculate_safety_scores, prepare_crash_points
+    from spatial_analysis import prepare_tree_points
+
+    generate_inputs(n_points, workdir, seed)
+    bike_path_file = os.path.join(workdir, 'processed_bike_paths.geojson')
+    crash_data_file = os.path.join(workdir, 'cleaned_motor_vehicle_collisions.parquet')
+    tree_data_file = os.path.join(workdir, 'processed_tree_data.parquet')
+    preprocess_bike_routes(os.path.join(workdir, 'NYC Bike Routes.geojson'), bike_path_file)
+    preprocess_collisions(os.path.join(workdir, 'Motor_Vehicle_Collisions.csv'), crash_data_file)
+    preprocess_trees(os.path.join(workdir, 'Tree Data.geojson'), tree_data_file)
+
+    return {
+        'workdir': workdir,
+        'bike_path_file': bike_path_file,
+        'crash_data_file': crash_data_file,
+        'bike_paths': prepare_bike_paths(bike_path_file, n_clusters=50, method='grid'),
+        'segments': prepare_segments(bike_path_file),
+        'trees': prepare_tree_points(tree_data_file),
+        'crashes': calculate_safety_scores(prepare_crash_points(crash_data_file)),
+    }
+
+def clear_of_buffer_edges(bike_paths, points, radius):
+    # Points that are not within the buffer approximation tolerance of the radius from any path
+    from scoring_engine import build_path_index, query_points_near_paths
+
+    tolerance = BUFFER_TOLERANCE * radius
+    point_geoms, path_geoms = np.asarray(points.geometry.values), np.asarray(bike_paths.geometry.values)
+    point_idx, path_idx = query_points_near_paths(build_path_index(bike_paths), point_geoms, radius + tolerance)
+    distances = shapely.distance(point_geoms[point_idx], path_geoms[path_idx])
+    near_edge = np.zeros(len(points), dtype=bool)
+    near_edge[point_idx[np.abs(distances - radius) <= tolerance]] = True
+    return points[~near_edge].reset_index(drop=True)
+
+def buffer_join_scores(bike_paths, points, radius, weight_column=None):
+    # The scoring before the STRtree engine: buffer polygons around every path and a 'within' spatial join.
+    # Grouped by the matched path, which is what the per-path scores were meant to be
+    buffers = gpd.GeoDataFrame(geometry=bike_paths.geometry.buffer(radius), crs=bike_paths.crs)
+    joined = gpd.sjoin(points, buffers, how='inner', predicate='within')
+    grouped = joined.groupby('index_right')
+    totals = grouped.size() if weight_column is None else grouped[weight_column].sum()
+    return totals.reindex(bike_paths.index, fill_value=0).to_numpy()
+
+def check_path_scores(fixture):
+    # user-001: tree counts and crash score sums per path from the STRtree engine match the buffer join
+    from scoring_engine import score_points_near_paths
+
+    bike_paths = fixture['bike_paths']
+    for name, points, radius, weight_column in [('trees', fixture['trees'], 100, None),
+                                                ('crashes', fixture['crashes'], 50, 'safety_score')]:
+        points = clear_of_buffer_edges(bike_paths, points, radius)
+        expected = buffer_join_scores(bike_paths, points, radius, weight_column)
+        actual = score_points_near_paths(bike_paths, points, radius, weight_column).to_numpy()
+        check(np.array_equal(actual, expected),
+              f"{name}: {(actual != expected).sum()} of {len(bike_paths)} paths differ from the buffer join")
+        check(expected.sum() > 0, f"{name}: the fixture matched no points, nothing was compared")
+    return f"{len(bike_paths)} combined paths, trees at 100 ft and crashes at 50 ft"
+
+def check_segment_pairs(fixture):
+    # user-025: pairs from the point index queried with chunks of segments on threads match the path index query
+    from scoring_engine import build_path_index, build_point_index, query_paths_near_points, query_points_near_paths
+
+    segments, trees = fixture['segments'], fixture['trees']
+    expected = query_points_near_paths(build_path_index(segments), trees.geometry.values, 100)
+    actual = query_paths_near_points(build_point_index(trees), segments.geometry.values, 100, n_jobs=4, chunk_size=64)
+    expected, actual = np.sort(np.column_stack(expected), axis=0), np.sort(np.column_stack(actual), axis=0)
+    check(np.array_equal(np.unique(actual, axis=0), np.unique(expected, axis=0)) and len(actual) == len(expected),
+          f"{len(actual)} pairs from the threaded segment query, {len(expected)} from the path index query")
+    return f"{len(expected)} tree-segment pairs"
+
+def check_radius_sweep(fixture):
+    # user-002: every radius of the single-pass sweep matches a separate run at that radius
+    from scoring_engine import score_points_multi_radius, score_points_near_paths
+
+    bike_paths, crashes, radii = fixture['bike_paths'], fixture['crashes'], [25, 50, 100, 200]
+    for weight_column in (None, 'safety_score'):
+        sweep = score_points_multi_radius(bike_paths, crashes, radii, weight_column)
+        for radius, column in zip(radii, sweep.columns):
+            expected = score_points_near_paths(bike_paths, crashes, radius, weight_column).to_numpy()
+            check(np.allclose(sweep[column].to_numpy(), expected),
+                  f"{column} ({weight_column or 'count'}) differs from a single run at {radius} ft")
+    return f"radii {radii}, counts and crash scores"
+
+def check_crash_points(fixture):
+    # user-019: vectorized crash points match one Point per crash reprojected with to_crs, with (0, 0) and
+    # out-of-city coordinates dropped
+    from columnar_io import read_collisions
+    from safety_analysis import create_crash_points
+
+    crashes = read_collisions(fixture['crash_data_file'])
+    crashes = pd.concat([crashes, crashes.iloc[:3].assign(LATITUDE=[0.0, 40.7, 45.0], LONGITUDE=[0.0, -80.0, -74.0])],
+                        ignore_index=True)
+    min_lon, min_lat, max_lon, max_lat = NYC_BOUNDS
+    in_city = crashes['LONGITUDE'].between(min_lon, max_lon) & crashes['LATITUDE'].between(min_lat, max_lat)
+    expected = crashes[in_city]
+    expected = gpd.GeoDataFrame(expected, geometry=[Point(xy) for xy in zip(expected['LONGITUDE'], expected['LATITUDE'])],
+                                crs='EPSG:4326').to_crs(PROJECTED_CRS)
+
+    actual = create_crash_points(crashes)
+    check(actual.index.equals(expected.index), f"kept {len(actual)} crashes, the baseline kept {len(expected)}")
+    offset = np.hypot(actual.geometry.x.to_numpy() - expected.geometry.x.to_numpy(), actual.geometry.y.to_numpy() - expected.geometry.y.to_numpy())
+    check(offset.max() < 1e-6, f"points are up to {offset.max():.3g} ft from the reprojected baseline")
+    return f"{len(actual)} crashes kept, {len(crashes) - len(actual)} dropped"
+
+def heap_dijkstra(n_nodes, edge_u, edge_v, weights, source):
+    # Textbook Dijkstra over the edge list, independent of the CSR matrix and scipy
+    neighbors = [[] for _ in range(n_nodes)]
+    for u, v, weight in zip(edge_u.tolist(), edge_v.tolist(), weights.tolist()):
+        neighbors[u].append((v, weight))
+        neighbors[v].append((u, weight))
+    distances = np.full(n_nodes, np.inf)
+    distances[source] = 0.0
+    queue = [(0.0, source)]
+    while queue:
+        distance, node = heapq.heappop(queue)
+        if distance > distances[node]:
+            continue
+        for neighbor, weight in neighbors[node]:
+            if distance + weight < distances[neighbor]:
+                distances[neighbor] = distance + weight
+                heapq.heappush(queue, (distance + weight, neighbor))
+    return distances
+
+def check_routes(fixture, n_pairs=30, seed=0):
+    # user-009/010: single routes and the cost matrix have the costs of a plain Dijkstra, and every route
+    # is a chain of edges whose weights add up to its cost
+    from routing import build_route_graph, load_route_graph, route_cost_matrix, save_route_graph, shortest_route
+
+    built = build_route_graph(fixture['segments'], fixture['trees'], fixture['crashes'])
+    graph_dir = os.path.join(fixture['workdir'], 'route_graph')
+    save_route_graph(built, graph_dir)
+    loaded = load_route_graph(graph_dir)
+    check(isinstance(loaded.edge_length, np.memmap), "the saved route graph was not memory-mapped on load")
+
+    pairs = np.random.default_rng(seed).integers(0, len(built.node_xy), (n_pairs, 2))
+    for graph, (green_weight, safety_weight) in [(built, (0.0, 0.0)), (built, (1.0, 1.0)), (built, (4.0, 0.5)),
+                                                 (loaded, (1.0, 1.0)), (loaded, (4.0, 0.5))]:
+        weights = graph.edge_weights(green_weight, safety_weight)
+        expected = np.array([heap_dijkstra(len(graph.node_xy), graph.edge_u, graph.edge_v, weights, origin) for origin in pairs[:, 0]])
+        costs = route_cost_matrix(graph, pairs[:, 0], pairs[:, 1], green_weight, safety_weight)
+        check(np.allclose(costs, expected[:, pairs[:, 1]]), f"cost matrix differs from Dijkstra at weights {green_weight}, {safety_weight}")
+
+        for (origin, destination), distances in zip(pairs, expected):
+            route = shortest_route(graph, origin, destination, green_weight, safety_weight)
+            check(route is not None and np.isclose(route['cost'], distances[destination]),
+                  f"route {origin}-{destination} costs {route and route['cost']}, Dijkstra {distances[destination]}")
+            ends = [{int(u), int(v)} for u, v in zip(graph.edge_u[route['edges']], graph.edge_v[route['edges']])]
+            steps = [{int(u), int(v)} for u, v in zip(route['nodes'][:-1], route['nodes'][1:])]
+            check(ends == steps and np.isclose(weights[route['edges']].sum(), route['cost']),
+                  f"route {origin}-{destination} is not a chain of edges adding up to its cost")
+    return f"{n_pairs} pairs at 3 weightings on {len(built.edge_u)} edges, built and loaded from disk"
+
+def check_roll_up(fixture):
+    # user-025: rolled-up totals add up to the segment totals, and group scores are the length-weighted
+    # means of their segments' scores
+    from segment_scoring import TOTAL_COLUMNS, pair_segment_points, roll_up, score_segments
+
+    segments, trees, crashes = fixture['segments'].copy(), fixture['trees'], fixture['crashes']
+    scored = score_segments(segments, trees, crashes, pair_segment_points(segments, trees, crashes, 100, 50))
+    scored['Lanes'] = scored['Lane Count'].astype(str)
+    for by in (['Borough'], ['Borough', 'Lanes']):
+        groups = roll_up(scored, by)
+        expected = scored.groupby(by)[TOTAL_COLUMNS].sum().reset_index()
+        merged = groups.merge(expected, on=by, suffixes=('', '_expected'))
+        check(len(merged) == len(expected) == len(groups), f"{by}: {len(groups)} groups, expected {len(expected)}")
+        for col in TOTAL_COLUMNS:
+            check(np.allclose(merged[col], merged[f'{col}_expected']), f"{by}: {col} totals differ from the segment sums")
+            check(np.isclose(groups[col].sum(), scored[col].sum()), f"{by}: {col} total changed in the roll-up")
+        check(groups['segments'].sum() == len(scored), f"{by}: segments lost in the roll-up")
+
+        weighted = scored.assign(weighted=scored['safety_score'] * scored['length_ft']).groupby(by)[['weighted', 'length_ft']].sum()
+        means = (weighted['weighted'] / weighted['length_ft']).rename('mean').reset_index()
+        merged = groups.merge(means, on=by)
+        check(np.allclose(merged['safety_score'], merged['mean']), f"{by}: safety_score is not the length-weighted segment mean")
+    return f"{len(scored)} segments by Borough and by Borough and lane count"
+
+def check_window_scores(fixture):
+    # user-011: scores from the crash-to-path table over hour, weekday and date windows match scoring only
+    # the crashes that a plain filter on their datetimes keeps
+    from crash_index import build_crash_path_table, query_safety_scores
+    from scoring_engine import score_points_near_paths
+
+    bike_paths, crashes = fixture['bike_paths'], fixture['crashes']
+    table = build_crash_path_table(bike_paths, crashes, buffer_radius=50)
+    times = crashes['CRASH DATETIME']
+    start, end = times.quantile(0.25), times.quantile(0.75)
+    windows = [
+        ('all crashes', {}),
+        ('evening rush', {'hours': range(17, 22)}),
+        ('around midnight', {'hours': [22, 23, 0, 1]}),
+        ('weekends', {'weekdays': [5, 6]}),
+        ('date range', {'start': start, 'end': end}),
+        ('open start', {'end': end}),
+        ('weekday mornings in range', {'hours': range(6, 10), 'weekdays': range(5), 'start': start, 'end': end}),
+    ]
+    for name, window in windows:
+        kept = np.ones(len(crashes), dtype=bool)
+        if 'hours' in window:
+            kept &= times.dt.hour.isin(window['hours']).to_numpy()
+        if 'weekdays' in window:
+            kept &= times.dt.weekday.isin(window['weekdays']).to_numpy()
+        if 'start' in window:
+            kept &= (times.dt.normalize() >= window['start'].normalize()).to_numpy()
+        if 'end' in window:
+            kept &= (times.dt.normalize() <= window['end'].normalize()).to_numpy()
+        expected = score_points_near_paths(bike_paths, crashes[kept], 50, 'safety_score').to_numpy()
+        actual = query_safety_scores(table, len(bike_paths), **window).to_numpy()
+        check(np.allclose(actual, expected), f"{name}: {(~np.isclose(actual, expected)).sum()} paths differ from scoring the filtered crashes")
+        check(name == 'all crashes' or 0 < kept.sum() < len(crashes), f"{name}: the window kept {kept.sum()} crashes, nothing was filtered")
+    return f"{len(windows)} windows over {len(table)} crash-path pairs"
+
+def check_traffic_chunks(fixture, chunk_size=97, seed=0):
+    # user-013: traffic counts aggregated chunk by chunk match one groupby over the whole file, with
+    # segments spread over many chunks, missing counts and dates that don't parse
+    from traffic_volume_preprocessing import DATE_FORMAT, hour_columns, key_columns, preprocess_traffic_counts
+
+    workdir = os.path.join(fixture['workdir'], 'traffic')
+    os.makedirs(workdir)
+    raw = pd.read_csv(os.path.join(fixture['workdir'], 'Traffic_Volume_Counts.csv'))
+    rng = np.random.default_rng(seed)
+    bad_dates = rng.random(len(raw)) < 0.02
+    raw.loc[bad_dates, 'Date'] = rng.choice(['2015-03-04', 'n/a', '13/45/2016'], bad_dates.sum()).tolist()
+    raw.loc[rng.random(len(raw)) < 0.02, hour_columns[8]] = np.nan
+    input_file = os.path.join(workdir, 'Traffic_Volume_Counts.csv')
+    raw.to_csv(input_file, index=False)
+
+    raw['Date'] = pd.to_datetime(raw['Date'], format=DATE_FORMAT, errors='coerce')
+    grouped = raw.groupby(key_columns)
+    expected = grouped[hour_columns].sum().add_suffix(' sum')
+    expected['Number of Days Measured'] = grouped['Date'].count()
+    expected['Last Day of Count'] = grouped['Date'].max()
+
+    actual = preprocess_traffic_counts(input_file, os.path.join(workdir, 'aggregated.parquet'), chunk_size=chunk_size)
+    actual = actual.astype({col: str for col in key_columns}).set_index(key_columns).reindex(expected.index)
+    check(len(actual) == len(expected) and actual.index.equals(expected.index) and not actual.isna().all(axis=1).any(),
+          f"{len(actual)} segments from the chunks, {len(expected)} from one groupby")
+    for col in expected.columns:
+        check(actual[col].equals(expected[col].astype(actual[col].dtype)) if col == 'Last Day of Count'
+              else np.array_equal(actual[col].to_numpy(), expected[col].to_numpy()),
+              f"{col} differs from one groupby for {(actual[col] != expected[col]).sum()} segments")
+    return f"{len(raw)} rows in {-(-len(raw) // chunk_size)} chunks, {len(expected)} segments"
+
+def write_quoted_csv(file_path, n_rows, n_fields, seed=0):
+    # Records with quoted commas, escaped quotes and line breaks inside fields, CRLF endings, a blank line,
+    # and a few records with a field too many or too few
+    import csv
+
+    rng = np.random.default_rng(seed)
+    values = ['plain', 'with, comma', 'say "hi"', 'two\nlines', 'three\nline,\n"field"', '']
+    with open(file_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow([f'column {i}' for i in range(n_fields)])
+        for row in range(n_rows):
+            n_row_fields = n_fields + int(rng.choice([-1, 1])) if rng.random() < 0.03 else n_fields
+            writer.writerow([values[i] for i in rng.integers(0, len(values), n_row_fields)])
+            if row == n_rows // 2:
+                file.write('\r\n')
+
+def check_validate_csv(fixture, n_rows=3_000, n_fields=5):
+    # user-023: quote-aware validation rejects the records csv.reader reads with the wrong field count, the same
+    # when scanned in one process, in small blocks and split over processes at offsets inside quoted fields
+    import csv
+    import helper_functions
+    from helper_functions import scan_range, validate_csv
+
+    file_path = os.path.join(fixture['workdir'], 'quoted.csv')
+    write_quoted_csv(file_path, n_rows, n_fields)
+    with open(file_path, newline='') as file:
+        rows = list(csv.reader(file))
+    expected = [index for index, row in enumerate(rows) if index > 0 and row and len(row) != n_fields]
+
+    serial, summary = validate_csv(file_path)
+    with open(file_path, 'rb') as file:
+        data_start = len(file.readline())
+    n_records, _, rejected = scan_range(file_path, data_start, os.path.getsize(file_path), n_fields, block_size=256)
+    blocks = [1 + record for record, *_ in rejected]
+    parallel_min_bytes = helper_functions.PARALLEL_MIN_BYTES
+    helper_functions.PARALLEL_MIN_BYTES = 0
+    try:
+        parallel, _ = validate_csv(file_path, n_jobs=7)
+    finally:
+        helper_functions.PARALLEL_MIN_BYTES = parallel_min_bytes
+
+    check(summary['records'] == n_records == len(rows) - 1, f"{summary['records']} records scanned, csv.reader read {len(rows) - 1}")
+    for name, actual in [('one process', serial), ('small blocks', blocks), ('7 processes', parallel)]:
+        check(actual == expected, f"{name}: rejected {len(actual)} records, csv.reader reads {len(expected)} with the wrong "
+                                  f"field count, {len(set(actual) ^ set(expected))} differ")
+    return f"{len(rows) - 1} records over {summary['lines']} lines, {len(expected)} rejected"
+
+def write_collisions(crashes, output_dir):
+    # Cleaned crashes as a year-partitioned dataset, the layout collisions_preprocessing writes
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    crashes = crashes.assign(**{'CRASH YEAR': crashes['CRASH DATETIME'].dt.year.astype('int16')})
+    pq.write_to_dataset(pa.Table.from_pandas(crashes, preserve_index=False), root_path=output_dir, partition_cols=['CRASH YEAR'])
+    return output_dir
+
+def score_state(state_dir):
+    from incremental_safety import load_score_state
+
+    bike_paths, state = load_score_state(state_dir)
+    return bike_paths['safety_score'].to_numpy(), state
+
+def check_incremental_update(fixture, seed=0):
+    # user-004: an update scores late and new crashes exactly once. It matches a full run on all crashes,
+    # an update without new data changes nothing, and a lookback longer than the stored one is refused
+    import shutil
+    from columnar_io import read_collisions
+    from incremental_safety import initialize_score_state, update_safety_scores
+
+    workdir = os.path.join(fixture['workdir'], 'incremental')
+    crashes = read_collisions(fixture['crash_data_file'])
+    cutoff = crashes['CRASH DATETIME'].quantile(0.8)
+    late = (crashes['CRASH DATETIME'] <= cutoff) & (crashes['CRASH DATETIME'] > cutoff - pd.Timedelta(days=20))
+    late &= np.random.default_rng(seed).random(len(crashes)) < 0.5
+    published = write_collisions(crashes[(crashes['CRASH DATETIME'] <= cutoff) & ~late], os.path.join(workdir, 'published.parquet'))
+    everything = write_collisions(crashes, os.path.join(workdir, 'everything.parquet'))
+
+    state_dir, full_dir = os.path.join(workdir, 'state'), os.path.join(workdir, 'full')
+    initialize_score_state(fixture['bike_path_file'], published, state_dir, clustering='grid')
+    before, _ = score_state(state_dir)
+    update_safety_scores(published, state_dir)
+    unchanged, _ = score_state(state_dir)
+    check(np.array_equal(before, unchanged), "an update without new crashes changed the scores")
+
+    try:
+        update_safety_scores(published, state_dir, lookback_days=365)
+        check(False, "an update with a longer lookback than the state keeps was accepted")
+    except ValueError:
+        pass
+    check(np.array_equal(before, score_state(state_dir)[0]), "a refused update changed the scores")
+
+    update_safety_scores(everything, state_dir)
+    once, once_state = score_state(state_dir)
+    update_safety_scores(everything, state_dir)
+    twice, twice_state = score_state(state_dir)
+    check(np.array_equal(once, twice) and once_state['n_scored'] == twice_state['n_scored'] == len(crashes),
+          f"a second update changed the scores or counts ({once_state['n_scored']}, {twice_state['n_scored']} of {len(crashes)})")
+
+    initialize_score_state(fixture['bike_path_file'], everything, full_dir, clustering='grid')
+    full, _ = score_state(full_dir)
+    check(np.allclose(once, full), f"the updated scores differ from a full run by up to {np.abs(once - full).max()}")
+    shutil.rmtree(workdir)
+    return f"{late.sum()} late and {(crashes['CRASH DATETIME'] > cutoff).sum()} new crashes"
+
+def write_stage_modules(module_dir, scale, offset):
+    # A stage reading a module constant and a helper it imports inside its body, as the pipeline stages do
+    with open(os.path.join(module_dir, 'cached_stage.py'), 'w') as f:
+        f.write(f"import pandas as pd\n\nSCALE = {scale}\n\n"
+                "def scale_values(path):\n    from cached_stage_helpers import offset\n"
+                "    return pd.read_csv(path).assign(value=lambda frame: frame['value'] * SCALE + offset())\n")
+    with open(os.path.join(module_dir, 'cached_stage_helpers.py'), 'w') as f:
+        f.write(f"def offset():\n    return {offset}\n")
+
+    import importlib
+    import linecache
+    linecache.clearcache()
+    importlib.invalidate_caches()
+    for name in ('cached_stage', 'cached_stage_helpers'):
+        sys.modules.pop(name, None)
+    return importlib.import_module('cached_stage')
+
+def check_stage_cache(fixture):
+    # user-005: a cached stage is reused until its input file, its source, a helper it imports or a module
+    # constant it reads changes
+    import functools
+    import stage_cache
+
+    module_dir = os.path.join(fixture['workdir'], 'stage_modules')
+    os.makedirs(module_dir)
+    input_file = os.path.join(module_dir, 'values.csv')
+    pd.DataFrame({'value': [1, 2, 3]}).to_csv(input_file, index=False)
+    cache = stage_cache.StageCache(os.path.join(fixture['workdir'], 'stage_cache'))
+    calls = []
+
+    def run(module):
+        @functools.wraps(module.scale_values)
+        def counted(path):
+            calls.append(path)
+            return module.scale_values(path)
+        n_calls = len(calls)
+        values = cache.run('values', counted, input_file, input_files=[input_file])['value'].tolist()
+        return values, len(calls) == n_calls
+
+    # The stage modules count as project code only while the project is their directory, and without
+    # bytecode files a rewrite within the same second can't be shadowed by a stale .pyc
+    project_dir, dont_write_bytecode = stage_cache.PROJECT_DIR, sys.dont_write_bytecode
+    stage_cache.PROJECT_DIR, sys.dont_write_bytecode = module_dir, True
+    sys.path.insert(0, module_dir)
+    try:
+        module = write_stage_modules(module_dir, 2, 1)
+        steps = [('first run', run(module), ([3, 5, 7], False)), ('same inputs', run(module), ([3, 5, 7], True))]
+        pd.DataFrame({'value': [1, 2, 3, 4]}).to_csv(input_file, index=False)
+        steps += [('changed input file', run(module), ([3, 5, 7, 9], False)), ('same inputs', run(module), ([3, 5, 7, 9], True))]
+        module = write_stage_modules(module_dir, 2, 2)
+        steps.append(('changed helper', run(module), ([4, 6, 8, 10], False)))
+        module = write_stage_modules(module_dir, 3, 2)
+        steps += [('changed constant', run(module), ([5, 8, 11, 14], False)), ('same inputs', run(module), ([5, 8, 11, 14], True))]
+    finally:
+        sys.path.remove(module_dir)
+        stage_cache.PROJECT_DIR, sys.dont_write_bytecode = project_dir, dont_write_bytecode
+        for name in ('cached_stage', 'cached_stage_helpers'):
+            sys.modules.pop(name, None)
+
+    for step, (values, hit), (expected_values, expected_hit) in steps:
+        check(hit == expected_hit, f"{step}: {'hit' if hit else 'missed'} the cache, expected a {'hit' if expected_hit else 'miss'}")
+        check(values == expected_values, f"{step}: returned {values}, expected {expected_values}")
+    return f"{len(steps)} runs, {sum(hit for _, (_, hit), _ in steps)} cache hits"
+
+CHECKS = {
+    'path_scores': check_path_scores,
+    'segment_pairs': check_segment_pairs,
+    'radius_sweep': check_radius_sweep,
+    'crash_points': check_crash_points,
+    'routes': check_routes,
+    'roll_up': check_roll_up,
+    'window_scores': check_window_scores,
+    'traffic_chunks': check_traffic_chunks,
+    'validate_csv': check_validate_csv,
+    'incremental_update': check_incremental_update,
+    'stage_cache': check_stage_cache,
+}
+
+def check_name(value):
+    # Checked here rather than with choices, which argparse also applies to the empty default of nargs='*'
+    if value not in CHECKS:
+        raise argparse.ArgumentTypeError(f"invalid check {value!r} (choose from {', '.join(CHECKS)})")
+    return value
+
+def run_checks(fixture, names=tuple(CHECKS)):
+    # Run every check, reporting each one instead of stopping at the first failure
+    failed = []
+    for name in names:
+        try:
+            print(f"PASS {name}: {CHECKS[name](fixture)}")
+        except CheckFailed as e:
+            print(f"FAIL {name}: {e}")
+            failed.append(name)
+    return failed
+
+def main(n_points=N_POINTS, seed=0, names=tuple(CHECKS)):
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            print("Building the fixture...")
+            fixture = build_fixture(workdir, n_points, seed)
+            failed = run_checks(fixture, names)
+        print(f"{len(names) - len(failed)} of {len(names)} checks passed")
+        return not failed
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return False
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the optimized code paths against baseline computations on a synthetic fixture.")
+    parser.add_argument('checks', nargs='*', type=check_name, metavar='CHECK',
+                        help=f"Checks to run, any of {', '.join(CHECKS)} (default: all)")
+    parser.add_argument('--points', type=int, default=N_POINTS, help=f"Number of trees and of crashes in the fixture (default: {N_POINTS})")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic data generators (default: 0)")
+    args = parser.parse_args()
+    sys.exit(0 if main(args.points, args.seed, args.checks or tuple(CHECKS)) else 1)
@@ -0,0 +1,355 @@
+import argparse
+import json
+import os
+import numpy as np
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from shapely import STRtree
+from bike_network import PROJECTED_CRS, load_bike_paths, lonlat_transformer
+from scoring_engine import query_points_near_paths, aggregate_by_path
+
+# Search radii in feet around each edge for trees and crashes, as in the cluster scoring
+TREE_RADIUS = 100
+CRASH_RADIUS = 50
+
+# Segment endpoints closer than this (in feet) are treated as the same intersection
+SNAP_TOLERANCE = 1.0
+
+# The graph is saved as a directory of .npy arrays that are memory-mapped on load
+GRAPH_DIR = 'route_graph'
+GRAPH_ARRAYS = ['node_xy', 'edge_u', 'edge_v', 'edge_length', 'edge_crash_cost', 'edge_shade_cost', 'coords', 'coord_offsets']
+
+# Green and safety weights of the CSR matrix saved with the graph, the ones routes use unless asked otherwise
+DEFAULT_WEIGHTS = (1.0, 1.0)
+
+class RouteGraph:
+    # Array-backed bike network; each edge is stored once and expanded into a CSR matrix per weighting
+    def __init__(self, node_xy, edge_u, edge_v, edge_length, edge_crash_cost, edge_shade_cost, coords, coord_offsets):
+        self.node_xy = node_xy
+        self.edge_u = edge_u
+        self.edge_v = edge_v
+        self.edge_length = edge_length
+        self.edge_crash_cost = edge_crash_cost
+        self.edge_shade_cost = edge_shade_cost
+        self.coords = coords
+        self.coord_offsets = coord_offsets
+        self._node_tree = None
+        self._matrices = {}
+
+    def edge_weights(self, green_weight=1.0, safety_weight=1.0):
+        # Length plus penalties for crash exposure and missing tree cover; never below the length
+        return self.edge_length + safety_weight * self.edge_crash_cost + green_weight * self.edge_shade_cost
+
+    def weight_matrix(self, green_weight=1.0, safety_weight=1.0):
+        # CSR adjacency for one weighting, cached since building it costs more than a query
+        key = (green_weight, safety_weight)
+        if key not in self._matrices:
+            weights = self.edge_weights(green_weight, safety_weight)
+            matrix, edge_ids = build_csr(len(self.node_xy), self.edge_u, self.edge_v, weights)
+            # Typical cost per foot of path, used to size the search bound of a query
+            cost_ratio = float(np.median(weights / np.maximum(self.edge_length, 1e-9))) if len(weights) else 1.0
+            self._matrices[key] = (matrix, edge_ids, cost_ratio)
+        return self._matrices[key]
+
+    def nearest_nodes(self, x, y):
+        # Snap projected coordinates to the closest network nodes
+        if self._node_tree is None:
+            self._node_tree = cKDTree(self.node_xy)
+        return self._node_tree.query(np.column_stack([np.atleast_1d(x), np.atleast_1d(y)]))[1]
+
+    def nearest_node(self, x, y):
+        return int(self.nearest_nodes(x, y)[0])
+
+def build_csr(n_nodes, edge_u, edge_v, weights):
+    # Both directions of every edge, sorted by source, target and weight
+    sources = np.concatenate([edge_u, edge_v])
+    targets = np.concatenate([edge_v, edge_u])
+    edge_ids = np.concatenate([np.arange(len(edge_u))] * 2)
+    entry_weights = weights[edge_ids]
+
+    order = np.lexsort((entry_weights, targets, sources))
+    sources, targets, edge_ids, entry_weights = sources[order], targets[order], edge_ids[order], entry_weights[order]
+
+    # Keep only the cheapest of parallel edges and drop self-loops, which never shorten a route.
+    # Zero weights stay explicit entries, which csgraph treats as edges
+    keep = np.concatenate([[True], (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])]) & (sources != targets)
+    sources, targets, edge_ids, entry_weights = sources[keep], targets[keep], edge_ids[keep], entry_weights[keep]
+
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n_nodes), out=indptr[1:])
+    return csr_matrix((entry_weights, targets, indptr), shape=(n_nodes, n_nodes)), edge_ids
+
+def edge_scores(lines, trees=None, crashes=None, density=None):
+    # Trees per foot and crash score per foot of each edge, scaled to 0-1 across the network;
+    # with a crash density raster the crash score is its mean along the edge instead
+    lengths = np.maximum(shapely.length(lines), 1e-9)
+    path_index = STRtree(lines)
+
+    green = np.zeros(len(lines))
+    if trees is not None:
+        tree_idx, tree_edge_idx = query_points_near_paths(path_index, trees.geometry.values, TREE_RADIUS)
+        green = aggregate_by_path(tree_idx, tree_edge_idx, len(lines)) / lengths
+
+    crash = np.zeros(len(lines))
+    if density is not None:
+        import geopandas as gpd
+        crash = density.path_scores(gpd.GeoDataFrame(geometry=lines, crs=PROJECTED_CRS))
+    elif crashes is not None:
+        crash_idx, crash_edge_idx = query_points_near_paths(path_index, crashes.geometry.values, CRASH_RADIUS)
+        crash = aggregate_by_path(crash_idx, crash_edge_idx, len(lines), crashes['safety_score'].to_numpy()) / lengths
+
+    return scale_scores(green), scale_scores(crash)
+
+def scale_scores(values):
+    # Clip at the 99th percentile so a few very short edges don't flatten everyone else's score
+    top = np.percentile(values, 99) if values.any() else 0
+    return np.clip(values / top, 0, 1) if top > 0 else np.zeros_like(values)
+
+def build_route_graph(bike_paths, trees=None, crashes=None, snap_tolerance=SNAP_TOLERANCE, density=None):
+    # Split the network into simple LineStrings, each one an edge between its two endpoints
+    lines = shapely.get_parts(np.asarray(bike_paths.to_crs(PROJECTED_CRS).geometry.values))
+    lines = lines[(shapely.get_type_id(lines) == shapely.GeometryType.LINESTRING) & ~shapely.is_empty(lines)]
+
+    coords, line_idx = shapely.get_coordinates(lines, return_index=True)
+    coord_offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(line_idx, minlength=len(lines)), out=coord_offsets[1:])
+
+    # Snap endpoints to a grid so segments meeting at an intersection share a node
+    endpoints = np.concatenate([coords[coord_offsets[:-1]], coords[coord_offsets[1:] - 1]])
+    snapped = np.round(endpoints / snap_tolerance).astype(np.int64)
+    _, first, node_ids = np.unique(snapped, axis=0, return_index=True, return_inverse=True)
+    node_ids = node_ids.ravel()
+    node_xy = endpoints[first]
+    edge_u, edge_v = node_ids[:len(lines)], node_ids[len(lines):]
+
+    green, crash = edge_scores(lines, trees, crashes, density)
+    edge_length = shapely.length(lines)
+    print(f"Built route graph with {len(node_xy)} nodes and {len(lines)} edges")
+
+    return RouteGraph(
+        node_xy, edge_u, edge_v, edge_length,
+        edge_crash_cost=edge_length * crash,
+        edge_shade_cost=edge_length * (1 - green),
+        coords=coords, coord_offsets=coord_offsets
+    )
+
+def edge_lines(graph):
+    # Rebuild the projected edge linework from the flat coordinate arrays
+    line_idx = np.repeat(np.arange(len(graph.edge_u)), np.diff(graph.coord_offsets))
+    return shapely.linestrings(graph.coords, indices=line_idx)
+
+def with_crash_scores(graph, edge_crash_scores):
+    # Same network with the crash penalty recomputed from per-edge crash scores, e.g. for one time window
+    crash = scale_scores(edge_crash_scores / np.maximum(graph.edge_length, 1e-9))
+    return RouteGraph(
+        graph.node_xy, graph.edge_u, graph.edge_v, graph.edge_length,
+        edge_crash_cost=graph.edge_length * crash,
+        edge_shade_cost=graph.edge_shade_cost,
+        coords=graph.coords, coord_offsets=graph.coord_offsets
+    )
+
+def save_route_graph(graph, graph_dir=GRAPH_DIR):
+    # Every array as a plain .npy, like the crash density raster, plus the CSR matrix of the default weights.
+    # Nothing else is precomputed: other weights build their matrix on first use
+    os.makedirs(graph_dir, exist_ok=True)
+    matrix, edge_ids, cost_ratio = graph.weight_matrix(*DEFAULT_WEIGHTS)
+    arrays = {name: getattr(graph, name) for name in GRAPH_ARRAYS}
+    arrays.update(csr_data=matrix.data, csr_indices=matrix.indices, csr_indptr=matrix.indptr, csr_edge_ids=edge_ids)
+    for name, values in arrays.items():
+        np.save(os.path.join(graph_dir, f'{name}.npy'), values)
+    with open(os.path.join(graph_dir, 'graph.json'), 'w') as file:
+        json.dump({'csr_weights': list(DEFAULT_WEIGHTS), 'cost_ratio': cost_ratio}, file, indent=2)
+
+def load_route_graph(graph_dir=GRAPH_DIR):
+    # Memory-mapped, so loading is instant and a query only reads the pages it touches;
+    # the saved CSR matrix is used as is for the default weights
+    def load(name):
+        return np.load(os.path.join(graph_dir, f'{name}.npy'), mmap_mode='r')
+
+    graph = RouteGraph(**{name: load(name) for name in GRAPH_ARRAYS})
+    with open(os.path.join(graph_dir, 'graph.json')) as file:
+        metadata = json.load(file)
+    n_nodes = len(graph.node_xy)
+    matrix = csr_matrix((load('csr_data'), load('csr_indices'), load('csr_indptr')), shape=(n_nodes, n_nodes), copy=False)
+    graph._matrices[tuple(metadata['csr_weights'])] = (matrix, load('csr_edge_ids'), metadata['cost_ratio'])
+    return graph
+
+def route_edges(matrix, edge_ids, nodes):
+    # Look up the edge used between each pair of consecutive nodes in the CSR rows
+    edges = []
+    for source, target in zip(nodes[:-1], nodes[1:]):
+        start, end = matrix.indptr[source], matrix.indptr[source + 1]
+        edges.append(int(edge_ids[start + np.searchsorted(matrix.indices[start:end], target)]))
+    return edges
+
+def shortest_route(graph, origin, destination, green_weight=1.0, safety_weight=1.0):
+    matrix, edge_ids, cost_ratio = graph.weight_matrix(green_weight, safety_weight)
+
+    # Compiled Dijkstra bounded by a cost limit, so only the area around the trip is searched.
+    # Distances under the limit are exact; start from a typical detour at the typical cost per foot
+    # and double the limit until the destination is settled
+    straight_line = float(np.hypot(*(graph.node_xy[origin] - graph.node_xy[destination])))
+    limit = 1.5 * cost_ratio * straight_line + 1
+    total_weight = matrix.data.sum()
+    while True:
+        distances, predecessors = dijkstra(matrix, indices=origin, return_predecessors=True, limit=limit)
+        if np.isfinite(distances[destination]) or limit > total_weight:
+            break
+        limit *= 2
+
+    if not np.isfinite(distances[destination]):
+        return None
+
+    # Walk back from the destination to recover the nodes and edges of the route
+    nodes = [destination]
+    while nodes[-1] != origin:
+        nodes.append(int(predecessors[nodes[-1]]))
+    nodes.reverse()
+    edges = route_edges(matrix, edge_ids, nodes)
+
+    return {'nodes': nodes, 'edges': edges, 'cost': float(distances[destination]), 'length_ft': float(graph.edge_length[edges].sum())}
+
+def route_cost_matrix(graph, origins, destinations, green_weight=1.0, safety_weight=1.0):
+    # All origin-destination costs from one compiled search per distinct endpoint instead of one per pair
+    matrix, _, _ = graph.weight_matrix(green_weight, safety_weight)
+    origins, destinations = np.asarray(origins), np.asarray(destinations)
+    unique_origins, origin_rows = np.unique(origins, return_inverse=True)
+    unique_destinations, destination_cols = np.unique(destinations, return_inverse=True)
+
+    # The network is undirected, so search from whichever side has fewer distinct nodes
+    if len(unique_destinations) < len(unique_origins):
+        costs = dijkstra(matrix, indices=unique_destinations)[:, unique_origins].T
+    else:
+        costs = dijkstra(matrix, indices=unique_origins)[:, unique_destinations]
+    return costs[np.ix_(origin_rows, destination_cols)]
+
+def route_geometry(graph, route):
+    # Chain the edge linework in travel direction into a single projected LineString
+    parts = []
+    for node, edge in zip(route['nodes'], route['edges']):
+        edge_coords = graph.coords[graph.coord_offsets[edge]:graph.coord_offsets[edge + 1]]
+        parts.append(edge_coords if graph.edge_u[edge] == node else edge_coords[::-1])
+    if not parts:
+        return shapely.Point(graph.node_xy[route['nodes'][0]])
+    return shapely.LineString(np.concatenate(parts))
+
+def route_between(graph, origin_lonlat, destination_lonlat, green_weight=1.0, safety_weight=1.0):
+    # Snap lon/lat endpoints to the nearest network nodes and route between them
+    transformer = lonlat_transformer()
+    origin = graph.nearest_node(*transformer.transform(*origin_lonlat))
+    destination = graph.nearest_node(*transformer.transform(*destination_lonlat))
+    return shortest_route(graph, origin, destination, green_weight, safety_weight)
+
+def prepare_route_graph(bike_path_file, tree_data_file, crash_data_file, crash_density_file=None):
+    # Imported here so routing a prebuilt graph doesn't load the scoring pipelines
+    from safety_analysis import prepare_crash_points, calculate_safety_scores
+    from spatial_analysis import prepare_tree_points
+
+    bike_paths = load_bike_paths(bike_path_file)
+    trees = prepare_tree_points(tree_data_file)
+    crashes = calculate_safety_scores(prepare_crash_points(crash_data_file))
+
+    # A saved crash density raster is reused as is, or built once for later runs
+    density = None
+    if crash_density_file:
+        from crash_density import crash_density_surface
+        density = crash_density_surface(crashes, crash_density_file)
+    return build_route_graph(bike_paths, trees, crashes, density=density)
+
+def output_route(graph, route, filename):
+    import geopandas as gpd
+
+    route_gdf = gpd.GeoDataFrame(
+        {'cost': [route['cost']], 'length_ft': [route['length_ft']]},
+        geometry=[route_geometry(graph, route)], crs=PROJECTED_CRS
+    )
+    route_gdf.to_crs('EPSG:4326').to_file(filename, driver='GeoJSON')
+
+def crash_table_file(graph_dir):
+    # The edge-level crash table lives with the graph it indexes
+    return os.path.join(graph_dir, 'crash_table.parquet')
+
+def apply_crash_window(graph, hours=None, weekdays=None, start=None, end=None, crash_data_file='cleaned_motor_vehicle_collisions.parquet',
+                       table_file=crash_table_file(GRAPH_DIR)):
+    # Reweight crash exposure with only the crashes in a time window, from the edge-level crash table,
+    # which is rebuilt when the graph's edges or the crash data changed
+    from crash_index import crash_path_table, query_safety_scores
+    import geopandas as gpd
+
+    edges = gpd.GeoDataFrame(geometry=edge_lines(graph), crs=PROJECTED_CRS)
+    table = crash_path_table(edges, crash_data_file, table_file, CRASH_RADIUS)
+
+    scores = query_safety_scores(table, len(graph.edge_u), hours, weekdays, start, end)
+    return with_crash_scores(graph, scores.to_numpy())
+
+def output_cost_matrix(graph, points_file, filename, green_weight=1.0, safety_weight=1.0):
+    # Costs between every pair of named points, e.g. borough centroids for a commute matrix
+    import pandas as pd
+
+    points = pd.read_csv(points_file)
+    nodes = graph.nearest_nodes(*lonlat_transformer().transform(points['longitude'].to_numpy(), points['latitude'].to_numpy()))
+    costs = route_cost_matrix(graph, nodes, nodes, green_weight, safety_weight)
+    pd.DataFrame(costs, index=points['name'], columns=points['name']).to_csv(filename)
+
+def main(origin=None, destination=None, green_weight=1.0, safety_weight=1.0, rebuild=False, window=None,
+         bike_path_file='processed_bike_paths.geojson', tree_data_file='processed_tree_data.parquet',
+         crash_data_file='cleaned_motor_vehicle_collisions.parquet', graph_dir=GRAPH_DIR,
+         output_file='./Bike Lane groupings/route.geojson', crash_density_file=None, points_file=None):
+    try:
+        if rebuild or not os.path.exists(os.path.join(graph_dir, 'graph.json')):
+            print("Building route graph...")
+            graph = prepare_route_graph(bike_path_file, tree_data_file, crash_data_file, crash_density_file)
+            save_route_graph(graph, graph_dir)
+        else:
+            graph = load_route_graph(graph_dir)
+
+        if window:
+            print("Applying crash time window...")
+            graph = apply_crash_window(graph, **window, crash_data_file=crash_data_file, table_file=crash_table_file(graph_dir))
+
+        if points_file:
+            print("Computing route cost matrix...")
+            output_cost_matrix(graph, points_file, output_file, green_weight, safety_weight)
+            return
+
+        print("Routing...")
+        route = route_between(graph, origin, destination, green_weight, safety_weight)
+        if route is None:
+            print("No route found between the origin and destination")
+            return
+
+        print(f"Route of {route['length_ft']:.0f} ft over {len(route['edges'])} segments (cost {route['cost']:.0f})")
+        output_route(graph, route, output_file)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find a green and safe bike route between two points.")
+    parser.add_argument('--origin', nargs=2, type=float, metavar=('LON', 'LAT'))
+    parser.add_argument('--destination', nargs=2, type=float, metavar=('LON', 'LAT'))
+    parser.add_argument('--points', metavar='CSV',
+                        help="Instead of one route, write the route costs between every pair of the name, longitude, latitude rows of CSV")
+    parser.add_argument('--output', help="File to write the route (GeoJSON) or cost matrix (CSV) to")
+    parser.add_argument('--green-weight', type=float, default=1.0, help="Penalty per foot of path without tree cover (default: 1.0)")
+    parser.add_argument('--safety-weight', type=float, default=1.0, help="Penalty per foot of path with crash exposure (default: 1.0)")
+    parser.add_argument('--rebuild', action='store_true', help=f"Rebuild the {GRAPH_DIR} graph directory from the processed data")
+    parser.add_argument('--crash-density', metavar='FILE',
+                        help="Crash exposure of a rebuilt graph from this crash density raster (.npy), built if missing or stale")
+    parser.add_argument('--hours', help="Only count crashes in these hours of the day, e.g. 17-21")
+    parser.add_argument('--weekdays', help="Only count crashes on these weekdays, 0=Monday, e.g. 0-4")
+    parser.add_argument('--since', help="Only count crashes from this date (YYYY-MM-DD)")
+    parser.add_argument('--until', help="Only count crashes up to this date (YYYY-MM-DD)")
+    args = parser.parse_args()
+    if not args.points and not (args.origin and args.destination):
+        parser.error("--origin and --destination are required unless --points is given")
+
+    window = None
+    if args.hours or args.weekdays or args.since or args.until:
+        from crash_index import parse_range
+        window = {'hours': parse_range(args.hours, 24), 'weekdays': parse_range(args.weekdays, 7), 'start': args.since, 'end': args.until}
+    output_file = args.output or ('./Bike Lane groupings/route_cost_matrix.csv' if args.points else './Bike Lane groupings/route.geojson')
+    main(args.origin and tuple(args.origin), args.destination and tuple(args.destination), args.green_weight, args.safety_weight,
+         args.rebuild, window, output_file=output_file, crash_density_file=args.crash_density, points_file=args.points)
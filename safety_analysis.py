@@ -1,111 +1,134 @@
+import argparse
+import os
 import geopandas as gpd
-import pandas as pd
-import matplotlib.pyplot as plt
-from shapely.ops import unary_union
-from shapely.geometry import Point, LineString, MultiLineString, GeometryCollection
-from sklearn.cluster import KMeans
-import numpy as np
-from sklearn.preprocessing import MinMaxScaler
-
+from bike_network import PROJECTED_CRS, ensure_projected, in_nyc_bounds, lonlat_transformer, load_bike_paths, prepare_bike_paths
+from columnar_io import read_collisions
+from instrumentation import instrumented, tracing
+from scoring_engine import score_points_near_paths, score_points_multi_radius, pair_points_with_paths, aggregate_by_path
+from plotting import finish_figure, new_figure
+from ranking import ranking_columns, top_k
+from stage_cache import StageCache
+
+# Buffer radii (in feet, the unit of EPSG:2263) compared in sweep mode
+SWEEP_RADII = [25, 50, 100, 200]
+
+# Weight of each casualty count in a crash's safety score
+SAFETY_WEIGHTS = {
+    'NUMBER OF PERSONS KILLED': 10,
+    'NUMBER OF CYCLIST KILLED': 8,
+    'NUMBER OF PEDESTRIANS KILLED': 8,
+    'NUMBER OF PERSONS INJURED': 2,
+    'NUMBER OF CYCLIST INJURED': 3,
+    'NUMBER OF PEDESTRIANS INJURED': 3,
+}
+
+OUTPUT_DIR = './Bike Lane groupings'
+
+# Cached pipeline stages, in the order they run
+PIPELINE_STAGES = ['combine', 'crash_points', 'crash_pairs']
+
+@instrumented
 def load_data(bike_path_file, crash_data_file):
-    # Load the bike paths and crash data GeoJSON files
-    bike_paths = gpd.read_file(bike_path_file)
-    crashes = pd.read_csv(crash_data_file, parse_dates=['CRASH DATETIME'])
+    # Load the bike paths GeoJSON file and the cleaned crash data (Parquet dataset or CSV)
+    bike_paths = load_bike_paths(bike_path_file)
+    crashes = read_collisions(crash_data_file)
     return bike_paths, crashes
 
-def cluster_bike_paths(bike_paths, n_clusters=50):
-    # Extract centroids for clustering
-    centroids = np.array([geom.centroid.coords[0] for geom in bike_paths.geometry])
-    
-    # Perform KMeans clustering
-    kmeans = KMeans(n_clusters=n_clusters, random_state=0).fit(centroids)
-    bike_paths['cluster'] = kmeans.labels_
-    
-    return bike_paths
-
-def combine_bike_paths(bike_paths):
-    combined_bike_paths = []
-    
-    # Combine bike paths within each cluster
-    for cluster in bike_paths['cluster'].unique():
-        cluster_paths = bike_paths[bike_paths['cluster'] == cluster]
-        combined_cluster_path = unary_union(cluster_paths.geometry)
-        
-        if isinstance(combined_cluster_path, (LineString, MultiLineString)):
-            combined_bike_paths.append(combined_cluster_path)
-        elif isinstance(combined_cluster_path, GeometryCollection):
-            for geom in combined_cluster_path:
-                if isinstance(geom, (LineString, MultiLineString)):
-                    combined_bike_paths.append(geom)
-        else:
-            print(f"Unhandled geometry type: {type(combined_cluster_path)}")
-    
-    print(f"Number of combined bike path segments: {len(combined_bike_paths)}")
-    return gpd.GeoDataFrame(geometry=combined_bike_paths, crs=bike_paths.crs)
-
-def create_crash_points(crashes):
-    # Create GeoDataFrame from crash data
-    geometry = [Point(xy) for xy in zip(crashes['LONGITUDE'], crashes['LATITUDE'])]
-    crashes_gdf = gpd.GeoDataFrame(crashes, geometry=geometry, crs='EPSG:4326')
-    return crashes_gdf
-
-def calculate_safety_scores(crashes):
+@instrumented
+def create_crash_points(crashes, crs=PROJECTED_CRS):
+    # Drop crashes geocoded outside the city, such as the (0, 0) placeholder, before any geometry exists
+    lon = crashes['LONGITUDE'].to_numpy(dtype=float)
+    lat = crashes['LATITUDE'].to_numpy(dtype=float)
+    in_bounds = in_nyc_bounds(lon, lat)
+    if not in_bounds.all():
+        print(f"Dropping {(~in_bounds).sum()} crashes with coordinates outside New York City")
+        crashes, lon, lat = crashes[in_bounds], lon[in_bounds], lat[in_bounds]
+
+    # Project the coordinate arrays, then build all points in one call instead of one Point per crash
+    x, y = (lon, lat) if crs == 'EPSG:4326' else lonlat_transformer(crs).transform(lon, lat)
+    return gpd.GeoDataFrame(crashes, geometry=gpd.points_from_xy(x, y, crs=crs))
+
+@instrumented
+def calculate_safety_scores(crashes, weights=SAFETY_WEIGHTS):
     # Calculate safety scores based on the weighted sum
-    crashes['safety_score'] = (
-        10 * crashes['NUMBER OF PERSONS KILLED'] +
-        8 * crashes['NUMBER OF CYCLIST KILLED'] +
-        8 * crashes['NUMBER OF PEDESTRIANS KILLED'] +
-        2 * crashes['NUMBER OF PERSONS INJURED'] +
-        3 * crashes['NUMBER OF CYCLIST INJURED'] +
-        3 * crashes['NUMBER OF PEDESTRIANS INJURED']
-    )
+    crashes['safety_score'] = sum(weight * crashes[col] for col, weight in weights.items())
     return crashes
 
+@instrumented
+def prepare_crash_points(crash_data_file):
+    # Load the crashes as projected points carrying their casualty counts
+    crashes = read_collisions(crash_data_file)
+    return create_crash_points(crashes)
+
+@instrumented
 def map_crashes_to_bike_paths(bike_paths, crashes, buffer_radius=50):
-    # Ensure both bike paths and crashes are in a projected CRS suitable for buffering and spatial operations
-    print("Reprojecting bike paths and crashes to a projected CRS for buffering and spatial operations...")
-    projected_crs = 'EPSG:2263'
-    bike_paths = bike_paths.to_crs(projected_crs)
-    crashes = crashes.to_crs(projected_crs)
+    # Ensure both bike paths and crashes are in a projected CRS suitable for distance queries
+    print("Reprojecting bike paths and crashes to a projected CRS for spatial operations...")
+    bike_paths = ensure_projected(bike_paths)
+    crashes = ensure_projected(crashes)
     
-    # Create buffers around bike paths
-    print(f"Creating buffers around bike paths with a radius of {buffer_radius} meters...")
-    bike_paths['buffer'] = bike_paths.geometry.buffer(buffer_radius)
+    # Query the bike path index for crashes within the radius of each path and aggregate their scores
+    print(f"Aggregating safety scores of crashes within {buffer_radius} feet of bike paths...")
+    bike_paths['safety_score'] = score_points_near_paths(bike_paths, crashes, buffer_radius, weight_column='safety_score')
     
-    # Perform spatial join to map crashes to nearby bike paths
-    print("Performing spatial join to count crashes within buffers...")
-    crashes_in_buffers = gpd.sjoin(crashes, bike_paths.set_geometry('buffer'), how='inner', predicate='within')
+    return bike_paths.to_crs('EPSG:4326')  # Reproject back to the original CRS
+
+def safety_by_cell(grid, level=0):
+    # Crash count and safety score per grid cell, plus the score per 1000 feet of bike path
+    from grid_index import per_path_length
+
+    cells = grid.cell_table(level, ['crashes', 'safety', 'path_length'])
+    cells['safety_per_1000ft'] = per_path_length(cells['safety'].to_numpy(), cells['path_length'].to_numpy())
+    return cells
+
+@instrumented
+def sweep_safety_radii(bike_paths, crashes, radii=SWEEP_RADII):
+    # Ensure both bike paths and crashes are in a projected CRS suitable for distance queries
+    print("Reprojecting bike paths and crashes to a projected CRS for spatial operations...")
+    bike_paths = ensure_projected(bike_paths)
+    crashes = ensure_projected(crashes)
     
-    # Aggregate safety scores by bike path
-    print("Aggregating safety scores by bike path...")
-    bike_paths['safety_score'] = crashes_in_buffers.groupby(crashes_in_buffers.index)['safety_score'].sum().reindex(bike_paths.index, fill_value=0)
+    # Score every radius from a single spatial pass over the crashes
+    print(f"Aggregating safety scores of crashes within {', '.join(f'{r:g}' for r in sorted(radii))} feet of bike paths...")
+    scores = score_points_multi_radius(bike_paths, crashes, radii, weight_column='safety_score', prefix='safety_score')
     
-    # Drop the buffer column to avoid issues with multiple geometry columns
-    bike_paths = bike_paths.drop(columns='buffer')
+    return bike_paths.join(scores).to_crs('EPSG:4326')  # Reproject back to the original CRS
+
+def output_radius_sweep(bike_paths, filename):
+    # Compare how the path rankings change between radii
+    score_columns = [col for col in bike_paths.columns if col.startswith('safety_score_')]
+    print("Rank correlation of safety scores between radii:")
+    print(bike_paths[score_columns].corr(method='spearman'))
     
-    return bike_paths.to_crs('EPSG:4326')  # Reproject back to the original CRS
+    # Output the per-radius scores for every path
+    bike_paths[score_columns].to_csv(filename, index_label='path_id')
 
+@instrumented
 def normalize_scores(bike_paths):
-    # Normalize the safety scores for better visualization
-    scaler = MinMaxScaler()
-    bike_paths['normalized_safety_score'] = scaler.fit_transform(bike_paths[['safety_score']])
+    # Min-max normalize the safety scores for better visualization; a constant score maps to 0 as with MinMaxScaler
+    scores = bike_paths['safety_score']
+    score_range = scores.max() - scores.min()
+    bike_paths['normalized_safety_score'] = (scores - scores.min()) / (score_range if score_range else 1)
     return bike_paths
 
+@instrumented
 def get_safe_and_unsafe_clusters(bike_paths, n_clusters=5):
-    # Sort by safety score to find the safest and least safe clusters
-    sorted_bike_paths = bike_paths.sort_values(by='normalized_safety_score')
-    
-    safest_clusters = sorted_bike_paths.head(n_clusters)
-    least_safe_clusters = sorted_bike_paths.tail(n_clusters)
+    # Select the safest and least safe clusters without sorting the whole network; least safe stays in ascending order
+    scores = bike_paths['normalized_safety_score'].to_numpy(dtype=float)
+    safest_clusters = bike_paths.iloc[top_k(scores, n_clusters, largest=False)]
+    least_safe_clusters = bike_paths.iloc[top_k(scores, n_clusters, largest=True)[::-1]]
     
     return safest_clusters, least_safe_clusters
 
+@instrumented
 def output_cluster_info(clusters, filename):
-    # Output the cluster information for Google Maps
-    clusters.to_file(filename, driver='GeoJSON')
+    # Output the cluster information for Google Maps, without the intermediate columns
+    columns = ranking_columns(clusters, [col for col in ['safety_score', 'normalized_safety_score'] if col in clusters.columns])
+    clusters[columns].to_file(filename, driver='GeoJSON')
 
-def plot_safety_results(bike_paths, safest_clusters, least_safe_clusters):
-    fig, ax = plt.subplots(figsize=(10, 10))
+@instrumented
+def plot_safety_results(bike_paths, safest_clusters, least_safe_clusters, output_file=None, show=True):
+    fig, ax = new_figure()
     
     vmin = bike_paths['normalized_safety_score'].min()
     vmax = bike_paths['normalized_safety_score'].max()
@@ -114,35 +137,51 @@ def plot_safety_results(bike_paths, safest_clusters, least_safe_clusters):
     safest_clusters.plot(ax=ax, color='green', linewidth=2, label='Safest Clusters')
     least_safe_clusters.plot(ax=ax, color='red', linewidth=2, label='Least Safe Clusters')
     
-    plt.legend()
-    plt.title('Bike Paths with Normalized Safety Scores')
-    plt.show()
+    ax.legend()
+    ax.set_title('Bike Paths with Normalized Safety Scores')
+    finish_figure(fig, output_file, show)
 
-def main():
+def main(sweep_radii=None, use_cache=True, rebuild_from=None, bike_path_file='processed_bike_paths.geojson',
+         crash_data_file='cleaned_motor_vehicle_collisions.parquet', output_dir=OUTPUT_DIR, plot_file=None, show_plot=True, kde=False, clustering='kmeans'):
     try:
-        # Load the processed data
-        print("Loading data...")
-        bike_paths, crashes = load_data('processed_bike_paths.geojson', 'cleaned_motor_vehicle_collisions.csv')
+        cache = StageCache(enabled=use_cache, rebuild_from=rebuild_from, stage_order=PIPELINE_STAGES)
 
-        # Cluster the bike path segments
-        print("Clustering bike paths...")
-        bike_paths = cluster_bike_paths(bike_paths, n_clusters=200)
-
-        # Combine bike path segments within each cluster
-        print("Combining bike paths...")
-        combined_bike_paths = combine_bike_paths(bike_paths)
+        # Load, cluster and combine the bike path segments
+        print("Loading, clustering and combining bike paths...")
+        combined_bike_paths = cache.run('combine', prepare_bike_paths, bike_path_file, n_clusters=200, method=clustering,
+                                        input_files=[bike_path_file])
 
         # Create crash points
         print("Creating crash points...")
-        crashes_gdf = create_crash_points(crashes)
+        crashes_gdf = cache.run('crash_points', prepare_crash_points, crash_data_file, input_files=[crash_data_file])
 
         # Calculate safety scores
         print("Calculating safety scores...")
         crashes_with_scores = calculate_safety_scores(crashes_gdf)
 
-        # Map crashes to bike paths
-        print("Mapping crashes to bike paths...")
-        bike_paths_with_scores = map_crashes_to_bike_paths(combined_bike_paths, crashes_with_scores)
+        # Compare scores across several radii instead of a single scoring run
+        if sweep_radii:
+            print("Sweeping buffer radii...")
+            bike_paths_swept = sweep_safety_radii(combined_bike_paths, crashes_with_scores, sweep_radii)
+            output_radius_sweep(bike_paths_swept, os.path.join(output_dir, 'safety_radius_sweep.csv'))
+            return
+
+        if kde:
+            # Score from the smoothed crash surface, so a crash just past the buffer still counts for most of its score
+            from crash_density import crash_density_surface
+            print("Sampling the crash density raster along bike paths...")
+            density = crash_density_surface(crashes_with_scores, os.path.join(output_dir, 'crash_density.npy'))
+            combined_bike_paths['safety_score'] = density.path_scores(combined_bike_paths)
+        else:
+            # Map crashes to bike paths; the pairs don't depend on the weights, so reweighting skips this stage
+            print("Mapping crashes to bike paths...")
+            crash_pairs = cache.run('crash_pairs', pair_points_with_paths, combined_bike_paths, crashes_gdf, radius=50,
+                                    depends_on=['combine', 'crash_points'])
+            combined_bike_paths['safety_score'] = aggregate_by_path(
+                crash_pairs['point_idx'].to_numpy(), crash_pairs['path_idx'].to_numpy(),
+                len(combined_bike_paths), crashes_with_scores['safety_score'].to_numpy()
+            )
+        bike_paths_with_scores = combined_bike_paths.to_crs('EPSG:4326')
 
         # Normalize safety scores
         print("Normalizing safety scores...")
@@ -154,15 +193,27 @@ def main():
 
         # Output the cluster information for Google Maps
         print("Outputting cluster information for Google Maps...")
-        output_cluster_info(safest_clusters, './Bike Lane groupings/most_safe_clusters.geojson')
-        output_cluster_info(least_safe_clusters, './Bike Lane groupings/least_safe_clusters.geojson')
+        output_cluster_info(safest_clusters, os.path.join(output_dir, 'most_safe_clusters.geojson'))
+        output_cluster_info(least_safe_clusters, os.path.join(output_dir, 'least_safe_clusters.geojson'))
 
-        # Plot the results
-        print("Plotting results...")
-        plot_safety_results(bike_paths_normalized, safest_clusters, least_safe_clusters)
+        # Plot the results, unless a batch run asked for no plot at all
+        if plot_file or show_plot:
+            print("Plotting results...")
+            plot_safety_results(bike_paths_normalized, safest_clusters, least_safe_clusters, plot_file, show_plot)
 
     except Exception as e:
         print(f"An error occurred: {e}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Score bike paths by the severity of nearby crashes.")
+    parser.add_argument('--sweep', nargs='*', type=float, metavar='FEET',
+                        help=f"Score every path at several buffer radii in one pass (default: {SWEEP_RADII})")
+    parser.add_argument('--kde', action='store_true', help="Score paths from a crash kernel density raster instead of a hard 50 ft buffer")
+    parser.add_argument('--no-cache', action='store_true', help="Recompute every stage without reading or writing the stage cache")
+    parser.add_argument('--rebuild-from', choices=PIPELINE_STAGES, help="Recompute this stage and every stage after it")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="Record per-stage time, rows, vertices and peak memory; FILE.json opens in a Chrome trace viewer, other names get JSON lines")
+    parser.add_argument('--profile', metavar='FILE', help="Also run under cProfile and write the stats to FILE (.prof)")
+    args = parser.parse_args()
+    with tracing(args.trace, args.profile):
+        main(sweep_radii=SWEEP_RADII if args.sweep == [] else args.sweep, use_cache=not args.no_cache, rebuild_from=args.rebuild_from, kde=args.kde)
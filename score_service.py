@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+import numpy as np
+import shapely
+from shapely import STRtree
+from bike_network import ensure_projected, lonlat_transformer
+
+SCORED_NETWORK_FILE = './Bike Lane groupings/scored_bike_paths.parquet'
+
+# Path columns returned by the queries, when the scored network has them
+SCORE_COLUMNS = ['tree_density', 'canopy_score', 'safety_score', 'normalized_safety_score', 'vehicle_exposure', 'safety_per_exposure', 'crash_density']
+
+# Default search radii in feet, the same as the scoring pipeline
+TREE_RADIUS = 100
+CRASH_RADIUS = 50
+
+# Largest request body accepted, bounds the memory a single batch can take
+MAX_BODY_BYTES = 16 * 1024 ** 2
+
+# Most queries in one batch; batches run in worker threads, and this bounds how long one can hold a thread
+MAX_BATCH_QUERIES = 1000
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+def json_number(value):
+    # NaN and infinity aren't valid JSON, they are returned as null
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+class ScoreIndex:
+    # Immutable in-memory indexes over the scored paths and the tree and crash points; a reload builds a new one
+    def __init__(self, bike_paths, trees, crashes):
+        bike_paths = ensure_projected(bike_paths).reset_index(drop=True)
+        self.path_geometries = np.asarray(bike_paths.geometry.values)
+        self.path_index = STRtree(self.path_geometries)
+        id_column = next((col for col in ('segment_id', 'cluster') if col in bike_paths.columns), None)
+        self.path_ids = bike_paths[id_column].to_numpy() if id_column else np.arange(len(bike_paths))
+        self.scores = {col: bike_paths[col].to_numpy(dtype=float) for col in SCORE_COLUMNS if col in bike_paths.columns}
+
+        from spatial_analysis import DBH_COLUMN
+        self.tree_index = STRtree(np.asarray(trees.geometry.values))
+        self.tree_dbh = trees[DBH_COLUMN].to_numpy(dtype=float) if DBH_COLUMN in trees.columns else np.zeros(len(trees))
+        self.crash_index = STRtree(np.asarray(crashes.geometry.values))
+        self.crash_scores = crashes['safety_score'].to_numpy(dtype=float)
+        self.loaded_at = time.time()
+
+    def path_scores(self, idx):
+        return {'path_id': int(self.path_ids[idx]), **{col: json_number(values[idx]) for col, values in self.scores.items()}}
+
+    def points_near(self, geometry, tree_radius, crash_radius):
+        # Trees and crashes within the radii of any geometry, from the point indexes
+        trees = self.tree_index.query(geometry, predicate='dwithin', distance=tree_radius)
+        crashes = self.crash_index.query(geometry, predicate='dwithin', distance=crash_radius)
+        return {
+            'trees': len(trees), 'canopy': float(self.tree_dbh[trees].sum()),
+            'crashes': len(crashes), 'crash_safety_score': float(self.crash_scores[crashes].sum()),
+        }
+
+    def point(self, lon, lat, tree_radius=TREE_RADIUS, crash_radius=CRASH_RADIUS, max_distance=None):
+        # Scores of the nearest scored path, and the greenery and crashes around the point itself
+        point = shapely.Point(lonlat_transformer().transform(lon, lat))
+        nearest, distances = self.path_index.query_nearest(point, max_distance=max_distance or max(tree_radius, crash_radius),
+                                                            return_distance=True)
+        path = None
+        if len(nearest):
+            path = {**self.path_scores(nearest[0]), 'distance_ft': float(distances[0])}
+        return {'path': path, **self.points_near(point, tree_radius, crash_radius)}
+
+    def bbox(self, min_lon, min_lat, max_lon, max_lat):
+        # Totals of every tree and crash in the box, and length-weighted path scores clipped to it
+        transformer = lonlat_transformer()
+        (min_x, max_x), (min_y, max_y) = transformer.transform([min_lon, max_lon], [min_lat, max_lat])
+        box = shapely.box(min_x, min_y, max_x, max_y)
+
+        # A point's envelope is the point, so the raw envelope query is already an exact containment test
+        trees = self.tree_index.query(box)
+        crashes = self.crash_index.query(box)
+        paths = self.path_index.query(box, predicate='intersects')
+        lengths = shapely.length(shapely.intersection(self.path_geometries[paths], box))
+        total_length = float(lengths.sum())
+        weighted = {
+            col: json_number(np.average(values[paths], weights=lengths)) if total_length > 0 else None
+            for col, values in self.scores.items()
+        }
+        return {
+            'trees': len(trees), 'canopy': float(self.tree_dbh[trees].sum()),
+            'crashes': len(crashes), 'crash_safety_score': float(self.crash_scores[crashes].sum()),
+            'paths': len(paths), 'path_length_ft': total_length, 'path_scores': weighted,
+        }
+
+    def path(self, coordinates, tree_radius=TREE_RADIUS, crash_radius=CRASH_RADIUS):
+        # Greenery and crash exposure along a proposed route, also per 1000 feet so routes of any length compare
+        coordinates = np.asarray(coordinates, dtype=float)
+        if coordinates.ndim != 2 or coordinates.shape[1] != 2 or len(coordinates) < 2:
+            raise ValueError("A path needs at least two [lon, lat] coordinates")
+        lon, lat = coordinates.T
+        line = shapely.linestrings(np.column_stack(lonlat_transformer().transform(lon, lat)))
+        length = float(line.length)
+        totals = self.points_near(line, tree_radius, crash_radius)
+        per_1000ft = 1000 / length if length > 0 else None
+        return {
+            **totals, 'length_ft': length,
+            'trees_per_1000ft': totals['trees'] * per_1000ft if per_1000ft else None,
+            'crash_safety_per_1000ft': totals['crash_safety_score'] * per_1000ft if per_1000ft else None,
+            'paths': len(self.path_index.query(line, predicate='dwithin', distance=crash_radius)),
+        }
+
+    def answer(self, query):
+        # One query of the form {"type": "point" | "bbox" | "path", ...arguments}
+        query = dict(query)
+        query_type = query.pop('type', None)
+        if query_type == 'point':
+            return self.point(**query)
+        if query_type == 'bbox':
+            return self.bbox(*query['bbox'])
+        if query_type == 'path':
+            return self.path(**query)
+        raise ValueError(f"Unknown query type {query_type!r}, expected point, bbox or path")
+
+    def answer_batch(self, queries):
+        # Failures are reported per query so one bad entry doesn't sink the batch
+        results = []
+        for query in queries:
+            try:
+                results.append(self.answer(query))
+            except (ValueError, KeyError, TypeError) as e:
+                results.append({'error': str(e)})
+            except Exception as e:
+                results.append({'error': f"Query failed: {e}"})
+        return results
+
+def load_score_index(scored_file, tree_data_file, crash_data_file):
+    # Load the scored network and build the point structures the scoring pipelines use
+    import geopandas as gpd
+    from safety_analysis import calculate_safety_scores, prepare_crash_points
+    from spatial_analysis import prepare_tree_points
+
+    bike_paths = gpd.read_parquet(scored_file)
+    trees = prepare_tree_points(tree_data_file)
+    crashes = calculate_safety_scores(prepare_crash_points(crash_data_file))
+    return ScoreIndex(bike_paths, trees, crashes)
+
+class ScoreService:
+    def __init__(self, scored_file, tree_data_file, crash_data_file):
+        self.files = {'scored_file': scored_file, 'tree_data_file': tree_data_file, 'crash_data_file': crash_data_file}
+        self.index = load_score_index(**self.files)
+        self.reload_lock = asyncio.Lock()
+        self.latencies = deque(maxlen=10_000)
+
+    async def reload(self, files):
+        # Build the new index in a worker thread; queries keep using the old one until the reference is swapped
+        async with self.reload_lock:
+            files = {**self.files, **{key: value for key, value in files.items() if key in self.files}}
+            start = time.perf_counter()
+            index = await asyncio.get_running_loop().run_in_executor(None, lambda: load_score_index(**files))
+            self.index, self.files = index, files
+            return {'status': 'reloaded', 'paths': len(index.path_geometries), 'seconds': round(time.perf_counter() - start, 3)}
+
+    def health(self):
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            'status': 'ok', 'paths': len(self.index.path_geometries), 'loaded_at': self.index.loaded_at,
+            'requests': len(self.latencies), 'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+        }
+
+    async def handle(self, method, path, body):
+        # Route one request to a JSON response; every query reads the index reference once
+        if method == 'GET' and path == '/health':
+            return 200, self.health()
+        if method != 'POST':
+            return 405, {'error': f"{method} not allowed on {path}"}
+        if path == '/reload':
+            # A failed reload leaves the current index serving
+            try:
+                return 200, await self.reload(json.loads(body or b'{}'))
+            except Exception as e:
+                return 500, {'error': f"Reload failed: {e}"}
+
+        index = self.index
+        request = json.loads(body)
+        if path == '/query':
+            return 200, index.answer(request)
+        if path == '/batch':
+            queries = request['queries']
+            if len(queries) > MAX_BATCH_QUERIES:
+                return 413, {'error': f"Batch of {len(queries)} queries, at most {MAX_BATCH_QUERIES} are accepted"}
+            # Run in a worker thread so a large batch doesn't hold up other clients; the shapely queries release the GIL
+            results = await asyncio.get_running_loop().run_in_executor(None, index.answer_batch, queries)
+            return 200, {'results': results}
+        return 404, {'error': f"Unknown endpoint {path}"}
+
+    async def serve_connection(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive, enough for local clients; no framework dependency
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_BYTES:
+                    status, response = 413, {'error': f"Request body over {MAX_BODY_BYTES} bytes"}
+                    body = b''
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    start = time.perf_counter()
+                    try:
+                        status, response = await self.handle(method, path, body)
+                    except (ValueError, KeyError, TypeError) as e:
+                        status, response = 400, {'error': str(e)}
+                    except Exception as e:
+                        # Anything else is answered rather than dropping the connection
+                        status, response = 500, {'error': f"Query failed: {e}"}
+                    if path in ('/query', '/batch'):
+                        self.latencies.append(time.perf_counter() - start)
+
+                payload = json.dumps(response).encode()
+                keep_alive = headers.get('connection', '').lower() != 'close' and status != 413
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(host, port, scored_file, tree_data_file, crash_data_file):
+    print("Loading scored network and point indexes...")
+    service = ScoreService(scored_file, tree_data_file, crash_data_file)
+    server = await asyncio.start_server(service.serve_connection, host, port)
+    print(f"Serving {len(service.index.path_geometries)} scored paths on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def main(host='127.0.0.1', port=8765, scored_file=SCORED_NETWORK_FILE, tree_data_file='processed_tree_data.parquet',
+         crash_data_file='cleaned_motor_vehicle_collisions.parquet'):
+    try:
+        asyncio.run(serve(host, port, scored_file, tree_data_file, crash_data_file))
+    except KeyboardInterrupt:
+        print("Stopped")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve point, bbox and path score queries over the scored bike network.")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8765, help="Port to listen on (default: 8765)")
+    parser.add_argument('--scored', default=SCORED_NETWORK_FILE, help="Scored network written by the pipeline")
+    parser.add_argument('--trees', default='processed_tree_data.parquet', help="Processed tree data")
+    parser.add_argument('--crashes', default='cleaned_motor_vehicle_collisions.parquet', help="Cleaned collisions")
+    args = parser.parse_args()
+    main(args.host, args.port, args.scored, args.trees, args.crashes)
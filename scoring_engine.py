@@ -0,0 +1,132 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+from instrumentation import instrumented
+
+# Number of points sent to the spatial index per query, keeps the pair arrays bounded in memory
+QUERY_CHUNK_SIZE = 500_000
+
+# Number of paths sent to a point index per query when the index is over the points instead
+PATH_CHUNK_SIZE = 10_000
+
+@instrumented
+def build_path_index(bike_paths):
+    # Build an STRtree over the raw bike path linework (no buffer polygons needed)
+    return STRtree(np.asarray(bike_paths.geometry.values))
+
+@instrumented
+def query_points_near_paths(path_index, points, radius, chunk_size=QUERY_CHUNK_SIZE):
+    # Find every (point, path) pair where the point lies within the radius of the path
+    points = np.asarray(points)
+    point_idx = [np.empty(0, dtype=np.intp)]
+    path_idx = [np.empty(0, dtype=np.intp)]
+
+    for start in range(0, len(points), chunk_size):
+        pairs = path_index.query(points[start:start + chunk_size], predicate='dwithin', distance=radius)
+        point_idx.append(pairs[0] + start)
+        path_idx.append(pairs[1])
+
+    return np.concatenate(point_idx), np.concatenate(path_idx)
+
+@instrumented
+def build_point_index(points):
+    # Build an STRtree over the points, for queries made with the paths
+    return STRtree(np.asarray(points.geometry.values))
+
+@instrumented
+def query_paths_near_points(point_index, paths, radius, n_jobs=None, chunk_size=PATH_CHUNK_SIZE):
+    # The same (point, path) pairs as query_points_near_paths, from an index over the points queried with the paths.
+    # With millions of points and tens of thousands of paths this walks the tree once per path instead of once per point.
+    # Shapely releases the GIL inside the query, so chunks of paths run on threads sharing the one index
+    paths = np.asarray(paths)
+    n_jobs = n_jobs or os.cpu_count()
+    chunk_size = max(1, min(chunk_size, -(-len(paths) // n_jobs)))
+
+    def query_chunk(start):
+        pairs = point_index.query(paths[start:start + chunk_size], predicate='dwithin', distance=radius)
+        return pairs[1], pairs[0] + start
+
+    starts = range(0, len(paths), chunk_size)
+    if n_jobs > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(query_chunk, starts))
+    else:
+        results = [query_chunk(start) for start in starts]
+
+    point_idx = [np.empty(0, dtype=np.intp)] + [point_idx for point_idx, _ in results]
+    path_idx = [np.empty(0, dtype=np.intp)] + [path_idx for _, path_idx in results]
+    return np.concatenate(point_idx), np.concatenate(path_idx)
+
+@instrumented
+def pair_points_with_paths(bike_paths, points, radius):
+    # Ensure the points are in the same CRS as the bike paths
+    if points.crs != bike_paths.crs:
+        points = points.to_crs(bike_paths.crs)
+
+    # Table of every (point, path) pair within the radius, reusable for any weighting of the points
+    point_idx, path_idx = query_points_near_paths(build_path_index(bike_paths), points.geometry.values, radius)
+    return pd.DataFrame({'point_idx': point_idx, 'path_idx': path_idx})
+
+@instrumented
+def aggregate_by_path(point_idx, path_idx, n_paths, weights=None):
+    # Count (or sum the weights of) the points matched to each path
+    if weights is None:
+        return np.bincount(path_idx, minlength=n_paths)
+
+    weights = np.asarray(weights)
+    totals = np.bincount(path_idx, weights=weights[point_idx], minlength=n_paths)
+
+    # Keep integer scores integer, as a groupby sum would
+    if np.issubdtype(weights.dtype, np.integer):
+        totals = totals.astype(np.int64)
+    return totals
+
+@instrumented
+def score_points_near_paths(bike_paths, points, radius, weight_column=None, path_index=None):
+    # Ensure the points are in the same CRS as the bike paths
+    if points.crs != bike_paths.crs:
+        points = points.to_crs(bike_paths.crs)
+
+    if path_index is None:
+        path_index = build_path_index(bike_paths)
+
+    point_idx, path_idx = query_points_near_paths(path_index, points.geometry.values, radius)
+    weights = None if weight_column is None else points[weight_column].to_numpy()
+    totals = aggregate_by_path(point_idx, path_idx, len(bike_paths), weights)
+
+    return pd.Series(totals, index=bike_paths.index)
+
+@instrumented
+def score_points_multi_radius(bike_paths, points, radii, weight_column=None, prefix='score', path_index=None):
+    # Ensure the points are in the same CRS as the bike paths
+    if points.crs != bike_paths.crs:
+        points = points.to_crs(bike_paths.crs)
+
+    if path_index is None:
+        path_index = build_path_index(bike_paths)
+
+    radii = np.sort(np.asarray(radii, dtype=float))
+    n_paths, n_radii = len(bike_paths), len(radii)
+
+    # Query once at the largest radius and compute each pair's distance a single time
+    point_geoms = np.asarray(points.geometry.values)
+    path_geoms = np.asarray(bike_paths.geometry.values)
+    point_idx, path_idx = query_points_near_paths(path_index, point_geoms, radii[-1])
+    distances = shapely.distance(point_geoms[point_idx], path_geoms[path_idx])
+
+    # Bin every pair into the smallest radius that contains it (radii[k-1] < d <= radii[k])
+    radius_bin = np.minimum(np.searchsorted(radii, distances, side='left'), n_radii - 1)
+    flat_idx = path_idx * n_radii + radius_bin
+    weights = None if weight_column is None else points[weight_column].to_numpy()[point_idx]
+    binned = np.bincount(flat_idx, weights=weights, minlength=n_paths * n_radii).reshape(n_paths, n_radii)
+
+    # Cumulative sum over the bins gives the total within each radius
+    totals = binned.cumsum(axis=1)
+    if weights is None or np.issubdtype(weights.dtype, np.integer):
+        totals = totals.astype(np.int64)
+
+    columns = [f'{prefix}_{radius:g}ft' for radius in radii]
+    return pd.DataFrame(totals, index=bike_paths.index, columns=columns)
@@ -0,0 +1,80 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from grid_index import per_path_length
+from instrumentation import instrumented
+from safety_analysis import normalize_scores
+from scoring_engine import aggregate_by_path, build_point_index, query_paths_near_points
+from spatial_analysis import canopy_scores
+from traffic_exposure import exposure_normalized_scores
+
+# Length the per-segment scores are normalized to, in feet
+UNIT_LENGTH = 100
+
+# Totals per segment that add up over any grouping; every normalized score is recomputed from these after a roll-up
+TOTAL_COLUMNS = ['length_ft', 'tree_count', 'canopy_total', 'crash_count', 'crash_score']
+OPTIONAL_TOTAL_COLUMNS = ['vehicle_exposure']
+
+# Per-length scores that don't come from totals, rolled up as length-weighted means
+MEAN_COLUMNS = ['crash_density']
+
+@instrumented
+def pair_segment_points(segments, trees, crashes, tree_radius, crash_radius, n_jobs=None):
+    # Pair trees and crashes with the segments from indexes over the points, queried with chunks of segments in parallel
+    geometries = np.asarray(segments.geometry.values)
+    pairs = {}
+    for name, points, radius in (('trees', trees, tree_radius), ('crashes', crashes, crash_radius)):
+        point_idx, path_idx = query_paths_near_points(build_point_index(points), geometries, radius, n_jobs)
+        pairs[name] = pd.DataFrame({'point_idx': point_idx, 'path_idx': path_idx})
+    return pairs
+
+def add_normalized_scores(table, unit_length=UNIT_LENGTH):
+    # Per-length scores from the totals, so segments and groups of any length compare; NaN where there is no length
+    length = table['length_ft'].to_numpy(dtype=float)
+    table['tree_density'] = per_path_length(table['tree_count'].to_numpy(dtype=float), length, unit_length)
+    table['canopy_score'] = per_path_length(table['canopy_total'].to_numpy(dtype=float), length, unit_length)
+    table['safety_score'] = per_path_length(table['crash_score'].to_numpy(dtype=float), length, unit_length)
+    if 'vehicle_exposure' in table.columns:
+        table['safety_per_exposure'] = exposure_normalized_scores(table, 'crash_score')
+    return normalize_scores(table)
+
+@instrumented
+def score_segments(segments, trees, crashes, point_pairs, unit_length=UNIT_LENGTH):
+    # Totals of every segment, then the same scores as the cluster pipeline per unit_length feet of path
+    n_segments = len(segments)
+    tree_pairs, crash_pairs = point_pairs['trees'], point_pairs['crashes']
+    segments['tree_count'] = aggregate_by_path(tree_pairs['point_idx'].to_numpy(), tree_pairs['path_idx'].to_numpy(), n_segments)
+    segments['canopy_total'] = canopy_scores(tree_pairs, trees, n_segments)
+    segments['crash_count'] = aggregate_by_path(crash_pairs['point_idx'].to_numpy(), crash_pairs['path_idx'].to_numpy(), n_segments)
+    segments['crash_score'] = aggregate_by_path(
+        crash_pairs['point_idx'].to_numpy(), crash_pairs['path_idx'].to_numpy(), n_segments, crashes['safety_score'].to_numpy()
+    )
+    return add_normalized_scores(segments, unit_length)
+
+@instrumented
+def roll_up(segments, by, unit_length=UNIT_LENGTH):
+    # Group scored segments by one or more columns: totals add up and the per-length scores are recomputed from them,
+    # so a group's score is its length-weighted mean whatever the grouping. The geometry collects the segments' lines
+    by = [by] if isinstance(by, str) else list(by)
+    codes, groups = pd.MultiIndex.from_frame(segments[by]).factorize() if len(by) > 1 else pd.factorize(segments[by[0]])
+    valid = codes >= 0
+    columns = TOTAL_COLUMNS + [col for col in OPTIONAL_TOTAL_COLUMNS if col in segments.columns]
+
+    totals = {col: np.bincount(codes[valid], weights=segments[col].to_numpy(dtype=float)[valid], minlength=len(groups))
+              for col in columns}
+    totals['segments'] = np.bincount(codes[valid], minlength=len(groups))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for col in [col for col in MEAN_COLUMNS if col in segments.columns]:
+            weighted = segments[col].to_numpy(dtype=float)[valid] * segments['length_ft'].to_numpy(dtype=float)[valid]
+            totals[col] = np.bincount(codes[valid], weights=weighted, minlength=len(groups)) / totals['length_ft']
+    keys = pd.DataFrame(list(groups), columns=by) if len(by) > 1 else pd.DataFrame({by[0]: groups})
+
+    # Every linear part of the group's segments in one multi-line geometry, no union needed
+    parts, part_idx = shapely.get_parts(np.asarray(segments.geometry.values)[valid], return_index=True)
+    part_codes = codes[valid][part_idx]
+    order = np.argsort(part_codes, kind='stable')
+    geometry = shapely.multilinestrings(parts[order], indices=part_codes[order], out=np.full(len(groups), None, dtype=object))
+
+    table = gpd.GeoDataFrame(keys.assign(**totals), geometry=geometry, crs=segments.crs)
+    return add_normalized_scores(table, unit_length)
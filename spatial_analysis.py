@@ -1,93 +1,81 @@
-import geopandas as gpd
-import matplotlib.pyplot as plt
-from shapely.ops import unary_union
-from shapely.geometry import LineString, MultiLineString, GeometryCollection
-from sklearn.cluster import KMeans
-import numpy as np
-from matplotlib.colors import TwoSlopeNorm
+import argparse
+import os
+from columnar_io import read_trees
+from instrumentation import instrumented, tracing
+from bike_network import PROJECTED_CRS, load_bike_paths, prepare_bike_paths
+from scoring_engine import score_points_multi_radius, pair_points_with_paths, aggregate_by_path
+from plotting import finish_figure, new_figure
+from ranking import ranking_columns, top_k
+from stage_cache import StageCache
 
-def load_data(bike_path_file, tree_data_file):
-    # Load the bike paths and tree data GeoJSON files
-    bike_paths = gpd.read_file(bike_path_file)
-    trees = gpd.read_file(tree_data_file)
-    return bike_paths, trees
+# Buffer radii (in feet, the unit of EPSG:2263) compared in sweep mode
+SWEEP_RADII = [25, 50, 100, 200]
 
-def cluster_bike_paths(bike_paths, n_clusters=50):
-    # Extract centroids for clustering
-    centroids = np.array([geom.centroid.coords[0] for geom in bike_paths.geometry])
-    
-    # Perform KMeans clustering
-    kmeans = KMeans(n_clusters=n_clusters, random_state=0).fit(centroids)
-    bike_paths['cluster'] = kmeans.labels_
-    
-    return bike_paths
+DBH_COLUMN = 'Tree Diameter at Breast Height (cm)'
 
-def combine_bike_paths(bike_paths):
-    combined_bike_paths = []
-    
-    # Combine bike paths within each cluster
-    for cluster in bike_paths['cluster'].unique():
-        cluster_paths = bike_paths[bike_paths['cluster'] == cluster]
-        combined_cluster_path = unary_union(cluster_paths.geometry)
-        
-        if isinstance(combined_cluster_path, (LineString, MultiLineString)):
-            combined_bike_paths.append(combined_cluster_path)
-        elif isinstance(combined_cluster_path, GeometryCollection):
-            for geom in combined_cluster_path:
-                if isinstance(geom, (LineString, MultiLineString)):
-                    combined_bike_paths.append(geom)
-        else:
-            print(f"Unhandled geometry type: {type(combined_cluster_path)}")
-    
-    print(f"Number of combined bike path segments: {len(combined_bike_paths)}")
-    
-    return gpd.GeoDataFrame(geometry=combined_bike_paths, crs=bike_paths.crs)
+OUTPUT_DIR = './Bike Lane groupings'
 
-def create_buffers(bike_paths, buffer_radius=100):
-    # Ensure bike paths are in a projected CRS suitable for buffering
-    print("Reprojecting bike paths to a projected CRS for buffering...")
-    bike_paths = bike_paths.to_crs(epsg=2263)
-    
-    # Create a buffer around the combined bike path segments
-    print(f"Creating buffers around bike paths with a radius of {buffer_radius} meters...")
-    bike_paths['buffer'] = bike_paths.geometry.buffer(buffer_radius)
-    
-    return bike_paths
+# Cached pipeline stages, in the order they run
+PIPELINE_STAGES = ['combine', 'tree_points', 'tree_pairs']
 
-def count_trees_in_buffers(bike_paths, trees):
-    # Ensure the trees are in the same CRS as the buffered bike paths
-    print("Ensuring the trees and bike paths have the same CRS...")
-    trees = trees.to_crs(bike_paths.crs)
-    
-    # Perform a spatial join to count the number of trees within each buffer
-    print("Performing spatial join to count trees within buffers...")
-    tree_counts = gpd.sjoin(trees, bike_paths.set_geometry('buffer'), how='inner', predicate='within')
-    
-    # Count the number of trees in each bike path buffer
-    print("Counting the number of trees in each buffer...")
-    tree_density = tree_counts.groupby(tree_counts.index).size()
-    
-    # Debugging: Print tree density values
-    print(tree_density)
-    
-    # Assign the tree density to the bike paths GeoDataFrame
-    print("Assigning tree density to bike paths...")
-    bike_paths['tree_density'] = bike_paths.index.map(tree_density).fillna(0)
-    
-    # Debugging: Check if tree density values are correctly assigned
-    print(bike_paths['tree_density'].describe())
-    
-    return bike_paths
+@instrumented
+def load_data(bike_path_file, tree_data_file):
+    # Load the bike paths GeoJSON file and the processed trees (coordinate Parquet or GeoJSON)
+    bike_paths = load_bike_paths(bike_path_file)
+    trees = read_trees(tree_data_file)
+    return bike_paths, trees
+
+@instrumented
+def prepare_tree_points(tree_data_file):
+    # Load the trees, projected to the same CRS as the bike paths
+    trees = read_trees(tree_data_file)
+    return trees if trees.crs == PROJECTED_CRS else trees.to_crs(PROJECTED_CRS)
+
+@instrumented
+def canopy_scores(tree_pairs, trees, n_paths):
+    # Sum of trunk diameters near each path, so large trees count for more than saplings
+    return aggregate_by_path(
+        tree_pairs['point_idx'].to_numpy(), tree_pairs['path_idx'].to_numpy(), n_paths, trees[DBH_COLUMN].to_numpy()
+    )
+
+def tree_density_by_cell(grid, level=0):
+    # Trees and canopy per grid cell, plus trees per 1000 feet of bike path so areas compare fairly
+    from grid_index import per_path_length
+
+    names = [name for name in ('trees', 'canopy', 'path_length') if name in grid.layers]
+    cells = grid.cell_table(level, names)
+    cells['trees_per_1000ft'] = per_path_length(cells['trees'].to_numpy(), cells['path_length'].to_numpy())
+    return cells
+
+@instrumented
+def sweep_tree_radii(bike_paths, trees, radii=SWEEP_RADII):
+    # Count trees at every radius from a single spatial pass over the trees
+    print(f"Counting trees within {', '.join(f'{r:g}' for r in sorted(radii))} feet of bike paths...")
+    tree_counts = score_points_multi_radius(bike_paths, trees, radii, prefix='tree_density')
+    
+    return bike_paths.join(tree_counts)
+
+def output_radius_sweep(bike_paths, filename):
+    # Compare how the path rankings change between radii
+    density_columns = [col for col in bike_paths.columns if col.startswith('tree_density_')]
+    print("Rank correlation of tree density between radii:")
+    print(bike_paths[density_columns].corr(method='spearman'))
+    
+    # Output the per-radius tree counts for every path
+    bike_paths[density_columns].to_csv(filename, index_label='path_id')
+
+@instrumented
+def plot_results(bike_paths, most_green_clusters, least_green_clusters, score_column='tree_density', output_file=None, show=True):
+    from matplotlib.colors import TwoSlopeNorm
 
-def plot_results(bike_paths, most_green_clusters, least_green_clusters):
     print("Plotting results...")
     # Plot the results with a gradient based on tree density
-    fig, ax = plt.subplots(figsize=(10, 10))
+    fig, ax = new_figure()
     
     # Normalize tree density values for better color differentiation
-    vmin = bike_paths['tree_density'].min()
-    vcenter = bike_paths['tree_density'].mean()
-    vmax = bike_paths['tree_density'].max()
+    vmin = bike_paths[score_column].min()
+    vcenter = bike_paths[score_column].mean()
+    vmax = bike_paths[score_column].max()
 
     print("vmin:", vmin)
     print("vcenter:", vcenter)
@@ -100,7 +88,7 @@ def plot_results(bike_paths, most_green_clusters, least_green_clusters):
     norm = TwoSlopeNorm(vmin=vmin, vcenter=vcenter, vmax=vmax)
     
     # Plot bike paths with a gradient color based on tree density
-    bike_paths.plot(ax=ax, column='tree_density', cmap='RdYlGn', linewidth=2, legend=True, norm=norm)
+    bike_paths.plot(ax=ax, column=score_column, cmap='RdYlGn', linewidth=2, legend=True, norm=norm)
     
     # Highlight the most green clusters in green
     most_green_clusters.plot(ax=ax, color='green', linewidth=2, label='Most Green Clusters')
@@ -112,65 +100,85 @@ def plot_results(bike_paths, most_green_clusters, least_green_clusters):
     handles, labels = ax.get_legend_handles_labels()
     ax.legend(handles, labels)
     
-    plt.title('Bike Paths with Normalized Tree Density')
-    plt.show()
+    ax.set_title('Bike Paths with Normalized Tree Density')
+    finish_figure(fig, output_file, show)
 
-def output_cluster_info(bike_paths):
+@instrumented
+def output_cluster_info(bike_paths, score_column='tree_density', output_dir=OUTPUT_DIR, k=5):
     print("Outputting cluster information for Google Maps...")
 
-    # Sort bike paths by tree density
-    sorted_bike_paths = bike_paths.sort_values(by='tree_density', ascending=False)
-    
-    # Get the five most and least green clusters
-    most_green_clusters = sorted_bike_paths.head(5)
-    least_green_clusters = sorted_bike_paths.tail(5)
+    # Select the k most and least green clusters by tree density (or canopy score) without sorting the whole network;
+    # the least green stay in descending order
+    scores = bike_paths[score_column].to_numpy(dtype=float)
+    most_green_clusters = bike_paths.iloc[top_k(scores, k, largest=True)]
+    least_green_clusters = bike_paths.iloc[top_k(scores, k, largest=False)[::-1]]
     
-    # Drop additional geometry columns before outputting to GeoJSON
-    most_green_clusters = most_green_clusters.drop(columns=['buffer'])
-    least_green_clusters = least_green_clusters.drop(columns=['buffer'])
-    
-    # Output the results
-    most_green_clusters.to_file("./Bike Lane groupings/most_green_clusters.geojson", driver='GeoJSON')
-    least_green_clusters.to_file("./Bike Lane groupings/least_green_clusters.geojson", driver='GeoJSON')
+    # Output the results, without the intermediate columns
+    columns = ranking_columns(bike_paths, [score_column])
+    most_green_clusters[columns].to_file(os.path.join(output_dir, 'most_green_clusters.geojson'), driver='GeoJSON')
+    least_green_clusters[columns].to_file(os.path.join(output_dir, 'least_green_clusters.geojson'), driver='GeoJSON')
     
     print("Most green clusters and least green clusters have been outputted to GeoJSON files.")
     
     return most_green_clusters, least_green_clusters
 
-def main():
+def main(sweep_radii=None, use_cache=True, rebuild_from=None, rank_by='tree_density', bike_path_file='processed_bike_paths.geojson',
+         tree_data_file='processed_tree_data.parquet', output_dir=OUTPUT_DIR, plot_file=None, show_plot=True, clustering='kmeans'):
     try:
-        # Load the processed data
-        print("Loading data...")
-        bike_paths, trees = load_data('processed_bike_paths.geojson', 'processed_tree_data.geojson')
-
-        # Cluster the bike path segments
-        print("Clustering bike paths...")
-        bike_paths = cluster_bike_paths(bike_paths, n_clusters=100)
-
-        # Combine bike path segments within each cluster
-        print("Combining bike paths...")
-        combined_bike_paths = combine_bike_paths(bike_paths)
-
-        # Create buffers around the combined bike paths
-        print("Creating buffers...")
-        buffered_bike_paths = create_buffers(combined_bike_paths)
-
-        # Count trees within the buffers
-        print("Counting trees within buffers...")
-        bike_paths_with_density = count_trees_in_buffers(buffered_bike_paths, trees)
-
-        # Reproject buffered bike paths back to the original CRS
+        cache = StageCache(enabled=use_cache, rebuild_from=rebuild_from, stage_order=PIPELINE_STAGES)
+
+        # Load, cluster, combine and project the bike path segments
+        print("Loading, clustering and combining bike paths...")
+        projected_bike_paths = cache.run('combine', prepare_bike_paths, bike_path_file, n_clusters=100, method=clustering,
+                                         input_files=[bike_path_file])
+
+        # Load the tree data
+        print("Loading tree data...")
+        trees = cache.run('tree_points', prepare_tree_points, tree_data_file, input_files=[tree_data_file])
+
+        # Compare tree counts across several radii instead of a single scoring run
+        if sweep_radii:
+            print("Sweeping buffer radii...")
+            bike_paths_swept = sweep_tree_radii(projected_bike_paths, trees, sweep_radii)
+            output_radius_sweep(bike_paths_swept, os.path.join(output_dir, 'tree_radius_sweep.csv'))
+            return
+
+        # Count trees near the bike paths
+        print("Counting trees near bike paths...")
+        tree_pairs = cache.run('tree_pairs', pair_points_with_paths, projected_bike_paths, trees, radius=100,
+                               depends_on=['combine', 'tree_points'])
+        projected_bike_paths['tree_density'] = aggregate_by_path(
+            tree_pairs['point_idx'].to_numpy(), tree_pairs['path_idx'].to_numpy(), len(projected_bike_paths)
+        )
+        projected_bike_paths['canopy_score'] = canopy_scores(tree_pairs, trees, len(projected_bike_paths))
+        bike_paths_with_density = projected_bike_paths
+
+        # Reproject bike paths back to the original CRS
         bike_paths_with_density = bike_paths_with_density.to_crs(epsg=4326)
 
         # Output the most and least green clusters
-        most_green_clusters, least_green_clusters = output_cluster_info(bike_paths_with_density)
+        most_green_clusters, least_green_clusters = output_cluster_info(bike_paths_with_density, rank_by, output_dir)
 
-        # Plot the results
-        print("Plotting results...")
-        plot_results(bike_paths_with_density, most_green_clusters, least_green_clusters)
+        # Plot the results, unless a batch run asked for no plot at all
+        if plot_file or show_plot:
+            print("Plotting results...")
+            plot_results(bike_paths_with_density, most_green_clusters, least_green_clusters, rank_by, plot_file, show_plot)
 
     except Exception as e:
         print(f"An error occurred: {e}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Score bike paths by the number of nearby trees.")
+    parser.add_argument('--sweep', nargs='*', type=float, metavar='FEET',
+                        help=f"Score every path at several buffer radii in one pass (default: {SWEEP_RADII})")
+    parser.add_argument('--no-cache', action='store_true', help="Recompute every stage without reading or writing the stage cache")
+    parser.add_argument('--rebuild-from', choices=PIPELINE_STAGES, help="Recompute this stage and every stage after it")
+    parser.add_argument('--rank-by', choices=['tree_density', 'canopy_score'], default='tree_density',
+                        help="Rank paths by tree count or by the diameter-weighted canopy score (default: tree_density)")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="Record per-stage time, rows, vertices and peak memory; FILE.json opens in a Chrome trace viewer, other names get JSON lines")
+    parser.add_argument('--profile', metavar='FILE', help="Also run under cProfile and write the stats to FILE (.prof)")
+    args = parser.parse_args()
+    with tracing(args.trace, args.profile):
+        main(sweep_radii=SWEEP_RADII if args.sweep == [] else args.sweep, use_cache=not args.no_cache, rebuild_from=args.rebuild_from,
+             rank_by=args.rank_by)
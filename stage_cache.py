@@ -0,0 +1,194 @@
+import dis
+import glob
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import json
+import os
+import pickle
+import sys
+import geopandas as gpd
+import pandas as pd
+from instrumentation import stage
+
+CACHE_DIR = '.stage_cache'
+MAX_CACHE_BYTES = 4 * 1024 ** 3
+
+# Only code defined in this project contributes its source to the code version
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Module-level settings referenced by stage code are part of its version too
+CONSTANT_TYPES = (bool, int, float, str, bytes, tuple, list, dict, set, frozenset)
+
+def in_project(path):
+    return bool(path) and os.path.abspath(path).startswith(PROJECT_DIR)
+
+def project_module(name):
+    # A project module imported by name; modules outside the project aren't imported just to be skipped
+    module = sys.modules.get(name)
+    if module is None:
+        spec = importlib.util.find_spec(name.partition('.')[0])
+        if spec is None or not in_project(spec.origin):
+            return None
+        module = importlib.import_module(name)
+    return module if in_project(getattr(module, '__file__', None)) else None
+
+def code_objects(code):
+    # A function's code and that of every function, lambda and comprehension nested in it
+    yield code
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            yield from code_objects(const)
+
+def referenced_objects(func):
+    # Globals the code names, names it imports inside its body and attributes it reads from project modules
+    names, objects = [], []
+    for code in code_objects(func.__code__):
+        names.extend(code.co_names)
+        module = None
+        for instruction in dis.get_instructions(code):
+            if instruction.opname == 'IMPORT_NAME':
+                module = project_module(instruction.argval)
+                objects.append(module)
+            elif instruction.opname == 'IMPORT_FROM' and module is not None:
+                objects.append(getattr(module, instruction.argval, None))
+    objects.extend(func.__globals__.get(name) for name in names)
+    modules = [obj for obj in objects if inspect.ismodule(obj) and in_project(getattr(obj, '__file__', None))]
+    objects.extend(getattr(module, name, None) for module in modules for name in names)
+    return objects
+
+def code_fingerprint(func, seen=None):
+    # Hash the source of a stage function and of every project function and class it references, directly,
+    # through a module or imported inside a function body. Wrapped functions (instrumented, lru_cache) are
+    # hashed by the function they wrap, and referenced module constants by their value
+    seen = set() if seen is None else seen
+    if id(func) in seen:
+        return ''
+    seen.add(id(func))
+
+    if isinstance(func, (set, frozenset)):
+        # Sorted, since set order changes between runs with string hash randomization
+        return repr(sorted(map(repr, func)))
+    if isinstance(func, CONSTANT_TYPES):
+        return repr(func)
+    if callable(func) and hasattr(func, '__wrapped__'):
+        func = inspect.unwrap(func)
+    if not (inspect.isfunction(func) or inspect.isclass(func)):
+        return ''
+    try:
+        source = inspect.getsource(func)
+        source_file = inspect.getsourcefile(func)
+    except (OSError, TypeError):
+        return ''
+    if not in_project(source_file):
+        return ''
+
+    parts = [source]
+    methods = [member for member in vars(func).values() if inspect.isfunction(member)] if inspect.isclass(func) else [func]
+    for method in methods:
+        parts.extend(code_fingerprint(referenced, seen) for referenced in referenced_objects(method))
+    return '\n'.join(parts)
+
+def file_fingerprint(file_path):
+    # Identify input files by path, size and modification time instead of hashing gigabytes of content
+    paths = sorted(glob.glob(os.path.join(file_path, '**', '*'), recursive=True)) if os.path.isdir(file_path) else [file_path]
+    stats = []
+    for path in paths:
+        stat = os.stat(path)
+        stats.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    return stats
+
+def is_frame(value):
+    return isinstance(value, (pd.DataFrame, pd.Series))
+
+class StageCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, enabled=True, rebuild_from=None, stage_order=()):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.keys = {}
+
+        # Stages from rebuild_from onwards are recomputed even when a cached entry exists
+        stage_order = list(stage_order)
+        if rebuild_from is not None and rebuild_from not in stage_order:
+            raise ValueError(f"Unknown stage {rebuild_from!r}, expected one of {stage_order}")
+        self.forced_stages = set(stage_order[stage_order.index(rebuild_from):]) if rebuild_from else set()
+
+    def stage_key(self, name, func, args, kwargs, input_files, depends_on):
+        # Frame arguments come from upstream stages and are represented by those stages' keys
+        params = {
+            'args': [None if is_frame(arg) else arg for arg in args],
+            'kwargs': {key: None if is_frame(value) else value for key, value in kwargs.items()},
+        }
+        digest = hashlib.sha256()
+        digest.update(name.encode())
+        digest.update(code_fingerprint(func).encode())
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        digest.update(json.dumps([file_fingerprint(path) for path in input_files]).encode())
+        digest.update(json.dumps([self.keys[stage] for stage in depends_on]).encode())
+        return digest.hexdigest()[:24]
+
+    def run(self, name, func, *args, input_files=(), depends_on=(), **kwargs):
+        # Return the cached result of a stage, computing and storing it on a miss
+        key = self.stage_key(name, func, args, kwargs, input_files, depends_on)
+        self.keys[name] = key
+        with stage(f'cache.{name}') as record:
+            if not self.enabled:
+                return func(*args, **kwargs)
+
+            entries = [path for path in glob.glob(os.path.join(self.cache_dir, f'{name}-{key}.*')) if not path.endswith('.tmp')]
+            hit = bool(entries) and name not in self.forced_stages
+            if record is not None:
+                record['cache_hit'] = hit
+            if hit:
+                print(f"Using cached result for stage '{name}'")
+                os.utime(entries[0])  # Mark as recently used for LRU eviction
+                return self.load_entry(entries[0])
+
+            result = func(*args, **kwargs)
+            self.store_entry(name, key, result)
+            self.evict()
+            return result
+
+    def load_entry(self, path):
+        if path.endswith('.geoparquet'):
+            return gpd.read_parquet(path)
+        if path.endswith('.parquet'):
+            return pd.read_parquet(path)
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    def store_entry(self, name, key, result):
+        # Frames go to (Geo)Parquet, anything else is pickled; written atomically via a temporary file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if isinstance(result, gpd.GeoDataFrame):
+            extension = 'geoparquet'
+        elif isinstance(result, pd.DataFrame):
+            extension = 'parquet'
+        else:
+            extension = 'pkl'
+
+        path = os.path.join(self.cache_dir, f'{name}-{key}.{extension}')
+        temp_path = path + '.tmp'
+        if extension == 'pkl':
+            with open(temp_path, 'wb') as file:
+                pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            result.to_parquet(temp_path)
+        os.replace(temp_path, path)
+
+    def evict(self):
+        # Drop the least recently used entries until the cache fits in its size budget
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and not entry.name.endswith('.tmp')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+
+        total_bytes = 0
+        for position, entry in enumerate(entries):
+            size = entry.stat().st_size
+            # The newest entry is always kept, even if it alone exceeds the budget
+            if total_bytes + size > self.max_bytes and position > 0:
+                os.remove(entry.path)
+                print(f"Evicted cached stage result {entry.name}")
+            else:
+                total_bytes += size
@@ -1,13 +1,13 @@
-import pandas as pd
-import matplotlib.pyplot as plt
+import os
+from columnar_io import read_collisions, read_traffic_counts
+from plotting import finish_figure, new_figure
 
 def load_traffic_data(file_path):
-    traffic_data = pd.read_csv(file_path)
+    traffic_data = read_traffic_counts(file_path)
     return traffic_data
 
 def process_traffic_data(traffic_data):
-    # Filtering data from 2015 onwards
-    traffic_data['Last Day of Count'] = pd.to_datetime(traffic_data['Last Day of Count'])
+    # Filtering data from 2015 onwards; 'Last Day of Count' is already a datetime column
     traffic_data_filtered = traffic_data[traffic_data['Last Day of Count'].dt.year >= 2015]
 
     # Aggregating traffic volume by time of day
@@ -16,61 +16,70 @@ def process_traffic_data(traffic_data):
 
     return traffic_sums
 
-def plot_traffic_data(traffic_sums):
+def plot_traffic_data(traffic_sums, output_file=None, show=True):
     # Plotting traffic volume by time of day
-    plt.figure(figsize=(12, 6))
+    fig, ax = new_figure(figsize=(12, 6))
     traffic_sums.index = [col.replace('sum', '').strip() for col in traffic_sums.index]
-    traffic_sums.plot(kind='bar')
-    plt.title('Traffic Volume by Time of Day (2015 to 2020)')
-    plt.xlabel('Time of Day')
-    plt.ylabel('Total Traffic Volume')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.show()
+    traffic_sums.plot(kind='bar', ax=ax)
+    ax.set_title('Traffic Volume by Time of Day (2015 to 2020)')
+    ax.set_xlabel('Time of Day')
+    ax.set_ylabel('Total Traffic Volume')
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+    finish_figure(fig, output_file, show)
 
 def load_collision_data(file_path):
-    collision_data = pd.read_csv(file_path)
+    collision_data = read_collisions(file_path, columns=['CRASH DATE', 'CRASH DATETIME'])
     return collision_data
 
 def process_collision_data(collision_data):
     # Filtering data from 2015 onwards
-    collision_data['CRASH DATE'] = pd.to_datetime(collision_data['CRASH DATE'])
-    collision_data_filtered = collision_data[collision_data['CRASH DATE'].dt.year >= 2015]
+    collision_data_filtered = collision_data[collision_data['CRASH DATE'].dt.year >= 2015].copy()
 
-    # Extracting hour from CRASH TIME
-    collision_data_filtered['HOUR'] = pd.to_datetime(collision_data_filtered['CRASH TIME'], format='%H:%M:%S').dt.hour
+    # Extracting hour from the already parsed CRASH DATETIME
+    collision_data_filtered['HOUR'] = collision_data_filtered['CRASH DATETIME'].dt.hour
 
     # Aggregatting crashes by time of day
     hourly_crashes = collision_data_filtered['HOUR'].value_counts().sort_index()
 
     return hourly_crashes
 
-def plot_collision_data(hourly_crashes):
+def plot_collision_data(hourly_crashes, output_file=None, show=True):
     # Plotting number of crashes by time of day
-    plt.figure(figsize=(12, 6))
+    fig, ax = new_figure(figsize=(12, 6))
     hourly_crashes.index = [f'{hour % 12 if hour % 12 != 0 else 12} {"AM" if hour < 12 else "PM"}' for hour in hourly_crashes.index]
-    hourly_crashes.plot(kind='bar')
-    plt.title('Number of Crashes by Time of Day (2015 to 2024)')
-    plt.xlabel('Time of Day')
-    plt.ylabel('Number of Crashes')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.show()
+    hourly_crashes.plot(kind='bar', ax=ax)
+    ax.set_title('Number of Crashes by Time of Day (2015 to 2024)')
+    ax.set_xlabel('Time of Day')
+    ax.set_ylabel('Number of Crashes')
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+    finish_figure(fig, output_file, show)
 
-def main():
+def main(traffic_file='aggregated_traffic_volume_counts.parquet', crash_data_file='cleaned_motor_vehicle_collisions.parquet',
+         plot_dir=None, show_plot=True):
     # Traffic Volume Analysis
     print("Loading and processing traffic volume data...")
-    traffic_data = load_traffic_data('aggregated_traffic_volume_counts.csv')
+    traffic_data = load_traffic_data(traffic_file)
     traffic_sums = process_traffic_data(traffic_data)
-    print("Plotting traffic volume data...")
-    plot_traffic_data(traffic_sums)
+
+    # Plot only when the figure is saved or shown, so batch runs never load matplotlib
+    plotting = bool(plot_dir or show_plot)
+    if plotting:
+        print("Plotting traffic volume data...")
+        plot_traffic_data(traffic_sums, plot_dir and os.path.join(plot_dir, 'traffic_by_hour.png'), show_plot)
+    else:
+        print(traffic_sums.to_string())
 
     # Collision Data Analysis
     print("Loading and processing collision data...")
-    collision_data = load_collision_data('cleaned_motor_vehicle_collisions.csv')
+    collision_data = load_collision_data(crash_data_file)
     hourly_crashes = process_collision_data(collision_data)
-    print("Plotting collision data...")
-    plot_collision_data(hourly_crashes)
+    if plotting:
+        print("Plotting collision data...")
+        plot_collision_data(hourly_crashes, plot_dir and os.path.join(plot_dir, 'crashes_by_hour.png'), show_plot)
+    else:
+        print(hourly_crashes.rename('crashes').rename_axis('hour').to_string())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+from bike_network import PROJECTED_CRS
+from columnar_io import read_traffic_counts
+
+FEET_PER_MILE = 5280
+
+# Spellings of street types and directions mapped to the short forms used in both datasets
+STREET_ABBREVIATIONS = {
+    'STREET': 'ST', 'AVENUE': 'AVE', 'AV': 'AVE', 'BOULEVARD': 'BLVD', 'ROAD': 'RD', 'PLACE': 'PL',
+    'DRIVE': 'DR', 'PARKWAY': 'PKWY', 'PKY': 'PKWY', 'EXPRESSWAY': 'EXPY', 'HIGHWAY': 'HWY', 'LANE': 'LN',
+    'TERRACE': 'TER', 'COURT': 'CT', 'BRIDGE': 'BR', 'SQUARE': 'SQ', 'TURNPIKE': 'TPKE',
+    'EAST': 'E', 'WEST': 'W', 'NORTH': 'N', 'SOUTH': 'S',
+}
+
+# How a path was matched to the traffic counts, from most to least specific
+MATCH_LEVELS = ['segment', 'cross street', 'street', 'none']
+
+def canonical_street_names(names):
+    # Canonicalize each distinct name once: upper case, no punctuation, no ordinal suffixes, abbreviated types
+    codes, uniques = pd.factorize(pd.Series(names).astype(object).fillna('').astype(str))
+    canonical = (
+        pd.Series(uniques).str.upper()
+        .str.replace(r"[^A-Z0-9 ]", ' ', regex=True)
+        .str.replace(r'\b(\d+)(?:ST|ND|RD|TH)\b', r'\1', regex=True)
+        .str.split()
+        .map(lambda words: ' '.join(STREET_ABBREVIATIONS.get(word, word) for word in words))
+    )
+    return canonical.to_numpy(dtype=object)[codes]
+
+def segment_keys(street, from_street, to_street):
+    # Canonical street plus the two cross streets in a fixed order, so either direction gives the same key
+    street, from_street, to_street = (canonical_street_names(names) for names in (street, from_street, to_street))
+    swap = from_street > to_street
+    return street, np.where(swap, to_street, from_street), np.where(swap, from_street, to_street)
+
+def load_traffic_segments(traffic_file):
+    # Aggregated counts per roadway segment with the average vehicles per counted day
+    segments = read_traffic_counts(traffic_file)
+    hour_columns = [col for col in segments.columns if col.endswith('sum')]
+    segments['daily_volume'] = segments[hour_columns].sum(axis=1) / segments['Number of Days Measured']
+    return segments[['Roadway Name', 'From', 'To', 'daily_volume']]
+
+def build_street_index(segments):
+    # Hash indexes from canonical keys to the mean daily volume, one per matching level
+    street, cross_a, cross_b = segment_keys(segments['Roadway Name'], segments['From'], segments['To'])
+    volume = segments['daily_volume'].to_numpy()
+    keyed = pd.DataFrame({'street': street, 'cross_a': cross_a, 'cross_b': cross_b, 'daily_volume': volume})
+
+    # Each end of a counted segment also indexes the segment by street and that cross street
+    ends = pd.concat([
+        keyed[['street', 'cross_a', 'daily_volume']].rename(columns={'cross_a': 'cross'}),
+        keyed[['street', 'cross_b', 'daily_volume']].rename(columns={'cross_b': 'cross'}),
+    ])
+    # The counts have no borough, so the street level is keyed once the paths place the counted segments in one
+    return {
+        'segment': keyed.groupby(['street', 'cross_a', 'cross_b'])['daily_volume'].mean(),
+        'cross street': ends[ends['cross'] != ''].groupby(['street', 'cross'])['daily_volume'].mean(),
+        'counted': keyed,
+    }
+
+def street_volume_by_borough(counted, street, cross_a, cross_b, borough):
+    # Mean daily volume per (borough, street), so a street name shared across boroughs (e.g. Broadway) doesn't
+    # mix their counts. A counted segment is in the borough of the paths on its street that share one of its
+    # ends, or else in the only borough with paths on its street; other counted segments aren't used here
+    path_ends = pd.DataFrame({'street': np.concatenate([street, street]), 'cross': np.concatenate([cross_a, cross_b]),
+                              'borough': np.concatenate([borough, borough])})
+    path_ends = path_ends[path_ends['cross'] != ''].drop_duplicates()
+    counted_ends = pd.concat([
+        counted[['street', 'cross_a']].rename(columns={'cross_a': 'cross'}),
+        counted[['street', 'cross_b']].rename(columns={'cross_b': 'cross'}),
+    ]).reset_index(names='segment')
+    located = counted_ends.merge(path_ends, on=['street', 'cross'])[['segment', 'borough']]
+
+    path_streets = pd.DataFrame({'street': street, 'borough': borough}).drop_duplicates()
+    single_borough = path_streets[~path_streets['street'].duplicated(keep=False)].set_index('street')['borough']
+    unlocated = counted[~counted.index.isin(located['segment'])]
+    unlocated = pd.DataFrame({'segment': unlocated.index, 'borough': single_borough.reindex(unlocated['street']).to_numpy()})
+
+    located = pd.concat([located, unlocated.dropna()]).drop_duplicates()
+    located = located.join(counted[['street', 'daily_volume']], on='segment')
+    return located.groupby(['borough', 'street'])['daily_volume'].mean().reindex(pd.MultiIndex.from_arrays([borough, street])).to_numpy()
+
+def match_traffic_volume(bike_paths, street_index):
+    # Look up every path at the most specific level that has a count, falling back to its street in its borough
+    street, cross_a, cross_b = segment_keys(bike_paths['Street Name'], bike_paths['From Street'], bike_paths['To Street'])
+
+    segment_volume = street_index['segment'].reindex(pd.MultiIndex.from_arrays([street, cross_a, cross_b])).to_numpy()
+    # A path can match counted segments at either end; average whichever ends matched
+    cross_volume = pd.DataFrame({
+        'from': street_index['cross street'].reindex(pd.MultiIndex.from_arrays([street, cross_a])).to_numpy(),
+        'to': street_index['cross street'].reindex(pd.MultiIndex.from_arrays([street, cross_b])).to_numpy(),
+    }).mean(axis=1).to_numpy()
+    # Paths without a borough only fall back to counts that paths without a borough placed
+    borough = (bike_paths['Borough'].astype(object).fillna('').to_numpy() if 'Borough' in bike_paths.columns
+               else np.full(len(bike_paths), '', dtype=object))
+    street_volume = street_volume_by_borough(street_index['counted'], street, cross_a, cross_b, borough)
+
+    levels = [segment_volume, cross_volume, street_volume]
+    volume = np.full(len(bike_paths), np.nan)
+    match = np.full(len(bike_paths), len(levels))
+    for level, level_volume in reversed(list(enumerate(levels))):
+        found = ~np.isnan(level_volume)
+        volume[found] = level_volume[found]
+        match[found] = level
+
+    return volume, pd.Categorical.from_codes(match, MATCH_LEVELS)
+
+def path_vehicle_exposure(bike_paths, traffic_file):
+    # Daily vehicle miles along each path: matched volume times path length, zero where no count matched
+    volume, match = match_traffic_volume(bike_paths, build_street_index(load_traffic_segments(traffic_file)))
+    lengths = bike_paths.geometry.to_crs(PROJECTED_CRS).length.to_numpy()
+    print(f"Matched traffic counts to {(match != 'none').sum()} of {len(bike_paths)} bike paths "
+          f"({', '.join(f'{level}: {count}' for level, count in pd.Series(match).value_counts().items())})")
+    return np.nan_to_num(volume) * lengths / FEET_PER_MILE
+
+def exposure_normalized_scores(bike_paths, score_column='safety_score'):
+    # Score per thousand daily vehicle miles; paths without matched traffic have no normalized score
+    exposure = bike_paths['vehicle_exposure'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(exposure > 0, bike_paths[score_column].to_numpy() / exposure * 1000, np.nan)